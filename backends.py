@@ -0,0 +1,499 @@
+"""
+Execution backends for dispatcher.py.
+Both backends take the same job description and give the same kind of
+ job ids, log paths and statuses, so that the dispatcher does not need
+ to know where the jobs run:
+    slurm_backend: sbatch on O2 (what the dispatcher always did).
+    local_backend: a bounded pool of local processes with CPU and
+     memory admission control, for lab workstations and for testing
+     parameter sweeps without a cluster.
+Job description (submit):
+    args_script (list of str):
+        Arguments of the python call (script path first). '{task_id}'
+         in an argument is replaced by the array task id.
+    path_log (str):
+        Log path. %j (job id), %A (array job id) and %a (array task id)
+         are expanded like slurm does.
+    resources (dict):
+        {'cpus', 'mem_GB', 'time_str'}.
+    array (str):
+        Array task ids, '0-3', '0,2,5' (optionally '%N' for at most N at once).
+    after_ok (list of str):
+        Job ids that must complete successfully before this job starts.
+Statuses use the slurm state names:
+ PENDING, RUNNING, COMPLETED, FAILED, CANCELLED, TIMEOUT, ...
+"""
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+
+states_terminal = ['COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE']
+
+
+def parse_array(array):
+    """
+    Parse a slurm --array spec.
+    Args:
+        array (str):
+            eg '0-9', '0,3,7-9', '0-9%2'.
+
+    Returns:
+        task_ids (list of int):
+        max_parallel (int or None):
+    """
+    spec, _, max_parallel = str(array).partition('%')
+    task_ids = []
+    for part in spec.split(','):
+        if '-' in part:
+            start, stop = part.split('-')
+            task_ids += list(range(int(start), int(stop) + 1))
+        elif part != '':
+            task_ids.append(int(part))
+    return task_ids, (int(max_parallel) if max_parallel else None)
+
+
+def expand_log_path(path_log, job_id, array_job_id=None, task_id=None):
+    """
+    Expand slurm's %j, %A and %a in a log path.
+    """
+    path_log = str(path_log)
+    path_log = path_log.replace('%A', str(array_job_id if array_job_id is not None else job_id))
+    path_log = path_log.replace('%a', str(task_id) if task_id is not None else '4294967294')
+    return path_log.replace('%j', str(job_id))
+
+
+def _quote_arg(arg):
+    """
+    Double quote an argument for bash, keeping '{task_id}' as
+     ${SLURM_ARRAY_TASK_ID}.
+    """
+    arg = re.sub(r'([\\"$`])', r'\\\1', str(arg))
+    return '"' + arg.replace('{task_id}', '${SLURM_ARRAY_TASK_ID}') + '"'
+
+
+class slurm_backend():
+    """
+    Submits jobs with sbatch and reads their state with sacct.
+    """
+    def __init__(
+        self,
+        name_job,
+        partition='priority',
+        dir_workdir='/n/data1/hms/neurobio/sabatini/rich/',
+        modules=('gcc/9.2.0',),
+        conda_env='suite2p',
+        requeue_on_timeout=False,
+        requeue_signal_s=600,
+        max_requeues=3,
+        cmd_sbatch='sbatch',
+        cmd_sacct='sacct',
+    ):
+        """
+        Args:
+            name_job (str):
+                --job-name of all jobs.
+            partition (str):
+                Slurm partition.
+            dir_workdir (str):
+                Directory the jobs start in.
+            modules (tuple of str):
+                Modules to load before activating the environment.
+            conda_env (str):
+                Conda environment with suite2p.
+            requeue_on_timeout (bool):
+                Requeue a job (it resumes from its checkpoint) when it
+                 is requeue_signal_s seconds from its time limit,
+                 at most max_requeues times.
+            requeue_signal_s (int):
+                See requeue_on_timeout.
+            max_requeues (int):
+                See requeue_on_timeout.
+            cmd_sbatch (str):
+                sbatch command.
+            cmd_sacct (str):
+                sacct command.
+        """
+        self.name_job = name_job
+        self.partition = partition
+        self.dir_workdir = dir_workdir
+        self.modules = list(modules)
+        self.conda_env = conda_env
+        self.requeue_on_timeout = requeue_on_timeout
+        self.requeue_signal_s = requeue_signal_s
+        self.max_requeues = max_requeues
+        self.cmd_sbatch = cmd_sbatch
+        self.cmd_sacct = cmd_sacct
+        self.job_ids = []
+
+    def make_sbatch_config(self, path_log, resources, array=None, dependency=None, cmd_python='python "$@"'):
+        """
+        Make the text of an sbatch script.
+        Args:
+            path_log (str):
+                --output of the job.
+            resources (dict):
+                {'cpus', 'mem_GB', 'time_str'}.
+            array (str):
+                --array spec, or None.
+            dependency (str):
+                --dependency spec (eg 'afterok:123'), or None.
+                The job is cancelled if the dependency can never
+                 be satisfied (eg a job it depends on failed).
+            cmd_python (str):
+                The python call.
+        """
+        return \
+f"""#!/usr/bin/bash
+#SBATCH --job-name={self.name_job}
+#SBATCH --output={path_log}
+#SBATCH --partition={self.partition}
+#SBATCH -c {resources['cpus']}
+#SBATCH -n 1
+#SBATCH --mem={resources['mem_GB']}GB
+#SBATCH --time={resources['time_str']}
+""" + (f"""#SBATCH --requeue
+#SBATCH --open-mode=append
+#SBATCH --signal=B:USR1@{self.requeue_signal_s}
+""" if self.requeue_on_timeout else "") + \
+(f"""#SBATCH --array={array}
+""" if array is not None else "") + \
+(f"""#SBATCH --dependency={dependency}
+#SBATCH --kill-on-invalid-dep=yes
+""" if dependency is not None else "") + \
+f"""
+unset XDG_RUNTIME_DIR
+
+cd {self.dir_workdir}
+
+date
+
+echo "loading modules"
+""" + ''.join([f"""module load {module}
+""" for module in self.modules]) + \
+f"""
+echo "activating environment"
+source activate {self.conda_env}
+
+echo "starting job"
+""" + (f"""## requeue this job (it resumes from its checkpoint) when the time limit is near
+requeue_job() {{
+    if [ "${{SLURM_RESTART_COUNT:-0}}" -lt {self.max_requeues} ]; then
+        echo "time limit near, requeueing job $SLURM_JOB_ID (restart ${{SLURM_RESTART_COUNT:-0}})"
+        scontrol requeue $SLURM_JOB_ID
+    fi
+}}
+trap requeue_job USR1
+
+## run in the background so that the trap runs while python is running.
+##  wait returns early when the trap runs, so wait again (for the exit status of python)
+{cmd_python} &
+pid=$!
+wait $pid
+wait $pid
+""" if self.requeue_on_timeout else f"""{cmd_python}
+""")
+
+    def submit(self, args_script, path_log, resources, array=None, after_ok=None, path_submit=None):
+        """
+        Write an sbatch script and submit it.
+        Args:
+            See the module docstring.
+            path_submit (str):
+                Where to write the sbatch script.
+
+        Returns:
+            str:
+                The slurm job id.
+        """
+        sbatch_config = self.make_sbatch_config(
+            path_log=path_log,
+            resources=resources,
+            array=array,
+            dependency=('afterok:' + ':'.join([str(job_id) for job_id in after_ok])) if after_ok else None,
+            cmd_python='python ' + ' '.join([_quote_arg(arg) for arg in args_script]),
+        )
+        with open(str(path_submit), 'w') as f:
+            f.write(sbatch_config)
+        out = subprocess.run([self.cmd_sbatch, '--parsable', str(path_submit)], capture_output=True, text=True, check=True).stdout
+        job_id = out.strip().split(';')[0]
+        self.job_ids.append(job_id)
+        return job_id
+
+    def status(self, job_ids=None):
+        """
+        State of jobs (and of each array task) with one sacct call.
+        Args:
+            job_ids (list of str):
+                Job ids. None for all jobs submitted with this backend.
+
+        Returns:
+            dict:
+                {job id or 'arrayid_taskid': state}.
+        """
+        job_ids = self.job_ids if job_ids is None else job_ids
+        if len(job_ids) == 0:
+            return {}
+        out = subprocess.run(
+            [self.cmd_sacct, '-X', '-n', '-P', '-j', ','.join([str(job_id) for job_id in job_ids]), '--format=JobID,State'],
+            capture_output=True, text=True,
+        ).stdout
+        states = {}
+        for line in out.strip().splitlines():
+            fields = line.split('|')
+            if len(fields) >= 2:
+                states[fields[0]] = fields[1].split()[0] if fields[1] else 'UNKNOWN'
+        return states
+
+    def wait(self, job_ids=None, interval=60, timeout=None):
+        """
+        Block until all jobs are in a terminal state.
+        Returns:
+            dict:
+                Final states (see status).
+        """
+        tic = time.time()
+        while True:
+            states = self.status(job_ids)
+            if len(states) > 0 and all([state in states_terminal for state in states.values()]):
+                return states
+            if timeout is not None and (time.time() - tic) > timeout:
+                return states
+            time.sleep(interval)
+
+
+class _local_task():
+    """
+    One process of a local_backend job (one array task, or the whole job).
+    """
+    def __init__(self, job_id, task_id, args_script, path_log, resources, after_ok):
+        self.job_id = job_id
+        self.task_id = task_id
+        self.id = f'{job_id}_{task_id}' if task_id is not None else str(job_id)
+        self.args_script = args_script
+        self.path_log = path_log
+        self.resources = resources
+        self.after_ok = after_ok
+        self.state = 'PENDING'
+        self.process = None
+        self.f_log = None
+        self.time_start = None
+        self.time_end = None
+
+
+class local_backend():
+    """
+    Runs jobs as local processes. A job starts when its dependencies
+     have completed and its requested CPUs and memory fit into what is
+     free (admission control). Requests larger than the machine are
+     reduced to the machine size, so they run alone instead of never.
+    Jobs run in the background. Call wait() before exiting.
+    """
+    def __init__(self, max_cpus=None, max_mem_GB=None, cmd_python=None, interval=0.5, verbose=True):
+        """
+        Args:
+            max_cpus (int):
+                CPUs to share between jobs. Default: all.
+            max_mem_GB (float):
+                Memory to share between jobs. Default: all physical memory.
+            cmd_python (str):
+                Python to run the jobs with. Default: this python.
+            interval (float):
+                Seconds between scheduling passes.
+            verbose (bool):
+                Whether to print when jobs start and end.
+        """
+        self.max_cpus = max_cpus if max_cpus is not None else os.cpu_count()
+        self.max_mem_GB = max_mem_GB if max_mem_GB is not None else (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')) / 1024**3
+        self.cmd_python = cmd_python if cmd_python is not None else sys.executable
+        self.interval = interval
+        self.verbose = verbose
+
+        self.job_ids = []
+        self._tasks = []
+        self._max_parallel = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._schedule, daemon=True)
+        self._stop = False
+        self._thread.start()
+
+    def submit(self, args_script, path_log, resources, array=None, after_ok=None, path_submit=None):
+        """
+        Queue a job.
+        Args:
+            See the module docstring.
+            path_submit (str):
+                Ignored (there is no submission script).
+
+        Returns:
+            str:
+                The job id (a local counter, unrelated to slurm ids).
+        """
+        resources = {
+            **resources,
+            'cpus': min(int(resources.get('cpus', 1)), self.max_cpus),
+            'mem_GB': min(float(resources.get('mem_GB', 0)), self.max_mem_GB),
+        }
+        with self._lock:
+            job_id = str(self._next_id)
+            self._next_id += 1
+            task_ids, max_parallel = parse_array(array) if array is not None else ([None], None)
+            self._max_parallel[job_id] = max_parallel
+            for task_id in task_ids:
+                self._tasks.append(_local_task(
+                    job_id=job_id,
+                    task_id=task_id,
+                    args_script=[str(arg).replace('{task_id}', str(task_id)) for arg in args_script],
+                    path_log=expand_log_path(path_log, job_id=f'{job_id}_{task_id}' if task_id is not None else job_id, array_job_id=job_id, task_id=task_id),
+                    resources=resources,
+                    after_ok=[str(job_id_dep) for job_id_dep in (after_ok or [])],
+                ))
+            self.job_ids.append(job_id)
+        return job_id
+
+    def _dependency_state(self, task):
+        """
+        'ok', 'wait' or 'failed'.
+        """
+        tasks_dep = [t for t in self._tasks if t.job_id in task.after_ok]
+        if any([t.state in states_terminal and t.state != 'COMPLETED' for t in tasks_dep]):
+            return 'failed'
+        if all([t.state == 'COMPLETED' for t in tasks_dep]):
+            return 'ok'
+        return 'wait'
+
+    def _start(self, task):
+        """
+        Start the process of a task. If it can't be started (eg the
+         command or the log folder is bad), the task is FAILED, so that
+         its after_ok dependents are cancelled instead of waiting forever.
+
+        Returns:
+            bool:
+                Whether the process was started.
+        """
+        try:
+            self._popen(task)
+        except Exception as e:
+            task.state = 'FAILED'
+            task.time_start = task.time_end = time.time()
+            message = f'local job {task.id} FAILED to start: {type(e).__name__}: {e}'
+            if task.f_log is not None:
+                task.f_log.write(message + '\n')
+                task.f_log.close()
+            if self.verbose:
+                print(message)
+            return False
+        task.state = 'RUNNING'
+        task.time_start = time.time()
+        if self.verbose:
+            print(f"local job {task.id} started ({task.resources['cpus']} cpus, {task.resources['mem_GB']:.1f} GB), log: {task.path_log}")
+        return True
+
+    def _popen(self, task):
+        Path(task.path_log).parent.mkdir(parents=True, exist_ok=True)
+        task.f_log = open(task.path_log, 'a')
+        env = {
+            **os.environ,
+            'SLURM_JOB_ID': task.id,
+            'SLURM_CPUS_PER_TASK': str(task.resources['cpus']),
+            'OMP_NUM_THREADS': str(task.resources['cpus']),
+            'MKL_NUM_THREADS': str(task.resources['cpus']),
+            'NUMBA_NUM_THREADS': str(task.resources['cpus']),
+        }
+        if task.task_id is not None:
+            env.update({'SLURM_ARRAY_JOB_ID': task.job_id, 'SLURM_ARRAY_TASK_ID': str(task.task_id)})
+        else:
+            [env.pop(key, None) for key in ['SLURM_ARRAY_JOB_ID', 'SLURM_ARRAY_TASK_ID']]
+        task.process = subprocess.Popen([self.cmd_python] + task.args_script, stdout=task.f_log, stderr=subprocess.STDOUT, env=env)
+
+    def _schedule(self):
+        while not self._stop:
+            with self._lock:
+                ## finished processes
+                for task in [t for t in self._tasks if t.state == 'RUNNING']:
+                    returncode = task.process.poll()
+                    if returncode is not None:
+                        task.state = 'COMPLETED' if returncode == 0 else 'FAILED'
+                        task.time_end = time.time()
+                        task.f_log.close()
+                        if self.verbose:
+                            print(f'local job {task.id} {task.state} (exit code {returncode}) after {task.time_end - task.time_start:.1f} s')
+
+                ## admission, in submission order. jobs that don't fit are skipped so that smaller ones can start
+                running = [t for t in self._tasks if t.state == 'RUNNING']
+                cpus_free = self.max_cpus - sum([t.resources['cpus'] for t in running])
+                mem_free = self.max_mem_GB - sum([t.resources['mem_GB'] for t in running])
+                for task in [t for t in self._tasks if t.state == 'PENDING']:
+                    dependency = self._dependency_state(task)
+                    if dependency == 'failed':
+                        task.state = 'CANCELLED'
+                        if self.verbose:
+                            print(f'local job {task.id} CANCELLED (dependency failed)')
+                        continue
+                    if dependency == 'wait':
+                        continue
+                    max_parallel = self._max_parallel[task.job_id]
+                    if max_parallel is not None and sum([t.job_id == task.job_id for t in running]) >= max_parallel:
+                        continue
+                    if task.resources['cpus'] <= cpus_free and task.resources['mem_GB'] <= mem_free:
+                        if not self._start(task):
+                            continue
+                        running.append(task)
+                        cpus_free -= task.resources['cpus']
+                        mem_free -= task.resources['mem_GB']
+            time.sleep(self.interval)
+
+    def status(self, job_ids=None):
+        """
+        State of jobs.
+        Args:
+            job_ids (list of str):
+                Job ids. None for all jobs submitted with this backend.
+
+        Returns:
+            dict:
+                {job id or 'jobid_taskid': state}.
+        """
+        job_ids = self.job_ids if job_ids is None else [str(job_id) for job_id in job_ids]
+        with self._lock:
+            return {t.id: t.state for t in self._tasks if t.job_id in job_ids}
+
+    def wait(self, job_ids=None, interval=None, timeout=None):
+        """
+        Block until all jobs are in a terminal state.
+        Returns:
+            dict:
+                Final states (see status).
+        """
+        tic = time.time()
+        while True:
+            states = self.status(job_ids)
+            if all([state in states_terminal for state in states.values()]):
+                return states
+            if timeout is not None and (time.time() - tic) > timeout:
+                return states
+            time.sleep(interval if interval is not None else self.interval)
+
+    def cancel(self, job_ids=None):
+        """
+        Cancel pending jobs and kill running ones.
+        """
+        job_ids = self.job_ids if job_ids is None else [str(job_id) for job_id in job_ids]
+        with self._lock:
+            for task in [t for t in self._tasks if t.job_id in job_ids]:
+                if task.state == 'RUNNING':
+                    task.process.kill()
+                    task.process.wait()
+                    task.f_log.close()
+                if task.state in ['PENDING', 'RUNNING']:
+                    task.state = 'CANCELLED'
+
+    def close(self):
+        self._stop = True
+        self._thread.join()
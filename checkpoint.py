@@ -0,0 +1,107 @@
+"""
+Manifest of the stages of a run that have finished, so that a job
+ that hit its time limit or was preempted can resume from the first
+ stage that did not finish instead of starting over.
+Used by stages.py. The manifest is a json file in dir_save:
+    {stage: {'status': 'started' or 'done', 'time': ..., ...}, ...}
+ with stages 'convert', 'plane{i}.registration', 'plane{i}.detection',
+ 'plane{i}.extraction', 'plane{i}.classification', 'plane{i}', 'combine'.
+A run resumes at 'convert', 'plane{i}.registration', 'plane{i}' or
+ 'combine'. Detection, extraction and classification of a plane run in
+ one suite2p.run_plane call: they are recorded when it returns, but a
+ failure in any of them runs all three again.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import time
+from pathlib import Path
+
+
+class checkpoint_manifest():
+    """
+    Read and update the checkpoint manifest of a run.
+    Updates are done under a file lock, since the plane jobs of
+     a fanned out run share one manifest.
+    """
+    def __init__(self, path, verbose=True):
+        """
+        Args:
+            path (str):
+                Path of the manifest json file.
+            verbose (bool):
+                Whether to print stage changes.
+        """
+        self.path = Path(path)
+        self.verbose = verbose
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(str(self.path) + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self):
+        if not self.path.exists():
+            return {}
+        with open(str(self.path), 'r') as f:
+            return json.load(f)
+
+    def _write(self, manifest):
+        path_tmp = str(self.path) + '.tmp'
+        with open(path_tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(path_tmp, str(self.path))
+
+    def read(self):
+        """
+        Returns:
+            dict:
+                The manifest.
+        """
+        with self._locked():
+            return self._read()
+
+    def _set(self, stage, status, **info):
+        with self._locked():
+            manifest = self._read()
+            manifest[stage] = {'status': status, 'time': time.ctime(), **info}
+            self._write(manifest)
+        if self.verbose:
+            print(f'checkpoint: {stage} {status}')
+
+    def start(self, stage, **info):
+        self._set(stage, 'started', **info)
+
+    def done(self, stage, **info):
+        self._set(stage, 'done', **info)
+
+    def clear(self, stage):
+        """
+        Forget a stage (and its sub stages: 'plane0' also clears 'plane0.*').
+        """
+        with self._locked():
+            manifest = self._read()
+            manifest = {key: val for key, val in manifest.items() if not (key == stage or key.startswith(stage + '.'))}
+            self._write(manifest)
+
+    def status(self, stage):
+        """
+        Returns:
+            str or None:
+                'started', 'done' or None if the stage never started.
+        """
+        return self.read().get(stage, {}).get('status', None)
+
+    def is_done(self, stage):
+        return self.status(stage) == 'done'
+
+    def is_interrupted(self, stage):
+        """
+        Whether a stage started but did not finish.
+        """
+        return self.status(stage) == 'started'
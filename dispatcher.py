@@ -19,7 +19,7 @@ import sys
 sys.path.append(dir_github)
 # %load_ext autoreload
 # %autoreload 2
-from basic_neural_processing_modules import container_helpers, server
+from basic_neural_processing_modules import container_helpers
 # from s2p_on_o2 import remote_run_s2p
 
 
@@ -34,6 +34,12 @@ dir_data = args[6]
 
 print(path_selfScript, dir_save, path_script, name_job, dir_data)
 
+## helper modules live next to remote_run_s2p.py in the s2p_on_o2 repo
+sys.path.append(str(Path(path_script).resolve().parent))
+import sweep
+import resources
+import backends
+
 ## set paths
 # dir_save = '/n/data1/hms/neurobio/sabatini/rich/analysis/suite2p_output/'
 Path(dir_save).mkdir(parents=True, exist_ok=True)
@@ -93,18 +99,68 @@ params_template = {
         'neuropil_extract': True,
         'inner_neuropil_radius': 2,
         'neucoeff': 0.7
-    }
+    },
+
+    ## reuse registered binaries across parameter sets that only change detection / extraction ops.
+    ##  entries are keyed by the input files and the registration ops. least recently used entries
+    ##  are deleted when the cache grows past quota_GB.
+    'reg_cache': {
+        'use': True,
+        'dir': str(Path(dir_fastDisk) / 'registration_cache'),
+        'quota_GB': 500,
+    },
+
+    ## record finished stages in checkpoint.json in each job's folder. a job that is run again
+    ##  (eg requeued, see requeue_on_timeout below) resumes from the first unfinished stage.
+    ##  keep_movie_raw keeps the converted binary so that an interrupted registration can restart.
+    'checkpoint': {
+        'use': True,
+        'keep_movie_raw': True,
+    },
+
+    ## after the run, also write stat / iscell / traces as flat, memory mappable arrays
+    ##  (plane*/roi_store, read with roi_store.roi_store). dtype_traces: 'float32' or 'float16'.
+    ##  compression: None (memory mappable) or 'zstd'. traces are chunked along time by chunk_frames.
+    'roi_store': {
+        'use': True,
+        'dtype_traces': 'float32',
+        'compression': None,
+        'chunk_frames': 10000,
+    },
+
+    ## append the wall time, CPU time, peak RSS and I/O of each stage to profile.jsonl in each job's folder.
+    ##  trace_python also records the peak of python allocations (tracemalloc, slower).
+    ##  collect them from the controller with util.load_stage_profiles
+    'profiling': {
+        'use': False,
+        'trace_python': False,
+    },
+
+    ## submit while the raw data is still being copied to dir_data (see master_controller.ipynb). the job copies
+    ##  each file to node local scratch ($TMPDIR) as soon as it is complete, runs suite2p there (fast_disk too)
+    ##  and copies the outputs back to dir_save at the end. staging is done when path_marker exists.
+    ##  only used when planes are not fanned out. $TMPDIR must fit the raw data, the binaries and the outputs.
+    'staging': {
+        'use': False,
+        'path_marker': str(Path(dir_data) / '.copy_complete'),
+        'workers': 8,
+        'interval': 10,
+        'timeout_s': 60*60*6,
+    },
 }
 
 
 ## make params dicts with grid swept values
-params = copy.deepcopy(params_template)
-params = [params]
-# params = [container_helpers.deep_update_dict(params, ['db', 'save_path0'], str(Path(val).resolve() / (name_save+str(ii)))) for val in dir_save]
-# params = [container_helpers.deep_update_dict(param, ['db', 'save_path0'], val) for param, val in zip(params, dirs_save_all)]
-# params = container_helpers.flatten_list([[container_helpers.deep_update_dict(p, ['lr'], val) for val in [0.00001, 0.0001, 0.001]] for p in params])
-
-# params_unchanging, params_changing = container_helpers.find_differences_across_dictionaries(params)
+## keys are dot separated paths into params_template. all combinations are run.
+##  see sweep.expand_sweep for the other forms a sweep can take.
+params_sweep = {
+    # 'ops.threshold_scaling': [0.8, 1.0, 1.2],
+    # 'ops.diameter': [10, 12, 14],
+    # 'ops.max_overlap': [0.5, 0.75],
+}
+params = sweep.expand_sweep(params_template, params_sweep)
+params_changing = sweep.find_changing_params(params, params_sweep)
+print(f'{len(params)} parameter sets')
 
 
 ## notes that will be saved as a text file in the outer directory
@@ -123,64 +179,194 @@ shutil.copy2(path_script, str(Path(dir_save) / Path(path_script).name));
 
 
 
-# ## save parameters to file
-# parameters_batch = {
-#     'params': params,
-#     # 'params_unchanging': params_unchanging,
-#     # 'params_changing': params_changing
-# }
-# import json
-# with open(str(Path(dir_save) / 'parameters_batch.json'), 'w') as f:
-#     json.dump(parameters_batch, f)
-
-# with open(str(Path(dir_save) / 'parameters_batch.json')) as f:
-#     test = json.load(f)
+## save parameters to file
+## in job array mode this is also the file each array task reads its parameters from
+parameters_batch = {
+    'params': params,
+    'params_sweep': {str(key): val for key, val in params_sweep.items()},
+    'params_changing': params_changing,
+}
+import json
+path_params_batch = str(Path(dir_save) / 'parameters_batch.json')
+with open(path_params_batch, 'w') as f:
+    json.dump(parameters_batch, f, indent=1)
 
 
-## run batch_run function
-paths_scripts = [path_script]
-params_list = params
-# sbatch_config_list = [sbatch_config]
-max_n_jobs=1
+## submit the jobs
+max_n_jobs=1  ## maximum number of parameter sets running at once (job array only)
 name_save=name_job
 
+## True: submit all parameter sets as one slurm job array (sbatch --array=0-N%max_n_jobs).
+## False: submit one job per parameter set (all at once on slurm; max_n_jobs only throttles the array).
+use_job_array = True
+
+## if nplanes > 1: split each parameter set into a conversion job, one job per plane
+##  (a job array that starts when the conversion succeeds) and a 'combined' job that
+##  starts when all planes succeed. planes then run at the same time instead of one after another.
+fan_out_planes = True
+nplanes = int(params_template['ops']['nplanes'])
+do_fan_out = fan_out_planes and (nplanes > 1)
+
+
+## estimate memory, cpus and walltime from the tiff headers and ops.
+##  the estimate is corrected using MaxRSS / Elapsed of previous runs recorded in path_resourceHistory.
+##  if False (or if no tiffs are found), the fixed values below are requested.
+##  with staging, the tiffs in dir_data are still being copied until the marker exists, so there is
+##   no estimate until then: it would only see the frames copied so far.
+estimate_resources = True
+path_resourceHistory = '/n/data1/hms/neurobio/sabatini/rich/analysis/suite2p_resource_history.json'
+sbatch_resources = {'cpus': 20, 'mem_GB': 240, 'time_str': '0-06:00:00'}
+
+## without a marker there is no way to tell that the copy is done
+staging_in_progress = any([
+    p['staging']['use'] and ((p['staging'].get('path_marker') is None) or not Path(p['staging']['path_marker']).exists())
+    for p in params if 'staging' in p
+])
+if estimate_resources and staging_in_progress:
+    print(f'staging: {dir_data} is still being copied, requesting the default resources')
+
+resource_estimate = None
+time_str_recording = sbatch_resources['time_str']  ## walltime of the whole recording (all planes)
+if estimate_resources and not staging_in_progress:
+    tiff_info = resources.read_tiff_info(dir_data)
+    if tiff_info['n_files'] > 0:
+        resources.update_history(path_resourceHistory)
+        resource_estimate = resources.estimate_resources(
+            tiff_info=tiff_info,
+            ops=[p['ops'] for p in params],
+            path_history=path_resourceHistory,
+        )
+        time_str_recording = resource_estimate['time_str']
+        if do_fan_out:
+            ## each plane job sees one plane's worth of frames
+            resource_estimate = resources.estimate_resources(
+                tiff_info={**tiff_info, 'n_pages': tiff_info['n_pages'] // nplanes, 'nplanes': 1},
+                ops=[{**p['ops'], 'nplanes': 1} for p in params],
+                path_history=path_resourceHistory,
+            )
+        sbatch_resources = {key: resource_estimate[key] for key in ['cpus', 'mem_GB', 'time_str']}
+        print(f"tiffs: {tiff_info['n_files']} files, {tiff_info['n_pages']} pages of {tiff_info['Ly']}x{tiff_info['Lx']}")
+        print(f"resource estimate: {sbatch_resources}  (history scale: {resource_estimate['scale']})")
+    else:
+        print(f'no tiffs found in {dir_data}, requesting the default resources')
+
+
+## requeue a job when it gets close to its time limit. it then resumes from its checkpoint.
+##  slurm sends SIGUSR1 requeue_signal_s seconds before the limit. a job is requeued at most max_requeues times.
+requeue_on_timeout = True
+requeue_signal_s = 600
+max_requeues = 3
+
+
+## where the jobs run (see backends.py). both backends take the same jobs and give job ids, logs and states the same way.
+##  'slurm': sbatch on O2.
+##  'local': a pool of processes on this machine. a job starts when its dependencies are done and its
+##   cpus / mem_GB fit into local_max_cpus / local_max_mem_GB (None: the whole machine).
+##   for small sessions on a workstation and for testing sweeps without the cluster.
+backend_name = 'slurm'
+local_max_cpus = None
+local_max_mem_GB = None
+
+if backend_name == 'slurm':
+    backend = backends.slurm_backend(
+        name_job=name_slurm,
+        requeue_on_timeout=requeue_on_timeout,
+        requeue_signal_s=requeue_signal_s,
+        max_requeues=max_requeues,
+    )
+elif backend_name == 'local':
+    backend = backends.local_backend(max_cpus=local_max_cpus, max_mem_GB=local_max_mem_GB)
+else:
+    raise ValueError(f'unknown backend: {backend_name}')
+
 
 ## define print log paths
 paths_log = [str(Path(dir_save) / f'{name_save}{jobNum}' / 'print_log_%j.log') for jobNum in range(len(params))]
 
-## define slurm SBATCH parameters
-sbatch_config_list = \
-[f"""#!/usr/bin/bash
-#SBATCH --job-name={name_slurm}
-#SBATCH --output={path}
-#SBATCH --partition=priority
-#SBATCH -c 20
-#SBATCH -n 1
-#SBATCH --mem=240GB
-#SBATCH --time=0-06:00:00
-
-unset XDG_RUNTIME_DIR
-
-cd /n/data1/hms/neurobio/sabatini/rich/
-
-date
-
-echo "loading modules"
-module load gcc/9.2.0
-
-echo "activating environment"
-source activate suite2p
-
-echo "starting job"
-python "$@"
-""" for path in paths_log]
-
-server.batch_run(
-    paths_scripts=paths_scripts,
-    params_list=params_list,
-    sbatch_config_list=sbatch_config_list,
-    max_n_jobs=max_n_jobs,
-    dir_save=str(dir_save),
-    name_save=name_save,
-    verbose=True,
-)
+## the conversion and combine steps of a fanned out run are light. conversion writes the binaries of
+##  all planes, so it gets the walltime of the whole recording rather than the per plane estimate
+resources_convert = {'cpus': 4, 'mem_GB': 32, 'time_str': time_str_recording}
+resources_combine = {'cpus': 4, 'mem_GB': 32, 'time_str': '0-02:00:00'}
+
+if do_fan_out:
+    job_ids = []
+    for jobNum, params_job in enumerate(params):
+        dir_job = Path(dir_save) / f'{name_save}{jobNum}'
+        dir_job.mkdir(parents=True, exist_ok=True)
+        path_params_job = dir_job / 'params.json'
+        with open(str(path_params_job), 'w') as f:
+            json.dump(params_job, f, indent=1)
+
+        ## remote_run_s2p.py takes the stage as a 4th argument. plane jobs use SLURM_ARRAY_TASK_ID as the plane index
+        id_convert = backend.submit(
+            args_script=[path_script, path_params_job, dir_job, 'convert'],
+            path_log=dir_job / 'print_log_convert_%j.log',
+            resources=resources_convert,
+            path_submit=dir_job / 'sbatch_config_convert.sh',
+        )
+        id_planes = backend.submit(
+            args_script=[path_script, path_params_job, dir_job, 'plane'],
+            path_log=dir_job / 'print_log_plane%a_%A.log',
+            resources=sbatch_resources,
+            array=f'0-{nplanes-1}',
+            after_ok=[id_convert],
+            path_submit=dir_job / 'sbatch_config_planes.sh',
+        )
+        id_combine = backend.submit(
+            args_script=[path_script, path_params_job, dir_job, 'combine'],
+            path_log=dir_job / 'print_log_combine_%j.log',
+            resources=resources_combine,
+            after_ok=[id_planes],
+            path_submit=dir_job / 'sbatch_config_combine.sh',
+        )
+        job_ids += [id_convert, id_planes, id_combine]
+        print(f'{name_save}{jobNum}: conversion job {id_convert} -> {nplanes} plane jobs {id_planes} -> combine job {id_combine}')
+elif use_job_array:
+    ## one directory per array task, made up front so that the logs can be written into them
+    for jobNum in range(len(params)):
+        (Path(dir_save) / f'{name_save}{jobNum}').mkdir(parents=True, exist_ok=True)
+
+    ## each task gets the shared parameter file and its own save directory
+    ##  ({name_save}{task_id}, the array task id is filled in by the backend).
+    ##  remote_run_s2p.py picks its parameters using SLURM_ARRAY_TASK_ID.
+    job_ids = [backend.submit(
+        args_script=[path_script, path_params_batch, str(Path(dir_save) / name_save) + '{task_id}'],
+        path_log=str(Path(dir_save) / f'{name_save}%a' / 'print_log_%A_%a.log'),
+        resources=sbatch_resources,
+        array=f'0-{len(params)-1}%{max_n_jobs}',
+        path_submit=Path(dir_save) / 'sbatch_config_array.sh',
+    )]
+    print(f'submitted job array {job_ids[0]} with {len(params)} tasks, at most {max_n_jobs} at once')
+else:
+    ## one job per parameter set. the ids come from the backend, so job_ids.txt only holds these jobs.
+    ##  on the local backend, admission control limits how many run at once
+    job_ids = []
+    for jobNum, params_job in enumerate(params):
+        dir_job = Path(dir_save) / f'{name_save}{jobNum}'
+        dir_job.mkdir(parents=True, exist_ok=True)
+        path_params_job = dir_job / 'params.json'
+        with open(str(path_params_job), 'w') as f:
+            json.dump(params_job, f, indent=1)
+        job_ids.append(backend.submit(
+            args_script=[path_script, path_params_job, dir_job],
+            path_log=paths_log[jobNum],
+            resources=sbatch_resources,
+            path_submit=dir_job / 'sbatch_config.sh',
+        ))
+    print(f'submitted {len(job_ids)} jobs: {job_ids}')
+
+
+## record the ids of the jobs just submitted so that util.slurm_job_monitor can track them
+with open(str(Path(dir_save) / 'job_ids.txt'), mode='a') as f:
+    f.write(''.join([f'{job_id}\n' for job_id in job_ids]))
+
+## record the jobs so that their MaxRSS / Elapsed can improve the next estimate
+##  (for fanned out runs only the plane jobs match the estimate)
+if resource_estimate is not None and backend_name == 'slurm':
+    resources.record_submission(path_resourceHistory, job_ids[1::3] if do_fan_out else job_ids, resource_estimate)
+
+## local jobs are children of this process, so wait for them
+if backend_name == 'local':
+    states = backend.wait()
+    backend.close()
+    print('\n'.join([f'job {job_id}: {state}' for job_id, state in states.items()]))
@@ -0,0 +1,497 @@
+"""
+Runs many sessions through the steps of master_controller.ipynb at once:
+    copy:     MICROSCOPE -> data1 (on the transfer node)
+    submit:   upload dispatcher.py and run it (on the compute login node)
+    compute:  wait for the session's slurm jobs (job_ids.txt)
+    retrieve: data1 -> MICROSCOPE (on the transfer node) and / or the local machine (sftp)
+Each session goes through the steps in order. Steps of different sessions
+ overlap, with a separate limit on how many copies, submissions, running
+ sessions and retrievals happen at once, so session N+1 copies while
+ session N computes and session N-1 is retrieved.
+The state of every session is saved to a json file after each change.
+ Running it again with the same file resumes where it stopped.
+
+Library:
+    pool = util.connection_pool(username=username, password=password)
+    sessions = [make_session(name) for name in ['AEG21/2022_05_14', 'AEG21/2022_05_15']]
+    orch = orchestrator(pool, sessions, path_state='orchestrator_state.json', path_dispatcher_local=...)
+    orch.run()
+CLI:
+    python orchestrator.py sessions.txt --username rh183 --state orchestrator_state.json
+     (sessions.txt: one session name per line, or a json list of session dicts)
+"""
+import json
+import os
+import shlex
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+try:
+    from . import util
+except ImportError:
+    import util
+
+
+stages = ['copy', 'submit', 'compute', 'retrieve']
+
+## paths of a session. '{session}' is the session name (eg 'AEG21/2022_05_14'),
+##  '{session_}' is the same with '/' replaced by '_'. None: skip.
+templates_session = {
+    'dir_data_MICROSCOPE': '/n/files/Neurobio/MICROSCOPE/Ally/Mesoscope/{session}',
+    'dir_data_remote': '/n/data1/hms/neurobio/sabatini/rich/data/2pRAM/{session}',
+    'dir_fastDisk_remote': '/n/data1/hms/neurobio/sabatini/rich/analysis/suite2p_fastDisk/{session}',
+    'dir_S2pOutput_remote': '/n/data1/hms/neurobio/sabatini/rich/analysis/suite2p_output/{session}',
+    'dir_s2pOutput_MICROSCOPE': '/n/files/Neurobio/MICROSCOPE/Ally/Mesoscope/{session}/suite2p_o2_output',
+    'dir_s2pOutput_local': None,
+    'name_slurm': '{session_}',
+    'name_job': 'jobNum_',
+}
+
+
+def make_session(name, **overrides):
+    """
+    Make the description of a session from templates_session.
+    Args:
+        name (str):
+            Session name, eg 'AEG21/2022_05_14'.
+        overrides:
+            Values (or templates) that replace those in templates_session.
+
+    Returns:
+        dict:
+            {'name': name, **paths}.
+    """
+    templates = {**templates_session, **overrides}
+    fill = {'session': name, 'session_': name.replace('/', '_')}
+    return {'name': name, **{key: (val.format(**fill) if isinstance(val, str) else val) for key, val in templates.items()}}
+
+
+def load_sessions(path, **overrides):
+    """
+    Read sessions from a file.
+    Args:
+        path (str):
+            Text file with one session name per line ('#' comments are
+             skipped), or a json list of session names and / or session
+             dicts (a dict needs 'name', missing paths come from the templates).
+        overrides:
+            Passed to make_session.
+
+    Returns:
+        list of dict:
+            Session descriptions.
+    """
+    with open(str(path), 'r') as f:
+        text = f.read()
+    try:
+        entries = json.loads(text)
+    except json.JSONDecodeError:
+        entries = [line.strip() for line in text.splitlines() if line.strip() != '' and not line.strip().startswith('#')]
+    return [make_session(e, **overrides) if isinstance(e, str) else make_session(e['name'], **{**overrides, **e}) for e in entries]
+
+
+class orchestrator():
+    """
+    Runs sessions through copy -> submit -> compute -> retrieve with
+     separate concurrency limits per step and a persisted state.
+    Commands run on exec channels of a util.connection_pool, so the
+     hosts are authenticated once (one Duo push per host).
+    """
+    def __init__(
+        self,
+        pool,
+        sessions,
+        path_state='orchestrator_state.json',
+        path_dispatcher_local=str(Path(__file__).resolve().parent / 'dispatcher.py'),
+        path_s2pScript_remote='/n/data1/hms/neurobio/sabatini/rich/github_repos/s2p_on_o2/remote_run_s2p.py',
+        hostname_transfer='transfer.rc.hms.harvard.edu',
+        hostname_compute='o2.hms.harvard.edu',
+        max_copy=2,
+        max_submit=1,
+        max_compute=4,
+        max_retrieve=2,
+        max_attempts=2,
+        use_staging=False,
+        workers_copy=8,
+        checksum=None,
+        timeout_copy=60*60*4,
+        timeout_retrieve=60*60*4,
+        interval=30,
+        workers_download=4,
+        cmd_squeue='squeue',
+        cmd_sacct='sacct',
+        verbose=True,
+    ):
+        """
+        Args:
+            pool (util.connection_pool):
+                Authenticated connections to the hosts.
+            sessions (list of dict):
+                Session descriptions (see make_session), in the order
+                 they should be processed.
+            path_state (str):
+                Local json file with the state of every session.
+            path_dispatcher_local (str):
+                dispatcher.py to upload to each session's output directory.
+            path_s2pScript_remote (str):
+                remote_run_s2p.py in the s2p_on_o2 repo on the server.
+            hostname_transfer (str):
+                Host to copy data on.
+            hostname_compute (str):
+                Host to submit and query jobs on.
+            max_copy (int):
+                Copies to data1 running at once.
+            max_submit (int):
+                Dispatcher runs at once.
+            max_compute (int):
+                Sessions with jobs on the cluster at once. A session
+                 is only submitted when there is room. None: no limit.
+            max_retrieve (int):
+                Retrievals running at once.
+            max_attempts (int):
+                Times a copy or retrieval is tried before the session
+                 is marked failed. Submissions are not retried.
+            use_staging (bool):
+                Copy in the background on the transfer node and submit
+                 right away (the jobs stage the files as they arrive).
+                 params_template['staging']['use'] must be True in
+                 dispatcher.py as well.
+            workers_copy (int):
+                Files copied at once by each copy and retrieval on the
+                 transfer node (see util.remote_copy).
+            checksum (str):
+                hashlib algorithm (eg 'blake2b') to verify copied and
+                 downloaded files with. The hashes are saved to
+                 .transfer_manifest.json in each destination.
+                 None: no verification.
+            timeout_copy (float):
+                Seconds a copy may take.
+            timeout_retrieve (float):
+                Seconds a retrieval may take.
+            interval (float):
+                Seconds between scheduler polls.
+            workers_download (int):
+                sftp channels for downloads to the local machine.
+            cmd_squeue (str):
+                squeue command (see util.slurm_job_monitor).
+            cmd_sacct (str):
+                sacct command (see util.slurm_job_monitor).
+            verbose (bool):
+                Whether to print progress.
+        """
+        self.pool = pool
+        self.sessions = {s['name']: s for s in sessions}
+        self.path_state = Path(path_state)
+        self.path_dispatcher_local = path_dispatcher_local
+        self.path_s2pScript_remote = path_s2pScript_remote
+        self.hostname_transfer = hostname_transfer
+        self.hostname_compute = hostname_compute
+        self.limits = {'copy': max_copy, 'submit': max_submit, 'retrieve': max_retrieve}
+        self.max_compute = max_compute
+        self.max_attempts = max_attempts
+        self.use_staging = use_staging
+        self.workers_copy = workers_copy
+        self.checksum = checksum
+        self.timeout_copy = timeout_copy
+        self.timeout_retrieve = timeout_retrieve
+        self.interval = interval
+        self.workers_download = workers_download
+        self.cmd_squeue = cmd_squeue
+        self.cmd_sacct = cmd_sacct
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        self._monitors = {}
+        self.state = self._load_state()
+
+    ## state
+
+    def _load_state(self):
+        """
+        Load the state file and add new sessions.
+        Steps that were running when the last run stopped are run again,
+         except submissions that already wrote job ids.
+        """
+        state = {}
+        if self.path_state.exists():
+            with open(str(self.path_state), 'r') as f:
+                state = json.load(f)
+        for name in self.sessions:
+            if name not in state:
+                state[name] = {
+                    'stages': {stage: {'status': 'pending', 'attempts': 0, 'start': None, 'end': None, 'error': None} for stage in stages},
+                    'job_ids': [],
+                }
+            for stage in ['copy', 'submit', 'retrieve']:
+                if state[name]['stages'][stage]['status'] == 'running':
+                    state[name]['stages'][stage]['status'] = 'interrupted'
+        return state
+
+    def _save_state(self):
+        with self._lock:
+            self.path_state.parent.mkdir(parents=True, exist_ok=True)
+            path_tmp = self.path_state.with_name(self.path_state.name + '.tmp')
+            with open(str(path_tmp), 'w') as f:
+                json.dump(self.state, f, indent=1)
+            os.replace(str(path_tmp), str(self.path_state))
+
+    def _set(self, name, stage, **values):
+        with self._lock:
+            self.state[name]['stages'][stage].update(values)
+        self._save_state()
+        if self.verbose and 'status' in values:
+            error = self.state[name]['stages'][stage]['error']
+            print(f"{time.strftime('%H:%M:%S')}  {name}: {stage} {values['status']}" + (f'  ({error})' if values['status'] == 'failed' and error else ''))
+
+    def next_stage(self, name):
+        """
+        First step of a session that is not done. None if all are done.
+        """
+        for stage in stages:
+            if self.state[name]['stages'][stage]['status'] != 'done':
+                return stage
+        return None
+
+    def is_finished(self, name):
+        """
+        Whether a session is done or has failed for good.
+        """
+        stage = self.next_stage(name)
+        if stage is None:
+            return True
+        info = self.state[name]['stages'][stage]
+        return info['status'] == 'failed' and (stage in ['submit', 'compute'] or info['attempts'] >= self.max_attempts)
+
+    def status_table(self):
+        """
+        Returns:
+            str:
+                One line per session with the status of each step.
+        """
+        width = max([len(name) for name in self.state] + [7])
+        lines = [f"{'session':<{width}}  " + '  '.join([f'{stage:<11}' for stage in stages])]
+        for name in self.sessions:
+            lines.append(f'{name:<{width}}  ' + '  '.join([f"{self.state[name]['stages'][stage]['status']:<11}" for stage in stages]))
+        return '\n'.join(lines)
+
+    ## steps
+
+    def _run(self, hostname, cmd, timeout=None, login_shell=False):
+        return self.pool.run(hostname, cmd, timeout=timeout, login_shell=login_shell, check=True, verbose=False)
+
+    def _copy(self, session):
+        src, dst = session['dir_data_MICROSCOPE'], session['dir_data_remote']
+        self._run(self.hostname_transfer, f'mkdir -p {shlex.quote(dst)}')
+        if self.use_staging:
+            ## returns right away. '.copy_complete' tells the staging jobs that the copy is done
+            marker = shlex.quote(f'{dst}/.copy_complete')
+            cmd_copy = shlex.quote(f'cp -r {shlex.quote(src)}/. {shlex.quote(dst)} && touch {marker}')
+            self._run(self.hostname_transfer, f'rm -f {marker}; nohup sh -c {cmd_copy} > {shlex.quote(dst + "/.copy_log")} 2>&1 &')
+        else:
+            ## only new and changed files are copied, so a retried or resumed copy is cheap
+            self._remote_copy(src, dst, timeout=self.timeout_copy)
+
+    def _remote_copy(self, source, target, timeout=None):
+        ssh = self.pool.ssh(self.hostname_transfer, open_shell=False, verbose=False)
+        ## with a checksum, the hashes are kept next to the data for later copies and the registration cache
+        path_manifest = f'{target}/.transfer_manifest.json' if self.checksum is not None else None
+        return util.remote_copy(ssh, source, target, workers=self.workers_copy, checksum=self.checksum, path_manifest=path_manifest, timeout=timeout, verbose=self.verbose)
+
+    def _read_job_ids(self, session):
+        path = f"{session['dir_S2pOutput_remote']}/job_ids.txt"
+        return self.pool.run(self.hostname_compute, f'cat {shlex.quote(path)} 2>/dev/null', verbose=False).stdout.split()
+
+    def _submit(self, session, resumed=False):
+        ## a submission interrupted after the dispatcher ran must not submit the jobs twice
+        if resumed:
+            job_ids = self._read_job_ids(session)
+            if len(job_ids) > 0:
+                return job_ids
+        dir_out = session['dir_S2pOutput_remote']
+        path_dispatcher_remote = f'{dir_out}/dispatcher.py'
+        self._run(self.hostname_transfer, f'mkdir -p {shlex.quote(dir_out)}')
+        sftp = self.pool.sftp(self.hostname_transfer)
+        try:
+            sftp.sftp.put(str(self.path_dispatcher_local), path_dispatcher_remote)
+        finally:
+            sftp.close()
+        ## dispatcher.py expects: dir_save, path_script, name_job, dir_fastDisk, name_slurm, dir_data
+        args = [dir_out, self.path_s2pScript_remote, session['name_job'], session['dir_fastDisk_remote'], session['name_slurm'], session['dir_data_remote']]
+        self._run(self.hostname_compute, f"python {shlex.quote(path_dispatcher_remote)} {' '.join([shlex.quote(str(a)) for a in args])}", login_shell=True)
+        job_ids = self._read_job_ids(session)
+        if len(job_ids) == 0:
+            raise RuntimeError(f'dispatcher ran but wrote no job ids to {dir_out}/job_ids.txt')
+        return job_ids
+
+    def _retrieve(self, session):
+        dir_out = session['dir_S2pOutput_remote']
+        if session.get('dir_s2pOutput_MICROSCOPE') is not None:
+            dst = session['dir_s2pOutput_MICROSCOPE']
+            self._remote_copy(dir_out, dst, timeout=self.timeout_retrieve)
+        if session.get('dir_s2pOutput_local') is not None:
+            sftp = self.pool.sftp(self.hostname_transfer)
+            try:
+                sftp.get_dir(
+                    dir_out,
+                    session['dir_s2pOutput_local'],
+                    verbose=False,
+                    workers=self.workers_download,
+                    hash_type=self.checksum,
+                    path_manifest=str(Path(session['dir_s2pOutput_local']) / '.transfer_manifest.json') if self.checksum is not None else None,
+                )
+            finally:
+                sftp.close()
+
+    def _do(self, name, stage):
+        """
+        Run one step of a session (in a worker thread).
+        """
+        session = self.sessions[name]
+        resumed = self.state[name]['stages'][stage]['status'] == 'interrupted'
+        self._set(name, stage, status='running', start=time.time(), end=None, error=None, attempts=self.state[name]['stages'][stage]['attempts'] + 1)
+        if stage == 'copy':
+            self._copy(session)
+        elif stage == 'submit':
+            job_ids = self._submit(session, resumed=resumed)
+            with self._lock:
+                self.state[name]['job_ids'] = job_ids
+        elif stage == 'retrieve':
+            self._retrieve(session)
+
+    def _poll_compute(self, name):
+        """
+        Query the jobs of a session. Marks 'compute' done when every
+         job completed, failed when any job ended otherwise.
+        """
+        if name not in self._monitors:
+            self._monitors[name] = util.slurm_job_monitor(
+                ssh=self.pool.ssh(self.hostname_compute, open_shell=False, verbose=False),
+                job_ids=self.state[name]['job_ids'],
+                path_job_ids=f"{self.sessions[name]['dir_S2pOutput_remote']}/job_ids.txt",
+                interval=self.interval,
+                interval_max=max(self.interval, 600),
+                cmd_squeue=self.cmd_squeue,
+                cmd_sacct=self.cmd_sacct,
+                verbose=False,
+            )
+            self._set(name, 'compute', status='running', start=self.state[name]['stages']['compute']['start'] or time.time())
+        monitor = self._monitors[name]
+        table = monitor.query()
+        if not monitor.done():
+            return
+        states = {job_id: table[job_id].state.split()[0] for job_id in monitor._top_level_ids()}
+        ## a job that is still PENDING here will never run (eg its afterok dependency failed)
+        failed = {job_id: (f"{state} ({(table[job_id].reason or '').strip('()')})" if state == 'PENDING' else state) for job_id, state in states.items() if state != 'COMPLETED'}
+        if len(failed) == 0:
+            self._set(name, 'compute', status='done', end=time.time())
+        else:
+            self._set(name, 'compute', status='failed', end=time.time(), error=f'jobs did not complete: {failed}')
+        del self._monitors[name]
+
+    ## scheduling
+
+    def run(self, timeout=None):
+        """
+        Process all sessions. Returns when every session is done or
+         has failed (or after timeout seconds).
+        Can be stopped at any time (eg KeyboardInterrupt) and run again.
+
+        Returns:
+            dict:
+                The state of every session.
+        """
+        names = list(self.sessions.keys())
+        running = {}
+        tic = time.time()
+        with ThreadPoolExecutor(max_workers=sum(self.limits.values())) as executor:
+            while True:
+                ## finished steps
+                for future in [f for f in running if f.done()]:
+                    name, stage = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        self._set(name, stage, status='done', end=time.time())
+                    else:
+                        self._set(name, stage, status='failed', end=time.time(), error=f'{type(error).__name__}: {error}')
+
+                ## jobs on the cluster
+                for name in names:
+                    if self.next_stage(name) == 'compute' and not self.is_finished(name):
+                        try:
+                            self._poll_compute(name)
+                        except Exception as e:
+                            ## a dropped connection is retried on the next poll
+                            if self.verbose:
+                                print(f'{name}: could not query jobs ({type(e).__name__}: {e})')
+
+                ## start steps in session order while there is room
+                n_running = {stage: sum([s == stage for _, s in running.values()]) for stage in self.limits}
+                n_compute = sum([self.next_stage(name) == 'compute' and not self.is_finished(name) for name in names]) + n_running['submit']
+                for name in names:
+                    stage = self.next_stage(name)
+                    if stage not in self.limits or self.is_finished(name) or self.state[name]['stages'][stage]['status'] == 'running':
+                        continue
+                    ## the worker sets the status to 'running' only once it starts
+                    if (name, stage) in running.values():
+                        continue
+                    if n_running[stage] >= self.limits[stage]:
+                        continue
+                    if stage == 'submit':
+                        if self.max_compute is not None and n_compute >= self.max_compute:
+                            continue
+                        n_compute += 1
+                    running[executor.submit(self._do, name, stage)] = (name, stage)
+                    n_running[stage] += 1
+
+                if all([self.is_finished(name) for name in names]) and len(running) == 0:
+                    break
+                if timeout is not None and (time.time() - tic) > timeout:
+                    break
+                if len(running) > 0:
+                    wait(list(running.keys()), timeout=self.interval, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(self.interval)
+        if self.verbose:
+            print(self.status_table())
+        return self.state
+
+
+if __name__ == '__main__':
+    import argparse
+    import getpass
+
+    parser = argparse.ArgumentParser(description='Run many sessions through copy -> submit -> compute -> retrieve.')
+    parser.add_argument('path_sessions', help='text file with one session name per line, or a json list of sessions')
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--state', default='orchestrator_state.json', help='state file. run again with the same file to resume')
+    parser.add_argument('--dispatcher', default=str(Path(__file__).resolve().parent / 'dispatcher.py'), help='local dispatcher.py to upload')
+    parser.add_argument('--script-remote', default='/n/data1/hms/neurobio/sabatini/rich/github_repos/s2p_on_o2/remote_run_s2p.py')
+    parser.add_argument('--max-copy', type=int, default=2)
+    parser.add_argument('--max-submit', type=int, default=1)
+    parser.add_argument('--max-compute', type=int, default=4)
+    parser.add_argument('--max-retrieve', type=int, default=2)
+    parser.add_argument('--staging', action='store_true', help="copy in the background and submit right away (see params_template['staging'])")
+    parser.add_argument('--local-output', default=None, help="also download each session's outputs to this local directory (/{session} is appended)")
+    parser.add_argument('--interval', type=float, default=30)
+    args = parser.parse_args()
+
+    overrides = {'dir_s2pOutput_local': str(Path(args.local_output) / '{session}')} if args.local_output is not None else {}
+    pool = util.connection_pool(username=args.username, password=getpass.getpass(prompt='Password: '), passcode_method=1, keepalive=30)
+    try:
+        orchestrator(
+            pool=pool,
+            sessions=load_sessions(args.path_sessions, **overrides),
+            path_state=args.state,
+            path_dispatcher_local=args.dispatcher,
+            path_s2pScript_remote=args.script_remote,
+            max_copy=args.max_copy,
+            max_submit=args.max_submit,
+            max_compute=args.max_compute,
+            max_retrieve=args.max_retrieve,
+            use_staging=args.staging,
+            interval=args.interval,
+        ).run()
+    finally:
+        pool.close()
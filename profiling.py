@@ -0,0 +1,217 @@
+"""
+Per stage profiling of remote_run_s2p.py.
+Each stage appends one json line to profile.jsonl (next to log.txt)
+ with its wall time, CPU time, peak RSS and bytes read / written:
+    {'stage': 'plane0.registration', 'status': 'done', 'wall_s': ..., 'cpu_s': ...,
+     'peak_rss_GB': ..., 'read_GB': ..., 'written_GB': ..., 'job_id': ..., ...}
+Records of many jobs can be collected from the controller with
+ util.load_stage_profiles.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import resource
+import socket
+import time
+import tracemalloc
+from pathlib import Path
+
+
+def _read_proc(path):
+    """
+    Parse a 'key: value' file from /proc. {} if it can't be read.
+    """
+    try:
+        with open(path, 'r') as f:
+            return {line.split(':')[0].strip(): line.split(':', 1)[1].strip() for line in f if ':' in line}
+    except OSError:
+        return {}
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak RSS of this process (VmHWM) so that it can be
+     measured per stage. Linux only, returns False if it can't.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_bytes():
+    """
+    Peak RSS of this process: VmHWM from /proc, else ru_maxrss
+     (peak over the whole life of the process).
+    """
+    vm_hwm = _read_proc('/proc/self/status').get('VmHWM', None)
+    if vm_hwm is not None:
+        return int(vm_hwm.split()[0]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _snapshot():
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = _read_proc('/proc/self/io')
+    return {
+        'wall': time.time(),
+        'cpu': usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime,
+        'read_bytes': int(io['read_bytes']) if 'read_bytes' in io else None,
+        'write_bytes': int(io['write_bytes']) if 'write_bytes' in io else None,
+        'rchar': int(io['rchar']) if 'rchar' in io else None,
+        'wchar': int(io['wchar']) if 'wchar' in io else None,
+        'children_maxrss': usage_children.ru_maxrss * 1024,
+    }
+
+
+def _diff_GB(end, start, key):
+    if end[key] is None or start[key] is None:
+        return None
+    return round((end[key] - start[key]) / 1024**3, 4)
+
+
+class stage_profiler():
+    """
+    Records wall time, CPU time, peak RSS and I/O of stages and
+     appends them as json lines to a file.
+    Use as:
+        profiler = stage_profiler(dir_save / 'profile.jsonl')
+        with profiler.profile('convert'):
+            ...
+    """
+    def __init__(self, path_jsonl, trace_python=False, info=None):
+        """
+        Args:
+            path_jsonl (str):
+                File to append the records to.
+            trace_python (bool):
+                Whether to also record the peak of memory allocated
+                 through python (tracemalloc, 'peak_traced_GB').
+                Slows allocation heavy code down.
+            info (dict):
+                Added to every record. The slurm job ids, the host
+                 and the pid are always added.
+        """
+        self.path_jsonl = Path(path_jsonl)
+        self.trace_python = trace_python
+        self.info = {
+            'job_id': os.environ.get('SLURM_JOB_ID', None),
+            'array_job_id': os.environ.get('SLURM_ARRAY_JOB_ID', None),
+            'array_task_id': os.environ.get('SLURM_ARRAY_TASK_ID', None),
+            'restart_count': os.environ.get('SLURM_RESTART_COUNT', None),
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            **(info or {}),
+        }
+        self.records = []
+        if trace_python and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def profile(self, stage, **info):
+        """
+        Profile the code in the with block as one stage.
+        The record is written even if the block raises
+         (with status 'failed' and the error).
+        Args:
+            stage (str):
+                Name of the stage.
+            info:
+                Added to the record. A dict yielded by the context
+                 manager can also be filled in the block
+                 (eg with suite2p's ops['timing']).
+        """
+        extra = {}
+        peak_resettable = _reset_peak_rss()
+        if self.trace_python:
+            tracemalloc.reset_peak()
+        start = _snapshot()
+        status, error = 'done', None
+        try:
+            yield extra
+        except BaseException as e:
+            status, error = 'failed', f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            end = _snapshot()
+            record = {
+                'stage': stage,
+                'status': status,
+                'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start['wall'])),
+                'wall_s': round(end['wall'] - start['wall'], 3),
+                'cpu_s': round(end['cpu'] - start['cpu'], 3),
+                'peak_rss_GB': round(_peak_rss_bytes() / 1024**3, 4),
+                'peak_rss_is_stage': peak_resettable,
+                'peak_rss_children_GB': round(end['children_maxrss'] / 1024**3, 4),
+                'read_GB': _diff_GB(end, start, 'read_bytes'),
+                'written_GB': _diff_GB(end, start, 'write_bytes'),
+                'read_all_GB': _diff_GB(end, start, 'rchar'),
+                'written_all_GB': _diff_GB(end, start, 'wchar'),
+                **({'peak_traced_GB': round(tracemalloc.get_traced_memory()[1] / 1024**3, 4)} if self.trace_python else {}),
+                **({'error': error} if error is not None else {}),
+                **self.info,
+                **info,
+                **extra,
+            }
+            self.write(record)
+
+    def write(self, record):
+        """
+        Append a record to the file (under a lock, since plane jobs
+         of a fanned out run share one file).
+        """
+        self.records.append(record)
+        self.path_jsonl.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(self.path_jsonl), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(json.dumps(record, default=str) + '\n')
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_records(path_jsonl):
+    """
+    Read the records of a profile.jsonl file.
+    Lines that can't be parsed (eg cut off by a killed job) are skipped.
+    """
+    records = []
+    with open(str(path_jsonl), 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def summary_table(records):
+    """
+    Make a text table of stage records.
+    Args:
+        records (list of dict):
+            Records written by stage_profiler.
+
+    Returns:
+        str:
+            One line per record: stage, status, wall time, CPU time,
+             CPU use (cores), peak RSS and GB read / written (the
+             *_all_GB keys: page cache included).
+    """
+    def fmt(val, width, precision):
+        return f'{val:{width}.{precision}f}' if val is not None else f"{'-':>{width}}"
+
+    header = f"{'stage':<28} {'status':<7} {'wall_s':>9} {'cpu_s':>9} {'cores':>6} {'peak_rss_GB':>11} {'read_all_GB':>11} {'written_all_GB':>14}"
+    lines = [header, '-' * len(header)]
+    for r in records:
+        cores = (r['cpu_s'] / r['wall_s']) if r.get('wall_s') else None
+        lines.append(
+            f"{r['stage']:<28} {r['status']:<7} {fmt(r.get('wall_s'), 9, 1)} {fmt(r.get('cpu_s'), 9, 1)} {fmt(cores, 6, 1)} "
+            f"{fmt(r.get('peak_rss_GB'), 11, 2)} {fmt(r.get('read_all_GB'), 11, 2)} {fmt(r.get('written_all_GB'), 14, 2)}"
+        )
+    return '\n'.join(lines)
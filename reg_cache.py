@@ -0,0 +1,384 @@
+"""
+Content addressed cache of registered binaries.
+Parameter sets that differ only in detection / extraction ops
+ (threshold_scaling, max_overlap, diameter, ...) register the same
+ movie the same way. The first job registers each plane and stores the
+ registered binary and the plane's ops.npy here. Later jobs copy them
+ into their own plane folders and go straight to detection.
+Entries are read-only copies (reflinks where the filesystem supports
+ them), so nothing a job does to its own binary reaches the cache.
+The key is a hash of the input files and the registration relevant ops.
+Used by stages.py.
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+
+## ops that change the registered binary. everything else (detection, extraction,
+##  classification, spikes) can be changed without registering again.
+ops_keys_registration = [
+    'nplanes', 'nchannels', 'functional_chan', 'mesoscan', 'lines', 'dx', 'dy', 'nrois',
+    'frames_include', 'force_sktiff', 'input_format', 'look_one_level_down', 'tiff_list', 'subfolders',
+    'do_bidiphase', 'bidiphase', 'bidi_corrected',
+    'do_registration', 'two_step_registration', 'align_by_chan', 'nimg_init', 'maxregshift',
+    'smooth_sigma', 'smooth_sigma_time', 'th_badframes', 'norm_frames', 'force_refImg', 'pad_fft',
+    '1Preg', 'spatial_hp_reg', 'pre_smooth', 'spatial_taper', 'subpixel',
+    'nonrigid', 'block_size', 'snr_thresh', 'maxregshiftNR',
+]
+
+## suffixes of the input files, by ops['input_format']
+suffixes_input = {
+    'tif': ['.tif', '.tiff'],
+    'h5': ['.h5', '.hdf5'],
+    'sbx': ['.sbx'],
+    'nd2': ['.nd2'],
+    'mesoscan': ['.tif', '.tiff'],
+}
+
+
+def find_input_files(ops):
+    """
+    List the raw data files suite2p will read.
+    Args:
+        ops (dict):
+            suite2p ops merged with db (data_path, tiff_list,
+             look_one_level_down, input_format).
+
+    Returns:
+        list of Path:
+            Sorted paths of the input files.
+    """
+    dirs_data = [Path(d) for d in ops.get('data_path', [])]
+    if ops.get('tiff_list'):
+        return sorted([dirs_data[0] / name for name in ops['tiff_list']])
+    suffixes = suffixes_input.get(ops.get('input_format', 'tif'), suffixes_input['tif'])
+    pattern = '**/*' if ops.get('look_one_level_down', False) else '*'
+    return sorted([p for d in dirs_data for p in d.glob(pattern) if p.is_file() and p.suffix.lower() in suffixes])
+
+
+def _hash_file_sample(path, n_bytes=1024**2):
+    """
+    Hash the size and the first and last n_bytes of a file.
+    Cheap compared to hashing whole movies, and changes if the
+     file is replaced or rewritten.
+    """
+    h = hashlib.sha1()
+    size = os.path.getsize(path)
+    h.update(str(size).encode())
+    with open(path, 'rb') as f:
+        h.update(f.read(n_bytes))
+        if size > n_bytes:
+            f.seek(max(size - n_bytes, n_bytes))
+            h.update(f.read(n_bytes))
+    return h.hexdigest()
+
+
+## manifest written next to the raw data by a verified transfer (util.remote_copy with a checksum,
+##  sftp_interface.put_dir / sync_dir with hash_type). {relative path: {'size', 'mtime', 'hash', 'hash_type'}}
+name_manifest = '.transfer_manifest.json'
+
+
+def load_transfer_hashes(dirs_data):
+    """
+    Read the hashes recorded by transfers of the input files.
+    Args:
+        dirs_data (list of str):
+            Data directories (db['data_path']). The manifest is
+             looked for in each of them.
+
+    Returns:
+        dict:
+            {absolute path: manifest entry} of entries with a hash.
+    """
+    out = {}
+    for dir_data in dirs_data:
+        path_manifest = Path(dir_data) / name_manifest
+        if not path_manifest.exists():
+            continue
+        try:
+            with open(str(path_manifest), 'r') as f:
+                manifest = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        for path_rel, entry in manifest.items():
+            if isinstance(entry, dict) and entry.get('hash') is not None:
+                out[str((Path(dir_data) / path_rel).resolve())] = entry
+    return out
+
+
+def _hash_input_file(path, hashes_transfer):
+    """
+    Hash of an input file for the key: the full hash from the transfer
+     manifest if the file has not changed since (same size and mtime),
+     else a sample of the file (see _hash_file_sample).
+    """
+    entry = hashes_transfer.get(str(Path(path).resolve()), None)
+    if entry is not None:
+        st = os.stat(str(path))
+        if entry.get('size') == st.st_size and int(entry.get('mtime', -1)) == int(st.st_mtime):
+            return f"{entry['hash_type']}:{entry['hash']}"
+    return _hash_file_sample(path)
+
+
+def make_key(ops):
+    """
+    Make the cache key of a run.
+    Args:
+        ops (dict):
+            suite2p ops merged with db.
+
+    Returns:
+        str or None:
+            Hex key. None if the run can't use the cache
+             (no input files found, or do_registration is not 1:
+             0 means there is nothing to cache and 2 forces registration).
+    """
+    if ops.get('do_registration', 1) != 1:
+        return None
+    files = find_input_files(ops)
+    if len(files) == 0:
+        return None
+    import suite2p
+    h = hashlib.sha1()
+    h.update(str(getattr(suite2p, 'version', '')).encode())
+    h.update(json.dumps({key: ops.get(key, None) for key in ops_keys_registration}, sort_keys=True, default=str).encode())
+    hashes_transfer = load_transfer_hashes(ops.get('data_path', []))
+    for path in files:
+        h.update(path.name.encode())
+        h.update(_hash_input_file(path, hashes_transfer).encode())
+    return h.hexdigest()[:24]
+
+
+def _copy(path_src, path_dst, writable):
+    """
+    Copy path_src to path_dst as a reflink if the filesystem supports
+     it (no data is copied until one side is written), else a full copy.
+    Args:
+        writable (bool):
+            True: the copy can be written by its owner.
+            False: the copy is read-only.
+    """
+    path_dst = Path(path_dst)
+    path_dst.parent.mkdir(parents=True, exist_ok=True)
+    if path_dst.exists():
+        path_dst.unlink()
+    try:
+        subprocess.run(['cp', '--reflink=auto', str(path_src), str(path_dst)], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError):
+        shutil.copyfile(str(path_src), str(path_dst))
+    mode = stat.S_IMODE(os.stat(str(path_dst)).st_mode)
+    os.chmod(str(path_dst), (mode | stat.S_IWUSR) if writable else (mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)))
+
+
+def _dir_size(path):
+    return sum([p.stat().st_size for p in Path(path).rglob('*') if p.is_file()])
+
+
+class registration_cache():
+    """
+    Registered binaries and ops of single planes, one entry per
+     (key, plane): dir_cache/key/plane{i}/{ops.npy, data.bin, data_chan2.bin, complete}.
+    The mtime of 'complete' is the last time the entry was used.
+    Entries are built and read under a file lock, so concurrent
+     array tasks wait for the first one instead of registering the
+     same plane twice.
+    """
+    def __init__(self, dir_cache, quota_GB=None, verbose=True):
+        """
+        Args:
+            dir_cache (str):
+                Directory of the cache. Should be on the same
+                 filesystem as fast_disk so that entries can be reflinked.
+            quota_GB (float):
+                Maximum size of the cache. Least recently used
+                 entries are deleted when a new entry pushes the
+                 cache over the quota. None for no limit.
+            verbose (bool):
+                Whether to print hits, misses and evictions.
+        """
+        self.dir_cache = Path(dir_cache)
+        self.dir_cache.mkdir(parents=True, exist_ok=True)
+        self.quota_GB = quota_GB
+        self.verbose = verbose
+
+    def path_entry(self, key, iplane):
+        return self.dir_cache / key / f'plane{iplane}'
+
+    @contextlib.contextmanager
+    def lock(self, key, iplane, blocking=True):
+        """
+        Exclusive lock on one entry. Yields True if the lock was
+         acquired (always, if blocking).
+        """
+        path_lock = self.dir_cache / f'{key}_plane{iplane}.lock'
+        with open(str(path_lock), 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def has(self, key, iplane):
+        return (self.path_entry(key, iplane) / 'complete').exists()
+
+    def n_planes(self, key):
+        """
+        Number of planes of a key (saved when the data is converted).
+        None if unknown.
+        """
+        path_info = self.dir_cache / key / 'info.json'
+        if not path_info.exists():
+            return None
+        with open(str(path_info), 'r') as f:
+            return json.load(f)['n_planes']
+
+    def set_n_planes(self, key, n_planes):
+        (self.dir_cache / key).mkdir(parents=True, exist_ok=True)
+        with open(str(self.dir_cache / key / 'info.json'), 'w') as f:
+            json.dump({'n_planes': int(n_planes)}, f)
+
+    def has_all(self, key):
+        """
+        Whether every plane of a key is cached.
+        """
+        n_planes = self.n_planes(key)
+        return (n_planes is not None) and all([self.has(key, iplane) for iplane in range(n_planes)])
+
+    def store(self, key, iplane, op):
+        """
+        Store a registered plane. Call while holding lock(key, iplane).
+        Args:
+            key (str):
+                Cache key (make_key).
+            iplane (int):
+                Index of the plane.
+            op (dict):
+                ops of the plane after registration, with reg_file
+                 (and reg_file_chan2) still on disk.
+        """
+        path_entry = self.path_entry(key, iplane)
+        path_tmp = path_entry.with_name(path_entry.name + '.tmp')
+        shutil.rmtree(str(path_tmp), ignore_errors=True)
+        path_tmp.mkdir(parents=True)
+
+        op = dict(op)
+        for key_file, name in [('reg_file', 'data.bin'), ('reg_file_chan2', 'data_chan2.bin')]:
+            if op.get(key_file) and Path(op[key_file]).exists():
+                ## a copy: the job's binary is opened with memmap 'r+' for detection
+                _copy(op[key_file], path_tmp / name, writable=False)
+        np.save(str(path_tmp / 'ops.npy'), op)
+        (path_tmp / 'complete').touch()
+
+        shutil.rmtree(str(path_entry), ignore_errors=True)
+        os.replace(str(path_tmp), str(path_entry))
+        if self.verbose:
+            print(f'registration cache: stored {key} plane{iplane}')
+        self.evict(keep=[(key, iplane)])
+
+    def restore(self, key, iplane, ops_path, dir_fast_plane):
+        """
+        Put a cached plane into a run's plane folders.
+        Call while holding lock(key, iplane), which keeps evict
+         from deleting the entry meanwhile.
+        Args:
+            key (str):
+                Cache key (make_key).
+            iplane (int):
+                Index of the plane.
+            ops_path (str):
+                Where to write the plane's ops.npy (save_path/ops.npy).
+            dir_fast_plane (str):
+                Plane folder on fast_disk. The registered binaries
+                 are copied into it (writable).
+
+        Returns:
+            dict or None:
+                ops of the plane, with paths pointing to this run.
+                None if the entry is not in the cache (eg it was
+                 deleted by hand or by a job that did not lock it):
+                 a cache miss.
+        """
+        try:
+            return self._restore(key, iplane, ops_path, dir_fast_plane)
+        except FileNotFoundError:
+            if self.verbose:
+                print(f'registration cache: {key} plane{iplane} is gone, not restored')
+            return None
+
+    def _restore(self, key, iplane, ops_path, dir_fast_plane):
+        path_entry = self.path_entry(key, iplane)
+        op = np.load(str(path_entry / 'ops.npy'), allow_pickle=True).item()
+        op['save_path0'] = str(Path(ops_path).parent.parent.parent)
+        op['save_path'] = str(Path(ops_path).parent)
+        op['ops_path'] = str(ops_path)
+        op['fast_disk'] = str(dir_fast_plane)
+        for key_file, name in [('reg_file', 'data.bin'), ('reg_file_chan2', 'data_chan2.bin')]:
+            if (path_entry / name).exists():
+                _copy(path_entry / name, Path(dir_fast_plane) / name, writable=True)
+                op[key_file] = str(Path(dir_fast_plane) / name)
+        ## raw binaries are not cached. registration is skipped so they are not needed
+        [op.pop(key_file, None) for key_file in ['raw_file', 'raw_file_chan2']]
+        Path(ops_path).parent.mkdir(parents=True, exist_ok=True)
+        np.save(str(ops_path), op)
+        os.utime(str(path_entry / 'complete'))
+        if self.verbose:
+            print(f'registration cache: restored {key} plane{iplane}')
+        return op
+
+    def entries(self):
+        """
+        All complete entries as a list of (key, iplane, last_used, path),
+         least recently used first.
+        """
+        out = []
+        for path_complete in self.dir_cache.glob('*/plane*/complete'):
+            path_entry = path_complete.parent
+            if path_entry.name[5:].isdigit():
+                out.append((path_entry.parent.name, int(path_entry.name[5:]), path_complete.stat().st_mtime, path_entry))
+        return sorted(out, key=lambda e: e[2])
+
+    def size_GB(self):
+        return _dir_size(self.dir_cache) / 1024**3
+
+    def evict(self, keep=()):
+        """
+        Delete least recently used entries until the cache is
+         within quota_GB. Entries in keep and entries that are
+         locked by another job are not deleted.
+        Returns:
+            list of (key, iplane):
+                Deleted entries.
+        """
+        if self.quota_GB is None:
+            return []
+        entries = self.entries()
+        sizes = {(key, iplane): _dir_size(path) for key, iplane, _, path in entries}
+        total = _dir_size(self.dir_cache)
+        deleted = []
+        for key, iplane, _, path in entries:
+            if total <= self.quota_GB * 1024**3:
+                break
+            if (key, iplane) in keep:
+                continue
+            with self.lock(key, iplane, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                shutil.rmtree(str(path), ignore_errors=True)
+            total -= sizes[(key, iplane)]
+            deleted.append((key, iplane))
+            if self.verbose:
+                print(f'registration cache: evicted {key} plane{iplane}')
+        return deleted
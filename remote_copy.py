@@ -0,0 +1,267 @@
+"""
+Incremental, parallel copy of a directory tree on the server
+ (eg MICROSCOPE -> data1 on the transfer node).
+Replaces 'cp -r src/. dst', which copies every file again on every run
+ through one stream:
+    - size / mtime manifests of the source and destination are compared
+     and only new or changed files are copied.
+    - files are copied by several workers at once, largest first.
+    - copies are written to a temporary name and renamed when complete,
+     so a killed copy never leaves a truncated file under the real name.
+    - optionally, each copied file is verified with a checksum.
+The last line printed is 'REMOTE_COPY_SUMMARY {json}' with the number of
+ files and bytes copied / skipped and the throughput.
+Run on the server by util.remote_copy (the file is sent with the command,
+ it does not need to be on the server), or directly:
+    python3 remote_copy.py src dst --workers 8 --checksum blake2b
+Only uses the standard library (the transfer nodes have no conda).
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+marker_summary = 'REMOTE_COPY_SUMMARY '
+suffix_partial = '.partial_copy'
+
+
+def build_manifest(dir_root):
+    """
+    Size and mtime of every file under a directory.
+    Args:
+        dir_root (str):
+            Directory to index. A missing directory gives {}.
+
+    Returns:
+        dict:
+            {relative path: [size, mtime]}.
+    """
+    manifest = {}
+    dir_root = os.path.abspath(dir_root)
+    if not os.path.isdir(dir_root):
+        return manifest
+    for dirpath, dirnames, filenames in os.walk(dir_root):
+        for filename in filenames:
+            if filename.endswith(suffix_partial):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            manifest[os.path.relpath(path, dir_root)] = [st.st_size, st.st_mtime]
+    return manifest
+
+
+def plan_copy(manifest_src, manifest_dst):
+    """
+    Files to copy: new, or with a different size or mtime.
+    Copies keep the mtime of their source (see copy_file), so an
+     unchanged file matches on the next run. mtimes are compared to
+     the second since filesystems store them at different resolutions.
+
+    Returns:
+        to_copy (list of str):
+            Relative paths, largest first.
+        to_skip (list of str):
+            Relative paths that are up to date.
+    """
+    to_copy, to_skip = [], []
+    for path_rel, (size, mtime) in manifest_src.items():
+        entry_dst = manifest_dst.get(path_rel, None)
+        if entry_dst is not None and entry_dst[0] == size and int(entry_dst[1]) == int(mtime):
+            to_skip.append(path_rel)
+        else:
+            to_copy.append(path_rel)
+    to_copy.sort(key=lambda path_rel: manifest_src[path_rel][0], reverse=True)
+    return to_copy, to_skip
+
+
+def hash_file(path, checksum='blake2b', chunk_size=2**23):
+    h = hashlib.new(checksum)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def copy_file(path_src, path_dst, checksum=None, chunk_size=2**23):
+    """
+    Copy one file through a temporary name and keep its mtime.
+    Args:
+        path_src (str):
+            Source file.
+        path_dst (str):
+            Destination file.
+        checksum (str):
+            hashlib algorithm (eg 'blake2b', 'md5'). If set, the source
+             is hashed as it is copied and the written file is read
+             back and hashed. A mismatch raises IOError.
+             None: plain copy (uses the kernel's copy where it can).
+        chunk_size (int):
+            Bytes per read when hashing.
+
+    Returns:
+        str or None:
+            Hex digest of the file (None if checksum is None).
+    """
+    os.makedirs(os.path.dirname(path_dst), exist_ok=True)
+    path_tmp = path_dst + suffix_partial
+    digest = None
+    try:
+        if checksum is None:
+            shutil.copyfile(path_src, path_tmp)
+        else:
+            h = hashlib.new(checksum)
+            with open(path_src, 'rb') as f_src, open(path_tmp, 'wb') as f_dst:
+                for chunk in iter(lambda: f_src.read(chunk_size), b''):
+                    h.update(chunk)
+                    f_dst.write(chunk)
+            digest = h.hexdigest()
+            digest_dst = hash_file(path_tmp, checksum=checksum, chunk_size=chunk_size)
+            if digest_dst != digest:
+                raise IOError('checksum mismatch after copy: {} ({} != {})'.format(path_dst, digest_dst, digest))
+        shutil.copystat(path_src, path_tmp)
+        os.replace(path_tmp, path_dst)
+    except BaseException:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+        raise
+    return digest
+
+
+def copy_tree(source, target, workers=8, checksum=None, path_manifest=None, dry_run=False, verbose=False):
+    """
+    Copy the new and changed files of source to target.
+    Args:
+        source (str):
+            Source directory.
+        target (str):
+            Destination directory (made if missing). Files in target
+             that are not in source are left alone.
+        workers (int):
+            Number of files copied at once.
+        checksum (str):
+            See copy_file.
+        path_manifest (str):
+            If set, the manifest of target after the copy
+             ({relative path: {'size', 'mtime', 'hash', 'hash_type'}})
+             is written to this json file. Hashes are those of the files
+             copied with a checksum, now or in an earlier run. The
+             registration cache uses them instead of reading the files
+             (reg_cache.name_manifest is the name it looks for).
+        dry_run (bool):
+            Only compare the manifests.
+        verbose (bool):
+            Whether to print each file as it is copied.
+
+    Returns:
+        dict:
+            Summary: 'n_files', 'n_copied', 'n_skipped', 'n_bytes_copied',
+             'n_bytes_skipped', 'time', 'throughput_MBps', 'errors'
+             (list of [relative path, error]) and 'checksums'
+             ({relative path: hex digest} of the copied files).
+    """
+    source, target = os.path.abspath(source), os.path.abspath(target)
+    if not os.path.isdir(source):
+        raise FileNotFoundError('source directory not found: {}'.format(source))
+    tic = time.time()
+    manifest_src = build_manifest(source)
+    manifest_dst = build_manifest(target)
+    to_copy, to_skip = plan_copy(manifest_src, manifest_dst)
+    t_index = time.time() - tic
+
+    lock = threading.Lock()
+    checksums, errors = {}, []
+    n_bytes = [0]
+
+    def _copy(path_rel):
+        try:
+            digest = copy_file(os.path.join(source, path_rel), os.path.join(target, path_rel), checksum=checksum)
+        except Exception as e:
+            with lock:
+                errors.append([path_rel, '{}: {}'.format(type(e).__name__, e)])
+            return
+        with lock:
+            n_bytes[0] += manifest_src[path_rel][0]
+            if digest is not None:
+                checksums[path_rel] = digest
+        if verbose:
+            print('copied {}'.format(path_rel), flush=True)
+
+    if not dry_run:
+        os.makedirs(target, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(pool.map(_copy, to_copy))
+
+    t = time.time() - tic
+    summary = {
+        'source': source,
+        'target': target,
+        'n_files': len(manifest_src),
+        'n_copied': len(to_copy) - len(errors) if not dry_run else 0,
+        'n_to_copy': len(to_copy),
+        'n_skipped': len(to_skip),
+        'n_bytes_copied': n_bytes[0],
+        'n_bytes_to_copy': sum([manifest_src[p][0] for p in to_copy]),
+        'n_bytes_skipped': sum([manifest_src[p][0] for p in to_skip]),
+        'time': round(t, 3),
+        'time_index': round(t_index, 3),
+        'throughput_MBps': round(n_bytes[0] / 1e6 / max(t - t_index, 1e-9), 2),
+        'workers': workers,
+        'checksum': checksum,
+        'dry_run': dry_run,
+        'errors': errors,
+        'checksums': checksums,
+    }
+    if path_manifest is not None and not dry_run:
+        ## hashes of earlier copies are kept while the file's size and mtime are unchanged
+        manifest_old = {}
+        if os.path.isfile(path_manifest):
+            with open(path_manifest, 'r') as f:
+                manifest_old = json.load(f)
+        manifest = {}
+        for p, (size, mtime) in build_manifest(target).items():
+            if os.path.join(target, p) == os.path.abspath(path_manifest):
+                continue
+            manifest[p] = {'size': size, 'mtime': mtime}
+            entry_old = manifest_old.get(p, {})
+            if 'hash' in entry_old and entry_old.get('size') == size and int(entry_old.get('mtime', -1)) == int(mtime):
+                manifest[p].update({'hash': entry_old['hash'], 'hash_type': entry_old['hash_type']})
+        for p, digest in checksums.items():
+            manifest[p].update({'hash': digest, 'hash_type': checksum})
+        path_tmp = path_manifest + '.tmp'
+        with open(path_tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(path_tmp, path_manifest)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Incremental, parallel copy of a directory tree.')
+    parser.add_argument('source')
+    parser.add_argument('target')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--checksum', default=None, help="hashlib algorithm to verify copies with, eg 'blake2b'")
+    parser.add_argument('--path-manifest', default=None)
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    summary = copy_tree(
+        source=args.source,
+        target=args.target,
+        workers=args.workers,
+        checksum=args.checksum,
+        path_manifest=args.path_manifest,
+        dry_run=args.dry_run,
+        verbose=args.verbose,
+    )
+    print(marker_summary + json.dumps(summary), flush=True)
+    sys.exit(1 if len(summary['errors']) > 0 else 0)
@@ -6,13 +6,19 @@ print(f'Conda Environment: ' + os.environ['CONDA_DEFAULT_ENV'])
 from pathlib import Path
 
 import sys
-path_script, path_params, dir_save = sys.argv
+path_script, path_params, dir_save, *args_extra = sys.argv
 dir_save = Path(dir_save)
+## optional 4th argument: which stage to run (see stages.py). 'all' runs suite2p.run_s2p in one go
+stage = args_extra[0] if len(args_extra) > 0 else 'all'
                 
 import json
 with open(path_params, 'r') as f:
     params = json.load(f)
 
+## tasks of a slurm job array share one parameter file. pick this task's parameters
+from sweep import select_task_params
+params = select_task_params(params, task_id=os.environ.get('SLURM_ARRAY_TASK_ID'))
+
 import shutil
 shutil.copy2(path_script, str(Path(dir_save) / Path(path_script).name));
 
@@ -46,21 +52,124 @@ db = params['db']
 db['save_path0'] = str(dir_save)
 
 
-write_to_log(f'BATCH RUN STARTED. time: {time.ctime()}')
+write_to_log(f'BATCH RUN STARTED. stage: {stage}. time: {time.ctime()}')
 write_to_log(' ')
 
-output_ops = suite2p.run_s2p(ops=ops, db=db)
+import stages
+
+## registered binaries can be shared between parameter sets that register the same way (see reg_cache.py)
+cache = None
+if params.get('reg_cache', {}).get('use', False):
+    import reg_cache
+    cache = reg_cache.registration_cache(dir_cache=params['reg_cache']['dir'], quota_GB=params['reg_cache'].get('quota_GB', None))
+    ## concurrent jobs must not write their binaries to the same place
+    ops['fast_disk'] = str(Path(ops['fast_disk'] or str(dir_save)) / dir_save.name)
+
+## record finished stages in dir_save, and resume from the first unfinished one if this job ran before
+##  (eg it was requeued after hitting the time limit). see checkpoint.py
+checkpoint = None
+if params.get('checkpoint', {}).get('use', False):
+    from checkpoint import checkpoint_manifest
+    checkpoint = checkpoint_manifest(dir_save / 'checkpoint.json')
+    write_to_log(f'checkpoint: {checkpoint.read()}')
+    ## keep the converted binary so that an interrupted registration can restart from it
+    if params['checkpoint'].get('keep_movie_raw', True):
+        ops['keep_movie_raw'] = True
+
+## wall time, CPU time, peak RSS and I/O of each stage, appended to profile.jsonl next to log.txt (see profiling.py)
+import contextlib
+profiler = None
+if params.get('profiling', {}).get('use', False):
+    import profiling
+    profiler = profiling.stage_profiler(dir_save / 'profile.jsonl', trace_python=params.get('profiling', {}).get('trace_python', False), info={'name_job': dir_save.name})
+profile = profiler.profile if profiler is not None else (lambda stage, **info: contextlib.nullcontext({}))
+
+## copy the input files to node local scratch while they are still arriving on data1, and run suite2p there.
+##  suite2p starts once every file is staged: only the queue wait and the staging overlap with the upstream copy.
+##  the outputs are copied back to dir_save at the end (see staging.py). only for single job runs:
+##  the stages of a fanned out run are on different nodes
+dir_local = None
+if params.get('staging', {}).get('use', False) and stage == 'all':
+    import staging
+    dir_local = staging.get_local_scratch() / f"s2p_{os.environ.get('SLURM_JOB_ID', os.getpid())}"
+    with profile('staging'):
+        staging.stage_inputs(
+            dirs_src=db['data_path'],
+            dir_dst=dir_local / 'data',
+            path_marker=params['staging'].get('path_marker', None),
+            workers=params['staging'].get('workers', 8),
+            interval=params['staging'].get('interval', 10),
+            timeout=params['staging'].get('timeout_s', 60*60*6),
+        )
+    db['data_path'] = [str(dir_local / 'data')]
+    db['save_path0'] = str(dir_local / 'save')
+    ops['fast_disk'] = str(dir_local / 'fast_disk')
+    write_to_log(f'STAGING FINISHED. time: {time.ctime()}')
+
+name_plot = 'batch_run_output.png'
+if stage == 'all':
+    if (cache is None) and (checkpoint is None):
+        with profile('run_s2p') as extra:
+            output_ops = suite2p.run_s2p(ops=ops, db=db)
+            extra['timing'] = output_ops.get('timing', None)
+    else:
+        output_ops = stages.run_all(ops=ops, db=db, cache=cache, checkpoint=checkpoint, profiler=profiler)
+elif stage == 'convert':
+    stages.convert(ops=ops, db=db, cache=cache, checkpoint=checkpoint, profiler=profiler)
+    output_ops = None
+elif stage == 'plane':
+    ## planes are the tasks of a job array
+    iplane = int(os.environ['SLURM_ARRAY_TASK_ID'])
+    output_ops = stages.run_plane(ops=ops, db=db, iplane=iplane, cache=cache, checkpoint=checkpoint, profiler=profiler)
+    name_plot = f'batch_run_output_plane{iplane}.png'
+elif stage == 'combine':
+    output_ops = stages.combine(ops=ops, db=db, checkpoint=checkpoint, profiler=profiler)
+else:
+    raise ValueError(f'unknown stage: {stage}')
 
 write_to_log(f'BATCH RUN FINISHED. time: {time.ctime()}')
 write_to_log(' ')
 
 
+## post processing: columnar, memory mappable copy of stat / iscell / traces (see roi_store.py)
+if params.get('roi_store', {}).get('use', False) and (output_ops is not None):
+    import roi_store
+    if stage == 'all':
+        dirs_store = roi_store.find_plane_dirs(stages.get_save_folder({**ops, **db}))
+    else:
+        dirs_store = [Path(output_ops['save_path'])]
+    with profile('roi_store'):
+        for dir_plane in dirs_store:
+            roi_store.write_roi_store(
+                dir_plane=dir_plane,
+                dtype_traces=params['roi_store'].get('dtype_traces', 'float32'),
+                compression=params['roi_store'].get('compression', None),
+                chunk_frames=params['roi_store'].get('chunk_frames', 10000),
+            )
+    write_to_log(f'ROI STORE FINISHED. time: {time.ctime()}')
+
+
+## staged runs: copy the outputs from local scratch to dir_save, once
+if dir_local is not None:
+    with profile('copy_back'):
+        staging.copy_back(dir_local / 'save', dir_save, workers=params['staging'].get('workers', 8))
+        shutil.rmtree(str(dir_local), ignore_errors=True)
+    output_ops = {**output_ops, 'save_path': str(dir_save / Path(output_ops['save_path']).relative_to(dir_local / 'save'))} if output_ops is not None else None
+    write_to_log(f'COPY BACK FINISHED. time: {time.ctime()}')
+
+
 
 ##################
 #### PLOTTING ####
 ##################
 
 ## TODO: save images of output_ops stuff
+if output_ops is None:
+    if profiler is not None:
+        write_to_log('PROFILE:\n' + profiling.summary_table(profiler.records))
+    write_to_log(f'STAGE {stage} COMPLETE')
+    sys.exit(0)
+
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -69,20 +178,10 @@ iscell = np.load(Path(output_ops['save_path']).joinpath('iscell.npy'), allow_pic
 stats = np.load(stats_file, allow_pickle=True)
 
 
-n_cells = len(stats)
-
+## all ROIs are drawn at once (see render.py)
+import render
 Ly, Lx = output_ops['Ly'], output_ops['Lx']
-h = np.random.rand(n_cells)
-hsvs = np.zeros((2, Ly, Lx, 3), dtype=np.float32)
-
-for i, stat in enumerate(stats):
-    ypix, xpix, lam = stat['ypix'], stat['xpix'], stat['lam']
-    hsvs[iscell[i], ypix, xpix, 0] = h[i]
-    hsvs[iscell[i], ypix, xpix, 1] = 1
-    hsvs[iscell[i], ypix, xpix, 2] = lam / lam.max()
-
-from colorsys import hsv_to_rgb
-rgbs = np.array([hsv_to_rgb(*hsv) for hsv in hsvs.reshape(-1, 3)]).reshape(hsvs.shape)
+rgbs = render.roi_overlay(stats, iscell, Ly, Lx)
 
 plt.figure(figsize=(18,18))
 plt.subplot(3, 1, 1)
@@ -99,7 +198,21 @@ plt.title("All non-Cell ROIs");
 
 plt.tight_layout()
 
-plt.savefig(str(dir_save / 'batch_run_output.png'))
+plt.savefig(str(dir_save / name_plot))
+
+## small PNGs for a quick look from the controller
+render.save_thumbnails(
+    images={
+        f'{Path(name_plot).stem}_max_proj': output_ops['max_proj'],
+        f'{Path(name_plot).stem}_meanImg': output_ops['meanImg'],
+        f'{Path(name_plot).stem}_cells': rgbs[1],
+        f'{Path(name_plot).stem}_nonCells': rgbs[0],
+    },
+    dir_save=dir_save / 'thumbnails',
+    max_size=512,
+)
 
 write_to_log(f'SAVING FIGURES FINISHED. time: {time.ctime()}')
-write_to_log('RUN COMPLETE')
\ No newline at end of file
+if profiler is not None:
+    write_to_log('PROFILE:\n' + profiling.summary_table(profiler.records))
+write_to_log('RUN COMPLETE' if stage in ['all', 'combine'] else f'STAGE {stage} COMPLETE')
\ No newline at end of file
@@ -0,0 +1,244 @@
+"""
+Rendering of ROI overlays and thumbnails for the figures saved at the
+ end of remote_run_s2p.py.
+All ROIs are drawn at once with numpy instead of a python loop over
+ ROIs and pixels (see benchmark at the bottom).
+"""
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+def hsv_to_rgb(hsv):
+    """
+    Vectorized colorsys.hsv_to_rgb.
+    Args:
+        hsv (np.ndarray):
+            Array of shape (..., 3) with hue, saturation and value in [0, 1].
+
+    Returns:
+        np.ndarray:
+            RGB array of the same shape.
+    """
+    hsv = np.asarray(hsv, dtype=np.float64)
+    h, s, v = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    i = np.floor(h * 6.0)
+    f = (h * 6.0) - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    i = i.astype(np.int64) % 6
+
+    ## same case table as colorsys. s == 0 gives grey
+    r = np.choose(i, [v, q, p, p, t, v])
+    g = np.choose(i, [t, v, v, q, p, p])
+    b = np.choose(i, [p, p, t, v, v, q])
+    rgb = np.stack([r, g, b], axis=-1)
+    grey = (s == 0.0)
+    rgb[grey] = v[grey][:, None]
+    return rgb
+
+
+def concatenate_stats(stats):
+    """
+    Concatenate the pixels of all ROIs.
+    Args:
+        stats (list of dict):
+            suite2p stat (contents of stat.npy).
+
+    Returns:
+        ypix (np.ndarray):
+            y coordinates of all pixels.
+        xpix (np.ndarray):
+            x coordinates of all pixels.
+        lam (np.ndarray):
+            Weights of all pixels.
+        roi (np.ndarray):
+            Index of the ROI of each pixel.
+    """
+    n_pix = np.array([len(stat['ypix']) for stat in stats], dtype=np.int64)
+    if len(stats) == 0 or n_pix.sum() == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.float32), np.zeros(0, np.int64)
+    ypix = np.concatenate([stat['ypix'] for stat in stats]).astype(np.int64)
+    xpix = np.concatenate([stat['xpix'] for stat in stats]).astype(np.int64)
+    lam = np.concatenate([stat['lam'] for stat in stats]).astype(np.float32)
+    roi = np.repeat(np.arange(len(stats), dtype=np.int64), n_pix)
+    return ypix, xpix, lam, roi
+
+
+def roi_overlay(stats, iscell, Ly, Lx, hues=None, seed=None):
+    """
+    Draw all ROIs, colored by a random hue and shaded by their
+     normalized weights, into one image for non-cells and one for cells.
+    Where ROIs overlap, the ROI later in stats is on top.
+    Args:
+        stats (list of dict):
+            suite2p stat (contents of stat.npy).
+        iscell (np.ndarray):
+            0 / 1 for each ROI (first column of iscell.npy).
+        Ly (int):
+            Height of the field of view.
+        Lx (int):
+            Width of the field of view.
+        hues (np.ndarray):
+            Hue of each ROI. If None, random hues are drawn.
+        seed (int):
+            Seed for the random hues.
+
+    Returns:
+        np.ndarray:
+            float32 RGB images of shape (2, Ly, Lx, 3).
+             [0] is the non-cells, [1] is the cells.
+    """
+    n_rois = len(stats)
+    if hues is None:
+        hues = np.random.default_rng(seed).random(n_rois) if seed is not None else np.random.rand(n_rois)
+    iscell = np.asarray(iscell).astype(np.int64)
+
+    ypix, xpix, lam, roi = concatenate_stats(stats)
+    rgbs = np.zeros((2, Ly, Lx, 3), dtype=np.float32)
+    if len(roi) > 0:
+        ## each pixel's weight divided by the max weight of its ROI
+        lam_max = np.zeros(n_rois, dtype=np.float32)
+        np.maximum.at(lam_max, roi, lam)
+        lam = lam / lam_max[roi]
+
+        ## keep only the last write to each pixel (the ROI on top)
+        idx = np.ravel_multi_index((iscell[roi], ypix, xpix), (2, Ly, Lx))
+        _, idx_last = np.unique(idx[::-1], return_index=True)
+        keep = len(idx) - 1 - idx_last
+
+        ## pixels without an ROI are black, so only the ROI pixels need converting
+        hsvs = np.stack([hues[roi[keep]], np.ones(len(keep)), lam[keep]], axis=-1).astype(np.float32)
+        rgbs.reshape(-1, 3)[idx[keep]] = hsv_to_rgb(hsvs)
+    return rgbs
+
+
+def downsample(image, factor):
+    """
+    Downsample an image by averaging factor x factor blocks.
+    Edges that don't fill a block are cropped.
+    Args:
+        image (np.ndarray):
+            Image of shape (Ly, Lx) or (Ly, Lx, n_channels).
+        factor (int):
+            Downsampling factor.
+    """
+    if factor <= 1:
+        return image
+    Ly, Lx = (image.shape[0] // factor) * factor, (image.shape[1] // factor) * factor
+    image = image[:Ly, :Lx]
+    return image.reshape(Ly // factor, factor, Lx // factor, factor, *image.shape[2:]).mean(axis=(1, 3))
+
+
+def save_thumbnails(images, dir_save, max_size=512, cmap='gray'):
+    """
+    Save downsampled PNGs of images.
+    Args:
+        images (dict):
+            {name: image}. Images are (Ly, Lx) (drawn with cmap)
+             or (Ly, Lx, 3) RGB.
+        dir_save (str):
+            Directory to save the PNGs to ({name}.png).
+        max_size (int):
+            Images are downsampled by an integer factor until
+             their longest side is at most max_size.
+        cmap (str):
+            Colormap of single channel images.
+
+    Returns:
+        list of Path:
+            Paths of the saved PNGs.
+    """
+    import matplotlib.pyplot as plt
+
+    Path(dir_save).mkdir(parents=True, exist_ok=True)
+    paths = []
+    for name, image in images.items():
+        image = np.asarray(image)
+        factor = int(np.ceil(max(image.shape[:2]) / max_size))
+        image = downsample(image.astype(np.float32), factor)
+        path = Path(dir_save) / f'{name}.png'
+        if image.ndim == 3:
+            plt.imsave(str(path), np.clip(image, 0, 1))
+        else:
+            plt.imsave(str(path), image, cmap=cmap)
+        paths.append(path)
+    return paths
+
+
+def _roi_overlay_loop(stats, iscell, Ly, Lx, hues):
+    """
+    The per ROI / per pixel rendering that roi_overlay replaces.
+    Kept for the benchmark.
+    """
+    from colorsys import hsv_to_rgb as hsv_to_rgb_colorsys
+    hsvs = np.zeros((2, Ly, Lx, 3), dtype=np.float32)
+    for i, stat in enumerate(stats):
+        ypix, xpix, lam = stat['ypix'], stat['xpix'], stat['lam']
+        hsvs[iscell[i], ypix, xpix, 0] = hues[i]
+        hsvs[iscell[i], ypix, xpix, 1] = 1
+        hsvs[iscell[i], ypix, xpix, 2] = lam / lam.max()
+    return np.array([hsv_to_rgb_colorsys(*hsv) for hsv in hsvs.reshape(-1, 3)]).reshape(hsvs.shape)
+
+
+def make_fake_stats(n_rois, Ly, Lx, radius=6, seed=0):
+    """
+    Random disk shaped ROIs, for the benchmark.
+    """
+    rng = np.random.default_rng(seed)
+    dy, dx = np.meshgrid(np.arange(-radius, radius + 1), np.arange(-radius, radius + 1), indexing='ij')
+    disk = (dy**2 + dx**2) <= radius**2
+    dy, dx = dy[disk], dx[disk]
+    stats = []
+    for _ in range(n_rois):
+        y, x = rng.integers(radius, Ly - radius), rng.integers(radius, Lx - radius)
+        stats.append({'ypix': y + dy, 'xpix': x + dx, 'lam': rng.random(len(dy)).astype(np.float32) + 0.01})
+    iscell = rng.integers(0, 2, n_rois)
+    return stats, iscell
+
+
+def benchmark(n_rois=2000, Ly=512, Lx=512, n_repeats=3, run_loop=True):
+    """
+    Time roi_overlay against the python loop it replaces, and check
+     that they make the same image.
+    Args:
+        n_rois (int):
+            Number of fake ROIs.
+        Ly (int):
+            Height of the fake field of view.
+        Lx (int):
+            Width of the fake field of view.
+        n_repeats (int):
+            Number of timed runs of roi_overlay (the best is reported).
+        run_loop (bool):
+            Whether to also time the loop (slow for large fields of view).
+
+    Returns:
+        dict:
+            Times in seconds ('vectorized', 'loop') and the max
+             absolute difference between the images ('max_diff').
+    """
+    stats, iscell = make_fake_stats(n_rois, Ly, Lx)
+    hues = np.random.default_rng(1).random(n_rois)
+
+    times = []
+    for _ in range(n_repeats):
+        tic = time.time()
+        rgbs = roi_overlay(stats, iscell, Ly, Lx, hues=hues)
+        times.append(time.time() - tic)
+    out = {'vectorized': min(times), 'loop': None, 'max_diff': None}
+
+    if run_loop:
+        tic = time.time()
+        rgbs_loop = _roi_overlay_loop(stats, iscell, Ly, Lx, hues=hues)
+        out['loop'] = time.time() - tic
+        out['max_diff'] = float(np.abs(rgbs - rgbs_loop).max())
+    print(f'{n_rois} ROIs, {Ly}x{Lx}: vectorized {out["vectorized"]:.3f}s' + (f', loop {out["loop"]:.3f}s ({out["loop"] / out["vectorized"]:.0f}x), max diff {out["max_diff"]:.2e}' if run_loop else ''))
+    return out
+
+
+if __name__ == '__main__':
+    benchmark(n_rois=2000, Ly=512, Lx=512)
+    benchmark(n_rois=20000, Ly=2048, Lx=2048)
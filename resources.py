@@ -0,0 +1,480 @@
+"""
+Data-size-aware estimation of the slurm resources (memory, cpus,
+ walltime) a suite2p run needs.
+The estimate is made from the TIFF headers under dir_data and the
+ suite2p ops, and is rescaled using the MaxRSS / Elapsed that sacct
+ recorded for earlier runs.
+Memory is in GB of 2**30 bytes throughout (predictions, history and
+ requests), which is what slurm means by --mem=NG and what sacct's
+ MaxRSS 'G' is.
+"""
+import json
+import math
+import os
+import re
+import struct
+import subprocess
+import time
+from pathlib import Path
+
+
+## rough per-pixel costs of a suite2p run on one O2 priority node.
+##  they only need to be in the right ballpark: the scale fitted
+##  from previous runs (see fit_history_scale) corrects them.
+coefs_default = {
+    'mem_overhead_GB': 6,         ## python, suite2p, numba, classifier
+    'mem_frames_reg': 6,          ## copies of a registration batch held at once
+    'mem_frames_reg_nonrigid': 4, ## extra copies for nonrigid block registration
+    'nbinned': 5000,              ## frames binned for detection (suite2p default)
+    'mem_frames_detect': 3,       ## copies of the binned movie held during detection
+    'sec_overhead': 10*60,        ## startup, classification, plotting
+    'sec_per_px_reg': 1/8e7,      ## rigid registration
+    'sec_per_px_reg_nonrigid': 1/8e7,
+    'sec_per_px_write': 1/2e8,    ## tiff -> binary conversion
+    'sec_per_px_extract': 1/1.5e8,
+    'sec_detect_per_px_frame': 1/4e7, ## per pixel of the binned movie
+}
+
+limits_default = {
+    'mem_GB': (8, 250),
+    'cpus': (4, 20),
+    'time_s': (30*60, 5*24*3600),
+}
+
+
+def read_tiff_info(dir_data, pattern='*.tif*'):
+    """
+    Read the headers of all TIFF files under a directory.
+    Only the headers are read, not the image data.
+    Files whose header can't be parsed (eg still being copied) are
+     skipped and counted in 'n_skipped'.
+    Args:
+        dir_data (str):
+            Directory with the raw TIFF files (searched recursively).
+        pattern (str):
+            Glob pattern of the TIFF files.
+
+    Returns:
+        dict:
+            'n_files': number of TIFF files.
+            'n_pages': total number of pages (frames x planes x channels).
+            'Ly', 'Lx': page height and width.
+            'bytes_per_px': bytes per pixel.
+            'nplanes', 'nchannels': from ScanImage metadata if present,
+             else None.
+            'n_bytes': total size of the files.
+            'n_skipped': number of files that could not be parsed.
+    """
+    paths = sorted([p for p in Path(dir_data).rglob(pattern) if p.is_file()])
+    info = {'n_files': 0, 'n_pages': 0, 'Ly': None, 'Lx': None, 'bytes_per_px': None, 'nplanes': None, 'nchannels': None, 'n_bytes': 0, 'n_skipped': 0}
+    for path in paths:
+        header = _read_tiff_header(path)
+        if header is None:
+            info['n_skipped'] += 1
+            continue
+        info['n_files'] += 1
+        info['n_pages'] += header['n_pages']
+        info['n_bytes'] += path.stat().st_size
+        for key in ['Ly', 'Lx', 'bytes_per_px', 'nplanes', 'nchannels']:
+            if info[key] is None:
+                info[key] = header[key]
+    return info
+
+
+def _read_tiff_header(path):
+    """
+    Minimal TIFF / BigTIFF header reader.
+    Reads the first two IFDs. If the pages are evenly spaced in the
+     file (as ScanImage writes them), the number of pages is derived
+     from the file size. Otherwise the IFD chain is walked.
+    Returns None if the file is not a TIFF or is cut short (eg empty
+     or still being written).
+    """
+    try:
+        return _parse_tiff_header(path)
+    except (KeyError, ValueError, struct.error, OSError):
+        return None
+
+
+def _parse_tiff_header(path):
+    size_file = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        order = {b'II': '<', b'MM': '>'}[f.read(2)]
+        version = struct.unpack(order + 'H', f.read(2))[0]
+        if version == 43:
+            f.read(4)
+            fmt_offset, fmt_count, size_entry, fmt_value = 'Q', 'Q', 20, 'Q'
+        else:
+            fmt_offset, fmt_count, size_entry, fmt_value = 'I', 'H', 12, 'I'
+        size_offset = struct.calcsize(fmt_offset)
+        size_count = struct.calcsize(fmt_count)
+
+        def _read_ifd(offset):
+            f.seek(offset)
+            n = struct.unpack(order + fmt_count, f.read(size_count))[0]
+            raw = f.read(n * size_entry)
+            next_offset = struct.unpack(order + fmt_offset, f.read(size_offset))[0]
+            tags = {}
+            for ii in range(n):
+                entry = raw[ii*size_entry : (ii+1)*size_entry]
+                tag, dtype = struct.unpack(order + 'HH', entry[:4])
+                count = struct.unpack(order + fmt_value, entry[4:4+struct.calcsize(fmt_value)])[0]
+                value_raw = entry[4+struct.calcsize(fmt_value):]
+                if dtype == 3:
+                    tags[tag] = struct.unpack(order + 'H', value_raw[:2])[0]
+                elif dtype in [4, 16]:
+                    tags[tag] = struct.unpack(order + ('I' if dtype == 4 else 'Q'), value_raw[:4 if dtype == 4 else 8])[0]
+                elif dtype == 2:
+                    tags[tag] = (count, struct.unpack(order + fmt_value, value_raw[:struct.calcsize(fmt_value)])[0], value_raw)
+            return tags, next_offset
+
+        ifd0 = struct.unpack(order + fmt_offset, f.read(size_offset))[0]
+        tags0, ifd1 = _read_ifd(ifd0)
+
+        ## ScanImage puts its settings in the ImageDescription (270) or Software (305) tag
+        text = ''
+        for tag in [270, 305]:
+            if tag in tags0:
+                count, offset, value_raw = tags0[tag]
+                if count <= len(value_raw):
+                    text += value_raw[:count].decode('latin-1')
+                else:
+                    f.seek(offset)
+                    text += f.read(min(count, 2**20)).decode('latin-1')
+
+        if ifd1 == 0:
+            n_pages = 1
+        else:
+            stride = ifd1 - ifd0
+            _, ifd2 = _read_ifd(ifd1)
+            if stride > 0 and (ifd2 == 0 or ifd2 - ifd1 == stride):
+                n_pages = max(1, round((size_file - ifd0) / stride))
+            else:
+                n_pages, offset = 1, ifd1
+                while offset != 0:
+                    n_pages += 1
+                    _, offset = _read_ifd(offset)
+
+    match_planes = re.search(r'SI\.hStackManager\.(?:numSlices|actualNumSlices)\s*=\s*(\d+)', text)
+    match_channels = re.search(r'SI\.hChannels\.channelSave\s*=\s*\[?([\d;\s]+)\]?', text)
+    return {
+        'n_pages': n_pages,
+        'Ly': tags0.get(257),
+        'Lx': tags0.get(256),
+        'bytes_per_px': (tags0.get(258, 16) // 8),
+        'nplanes': int(match_planes.group(1)) if match_planes else None,
+        'nchannels': len(re.findall(r'\d+', match_channels.group(1))) if match_channels else None,
+    }
+
+
+def predict(tiff_info, ops, coefs=None):
+    """
+    Predict peak memory and walltime from data size and ops,
+     before any correction from previous runs.
+    Args:
+        tiff_info (dict):
+            Output of read_tiff_info.
+        ops (dict):
+            suite2p ops (eg params['ops'] in dispatcher.py).
+            Uses nplanes, nchannels, batch_size, nonrigid,
+             block_size, do_registration, nbinned, multiplane_parallel.
+        coefs (dict):
+            Cost coefficients. See coefs_default.
+
+    Returns:
+        dict:
+            'mem_GB', 'time_s', 'cpus' and the data size features
+             ('n_frames', 'Ly', 'Lx', 'nplanes', 'nchannels').
+    """
+    coefs = {**coefs_default, **(coefs or {})}
+    ## suite2p deinterleaves the tiffs using ops, so ops win over the ScanImage metadata
+    nplanes = int(ops.get('nplanes') or tiff_info.get('nplanes') or 1)
+    nchannels = int(ops.get('nchannels') or tiff_info.get('nchannels') or 1)
+    Ly, Lx = int(tiff_info['Ly']), int(tiff_info['Lx'])
+    n_frames = tiff_info['n_pages'] // max(1, nplanes * nchannels)
+    px = Ly * Lx
+    bytes_px = 4
+
+    nonrigid = bool(ops.get('nonrigid', True))
+    block_size = ops.get('block_size', [128, 128])
+    n_blocks = math.ceil(Ly / block_size[0]) * math.ceil(Lx / block_size[1]) if nonrigid else 0
+    batch_size = int(ops.get('batch_size', 500))
+    nbinned = min(int(ops.get('nbinned', coefs['nbinned'])), n_frames)
+
+    mem_reg = batch_size * px * bytes_px * (coefs['mem_frames_reg'] + (coefs['mem_frames_reg_nonrigid'] if nonrigid else 0))
+    mem_reg += batch_size * n_blocks * 2 * (block_size[0] * block_size[1]) * 8 if nonrigid else 0  ## block fft buffers (complex64)
+    mem_detect = nbinned * px * bytes_px * coefs['mem_frames_detect']
+    mem_traces = n_frames * 4 * bytes_px * max(1000, px // 100)  ## F, Fneu, spks for an ROI count that grows with the FOV
+    mem_plane = max(mem_reg, mem_detect) + mem_traces
+    n_planes_at_once = nplanes if ops.get('multiplane_parallel', False) else 1
+    mem_GB = coefs['mem_overhead_GB'] + n_planes_at_once * mem_plane / 1024**3
+
+    px_frames = n_frames * px * nplanes
+    sec = px_frames * coefs['sec_per_px_write']
+    if ops.get('do_registration', 1):
+        sec += px_frames * (coefs['sec_per_px_reg'] + (coefs['sec_per_px_reg_nonrigid'] if nonrigid else 0))
+    sec += nbinned * px * nplanes * coefs['sec_detect_per_px_frame']
+    sec += px_frames * coefs['sec_per_px_extract']
+    time_s = coefs['sec_overhead'] + sec
+
+    cpus = math.ceil(8 * px / (512 * 512))
+
+    return {
+        'mem_GB': mem_GB,
+        'time_s': time_s,
+        'cpus': cpus,
+        'n_frames': n_frames,
+        'Ly': Ly,
+        'Lx': Lx,
+        'nplanes': nplanes,
+        'nchannels': nchannels,
+    }
+
+
+def estimate_resources(
+    tiff_info,
+    ops,
+    path_history=None,
+    safety_mem=1.3,
+    safety_time=1.5,
+    coefs=None,
+    limits=None,
+):
+    """
+    Estimate the slurm resources to request for a suite2p run.
+    The raw prediction (see predict) is rescaled by how far off it
+     was for previous runs (see fit_history_scale), then padded by
+     a safety factor and clipped to the partition limits.
+    Args:
+        tiff_info (dict):
+            Output of read_tiff_info.
+        ops (dict or list of dict):
+            suite2p ops. If a list (a sweep), the largest
+             request over all of them is returned.
+        path_history (str):
+            Path to the json history of previous runs.
+            See record_submission and update_history.
+        safety_mem (float):
+            Factor applied to the memory estimate.
+        safety_time (float):
+            Factor applied to the walltime estimate.
+        coefs (dict):
+            Cost coefficients. See coefs_default.
+        limits (dict):
+            {'mem_GB': (min, max), 'cpus': (min, max), 'time_s': (min, max)}.
+            See limits_default.
+
+    Returns:
+        dict:
+            'mem_GB' (int), 'cpus' (int), 'time_s' (int),
+             'time_str' (slurm 'D-HH:MM:SS'), 'prediction'
+             (the raw prediction) and 'scale' (from history).
+    """
+    limits = {**limits_default, **(limits or {})}
+    ops_list = [ops] if isinstance(ops, dict) else list(ops)
+    predictions = [predict(tiff_info, o, coefs=coefs) for o in ops_list]
+    prediction = {
+        **predictions[0],
+        'mem_GB': max(p['mem_GB'] for p in predictions),
+        'time_s': max(p['time_s'] for p in predictions),
+        'cpus': max(p['cpus'] for p in predictions),
+    }
+    scale = fit_history_scale(load_history(path_history))
+
+    clip = lambda val, key: int(min(max(val, limits[key][0]), limits[key][1]))
+    mem_GB = clip(math.ceil(prediction['mem_GB'] * scale['mem'] * safety_mem), 'mem_GB')
+    time_s = clip(math.ceil(prediction['time_s'] * scale['time'] * safety_time), 'time_s')
+    cpus = clip(prediction['cpus'], 'cpus')
+    return {
+        'mem_GB': mem_GB,
+        'cpus': cpus,
+        'time_s': time_s,
+        'time_str': format_slurm_time(time_s),
+        'prediction': prediction,
+        'scale': scale,
+    }
+
+
+def format_slurm_time(seconds):
+    """
+    Format seconds as a slurm time limit ('D-HH:MM:SS').
+    """
+    seconds = int(math.ceil(seconds))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{days}-{hours:02d}:{minutes:02d}:{seconds:02d}'
+
+
+def load_history(path_history):
+    """
+    Load the json history of previous runs.
+    Returns an empty list if the path is None or does not exist.
+    """
+    if path_history is None or not Path(path_history).exists():
+        return []
+    with open(path_history, 'r') as f:
+        return json.load(f)
+
+
+def save_history(path_history, history):
+    """
+    Save the json history of previous runs.
+    Written to a temporary file first so that a reader never
+     sees a half written file.
+    """
+    path_tmp = f'{path_history}.{os.getpid()}.tmp'
+    with open(path_tmp, 'w') as f:
+        json.dump(history, f, indent=1)
+    os.replace(path_tmp, path_history)
+
+
+def record_submission(path_history, job_ids, estimate):
+    """
+    Add submitted jobs to the history, so that their MaxRSS and
+     Elapsed can be filled in by update_history once they finish.
+    Args:
+        path_history (str):
+            Path to the json history.
+        job_ids (list of str):
+            Slurm job ids (an array job id stands for all its tasks).
+        estimate (dict):
+            Output of estimate_resources.
+    """
+    if path_history is None:
+        return
+    history = load_history(path_history)
+    for job_id in job_ids:
+        history.append({
+            'job_id': str(job_id),
+            'time_submitted': time.time(),
+            'prediction': estimate['prediction'],
+            'requested': {key: estimate[key] for key in ['mem_GB', 'cpus', 'time_s']},
+            'max_rss_GB': None,
+            'elapsed_s': None,
+            'state': None,
+        })
+    save_history(path_history, history)
+
+
+def update_history(path_history, cmd_sacct='sacct', max_age_days=30):
+    """
+    Fill in MaxRSS and Elapsed of finished jobs in the history
+     with one sacct call.
+    Jobs older than max_age_days that never finished are dropped.
+    Args:
+        path_history (str):
+            Path to the json history.
+        cmd_sacct (str):
+            sacct command.
+        max_age_days (float):
+            Age after which unfinished entries are dropped.
+
+    Returns:
+        list of dict:
+            The updated history.
+    """
+    history = load_history(path_history)
+    pending = [h for h in history if h['state'] is None]
+    if len(pending) == 0:
+        return history
+    try:
+        out = subprocess.run(
+            [cmd_sacct, '-n', '-P', '-j', ','.join(h['job_id'] for h in pending), '--format=JobID,State,Elapsed,MaxRSS'],
+            capture_output=True, text=True, timeout=60,
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return history
+
+    ## fold job steps and array tasks into the submitted job id: worst case over all of them
+    results = {}
+    for line in out.strip().splitlines():
+        fields = line.split('|')
+        if len(fields) < 4:
+            continue
+        job_id = re.split(r'[._]', fields[0])[0]
+        r = results.setdefault(job_id, {'states': [], 'elapsed_s': 0.0, 'max_rss_GB': 0.0})
+        if '.' not in fields[0]:
+            r['states'].append(fields[1].split()[0])
+        r['elapsed_s'] = max(r['elapsed_s'], parse_slurm_time(fields[2]) or 0.0)
+        r['max_rss_GB'] = max(r['max_rss_GB'], (parse_slurm_mem(fields[3]) or 0) / 1024**3)
+
+    states_running = ['PENDING', 'RUNNING', 'REQUEUED', 'RESIZING', 'SUSPENDED', 'CONFIGURING', 'COMPLETING']
+    t_now = time.time()
+    history_new = []
+    for h in history:
+        r = results.get(h['job_id'])
+        if h['state'] is None and r is not None and len(r['states']) > 0 and not any(s in states_running for s in r['states']):
+            h['state'] = 'COMPLETED' if all(s == 'COMPLETED' for s in r['states']) else sorted(set(r['states']) - {'COMPLETED'})[0]
+            h['elapsed_s'] = r['elapsed_s']
+            h['max_rss_GB'] = r['max_rss_GB']
+        if h['state'] is None and (t_now - h['time_submitted']) > max_age_days * 86400:
+            continue
+        history_new.append(h)
+    save_history(path_history, history_new)
+    return history_new
+
+
+def fit_history_scale(history, n_recent=20):
+    """
+    How far off the raw predictions were for previous runs.
+    Uses the median of observed / predicted over the most recent
+     completed runs. Runs killed for time or memory only give a
+     lower bound (observed >= requested), so they can only push
+     the scale up.
+    Args:
+        history (list of dict):
+            See load_history.
+        n_recent (int):
+            Number of recent runs to use.
+
+    Returns:
+        dict:
+            {'mem': scale, 'time': scale, 'n': number of runs used}.
+            Scales are 1.0 if there is no usable history.
+    """
+    done = [h for h in history if h.get('state') is not None and h.get('prediction') is not None][-n_recent:]
+    ratios = {'mem': [], 'time': []}
+    for h in done:
+        if h['state'] == 'COMPLETED':
+            if h['max_rss_GB']:
+                ratios['mem'].append(h['max_rss_GB'] / h['prediction']['mem_GB'])
+            if h['elapsed_s']:
+                ratios['time'].append(h['elapsed_s'] / h['prediction']['time_s'])
+        elif h['state'] == 'OUT_OF_MEMORY':
+            ratios['mem'].append(1.5 * h['requested']['mem_GB'] / h['prediction']['mem_GB'])
+        elif h['state'] == 'TIMEOUT':
+            ratios['time'].append(1.5 * h['requested']['time_s'] / h['prediction']['time_s'])
+
+    median = lambda vals: sorted(vals)[len(vals)//2] if len(vals) > 0 else 1.0
+    return {'mem': median(ratios['mem']), 'time': median(ratios['time']), 'n': len(done)}
+
+
+def parse_slurm_time(text):
+    """
+    Parses a slurm duration ('[DD-][HH:]MM:SS[.mmm]') into seconds.
+    Returns None for empty, 'UNLIMITED' or 'INVALID'.
+    """
+    text = text.strip()
+    if text in ['', 'UNLIMITED', 'INVALID', 'Partition_Limit', 'NOT_SET']:
+        return None
+    days, _, text = text.rpartition('-')
+    parts = [float(p) for p in text.split(':')]
+    while len(parts) < 3:
+        parts.insert(0, 0.0)
+    return (float(days) if days else 0.0) * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def parse_slurm_mem(text):
+    """
+    Parses a slurm memory value ('1234K', '2.5G', '0') into bytes.
+    Slurm's units are binary (K = 2**10, G = 2**30).
+    Returns None if empty.
+    """
+    text = text.strip()
+    if text == '':
+        return None
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    if text[-1].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(float(text))
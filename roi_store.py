@@ -0,0 +1,262 @@
+"""
+Columnar store of suite2p outputs that can be memory mapped.
+stat.npy is a pickled array of dicts and F.npy / Fneu.npy / spks.npy
+ have to be loaded whole. The store keeps the same data in flat arrays:
+    meta.json
+    pix_offsets.npy         (n_rois + 1,) int64. pixels of ROI i are [offsets[i], offsets[i+1])
+    ypix.npy, xpix.npy      (n_pix,) int32
+    lam.npy                 (n_pix,) float32
+    scalars/{key}.npy       (n_rois,) or (n_rois, k). per ROI values from stat
+    iscell.npy              (n_rois, 2)
+    traces/{name}/{i}.npy   (n_rois, n_frames of chunk i). chunks along time.
+                             .npy.zst if compressed
+Written by write_roi_store (a post processing stage of remote_run_s2p.py),
+ read lazily by roi_store.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+names_traces = ['F', 'Fneu', 'spks', 'F_chan2', 'Fneu_chan2']
+
+## stat keys with one value per pixel, stored with pix_offsets instead of as scalars
+keys_pixels = ['ypix', 'xpix', 'lam']
+
+
+def _scalar_keys(stats):
+    """
+    stat keys whose values are numbers or fixed length arrays of
+     numbers in every ROI. Keys of any ROI are used. A number that is
+     missing in some ROIs is filled with NaN (see _scalar_values); an
+     array that is missing in some ROIs is not stored.
+    """
+    keys = list(dict.fromkeys([key for stat in stats for key in stat.keys()]))
+    keys_out = []
+    for key in keys:
+        if key in keys_pixels:
+            continue
+        shapes = set()
+        for stat in stats:
+            val = np.asarray(stat.get(key, np.nan))
+            if (val.dtype.kind not in 'biuf') or (val.ndim > 1) or (val.ndim == 1 and len(val) > 16):
+                shapes = None
+                break
+            shapes.add(val.shape)
+        if shapes is not None and len(shapes) == 1:
+            keys_out.append(key)
+    return keys_out
+
+
+def _scalar_values(stats, key):
+    return np.array([stat.get(key, np.nan) for stat in stats])
+
+
+def _save_chunk(path, array, compression):
+    if compression is None:
+        np.save(str(path), array)
+    elif compression == 'zstd':
+        import io
+        import zstandard
+        buf = io.BytesIO()
+        np.save(buf, array)
+        with open(str(path) + '.zst', 'wb') as f:
+            f.write(zstandard.ZstdCompressor(level=3).compress(buf.getvalue()))
+    else:
+        raise ValueError(f'unknown compression: {compression}')
+
+
+def _load_chunk(path, compression):
+    if compression is None:
+        return np.load(str(path), mmap_mode='r')
+    import io
+    import zstandard
+    with open(str(path) + '.zst', 'rb') as f:
+        return np.load(io.BytesIO(zstandard.ZstdDecompressor().decompress(f.read())))
+
+
+def write_roi_store(dir_plane, dir_store=None, dtype_traces='float32', compression=None, chunk_frames=10000, verbose=True):
+    """
+    Write the columnar store of one plane folder (or 'combined').
+    Args:
+        dir_plane (str):
+            suite2p plane folder with stat.npy, iscell.npy and traces.
+        dir_store (str):
+            Where to write the store. Default: dir_plane/roi_store.
+        dtype_traces (str):
+            'float32' or 'float16'. float16 halves the size of the traces.
+        compression (str):
+            None (chunks can be memory mapped) or 'zstd'.
+        chunk_frames (int):
+            Number of frames per trace chunk.
+        verbose (bool):
+            Whether to print what was written.
+
+    Returns:
+        Path:
+            Path of the store.
+    """
+    dir_plane = Path(dir_plane)
+    dir_store = Path(dir_store) if dir_store is not None else dir_plane / 'roi_store'
+    (dir_store / 'scalars').mkdir(parents=True, exist_ok=True)
+
+    stats = np.load(str(dir_plane / 'stat.npy'), allow_pickle=True)
+    n_rois = len(stats)
+
+    ## pixels
+    n_pix = np.array([len(stat['ypix']) for stat in stats], dtype=np.int64)
+    np.save(str(dir_store / 'pix_offsets.npy'), np.concatenate([[0], np.cumsum(n_pix)]).astype(np.int64))
+    for key, dtype in [('ypix', np.int32), ('xpix', np.int32), ('lam', np.float32)]:
+        values = np.concatenate([np.asarray(stat[key]) for stat in stats]).astype(dtype) if n_rois > 0 else np.zeros(0, dtype)
+        np.save(str(dir_store / f'{key}.npy'), values)
+
+    ## per ROI values
+    keys_scalars = _scalar_keys(stats) if n_rois > 0 else []
+    for key in keys_scalars:
+        np.save(str(dir_store / 'scalars' / f'{key}.npy'), _scalar_values(stats, key))
+    if (dir_plane / 'iscell.npy').exists():
+        np.save(str(dir_store / 'iscell.npy'), np.load(str(dir_plane / 'iscell.npy'), allow_pickle=True))
+
+    ## traces, read with mmap so that they are never all in memory
+    traces = {}
+    for name in names_traces:
+        path = dir_plane / f'{name}.npy'
+        if not path.exists():
+            continue
+        F = np.load(str(path), mmap_mode='r')
+        dir_trace = dir_store / 'traces' / name
+        dir_trace.mkdir(parents=True, exist_ok=True)
+        n_frames = F.shape[1] if F.ndim == 2 else 0
+        n_chunks = int(np.ceil(n_frames / chunk_frames))
+        for i_chunk in range(n_chunks):
+            chunk = np.ascontiguousarray(F[:, i_chunk*chunk_frames : (i_chunk+1)*chunk_frames], dtype=dtype_traces)
+            _save_chunk(dir_trace / f'{i_chunk}.npy', chunk, compression)
+        traces[name] = {'n_frames': n_frames, 'n_chunks': n_chunks}
+
+    meta = {
+        'n_rois': n_rois,
+        'n_pix': int(n_pix.sum()),
+        'keys_scalars': keys_scalars,
+        'traces': traces,
+        'dtype_traces': str(np.dtype(dtype_traces)),
+        'compression': compression,
+        'chunk_frames': chunk_frames,
+    }
+    with open(str(dir_store / 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    if verbose:
+        print(f'wrote roi store: {dir_store}  ({n_rois} ROIs, traces: {list(traces.keys())})')
+    return dir_store
+
+
+class roi_store():
+    """
+    Lazy reader of a store written by write_roi_store.
+    Nothing is loaded until asked for. Uncompressed arrays are
+     memory mapped, so slicing reads only the parts that are used.
+    """
+    def __init__(self, dir_store):
+        """
+        Args:
+            dir_store (str):
+                Path of the store (eg plane0/roi_store).
+        """
+        self.dir_store = Path(dir_store)
+        with open(str(self.dir_store / 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self._arrays = {}
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(str(self.dir_store / name), mmap_mode='r')
+        return self._arrays[name]
+
+    @property
+    def n_rois(self):
+        return self.meta['n_rois']
+
+    @property
+    def names_traces(self):
+        return list(self.meta['traces'].keys())
+
+    @property
+    def keys_scalars(self):
+        return list(self.meta['keys_scalars'])
+
+    def n_frames(self, name='F'):
+        return self.meta['traces'][name]['n_frames']
+
+    def pixels(self, roi):
+        """
+        Pixels of one ROI.
+        Args:
+            roi (int):
+                Index of the ROI.
+
+        Returns:
+            ypix (np.ndarray):
+            xpix (np.ndarray):
+            lam (np.ndarray):
+        """
+        offsets = self._array('pix_offsets.npy')
+        start, stop = int(offsets[roi]), int(offsets[roi + 1])
+        return tuple([np.asarray(self._array(f'{key}.npy')[start:stop]) for key in keys_pixels])
+
+    def scalar(self, key):
+        """
+        Per ROI values of a stat key (eg 'med', 'npix', 'skew').
+        Returns:
+            np.ndarray:
+                Memory mapped array of shape (n_rois,) or (n_rois, k).
+        """
+        if key not in self.meta['keys_scalars']:
+            raise KeyError(f'{key} is not in the store. Stored keys: {self.keys_scalars}')
+        return self._array(str(Path('scalars') / f'{key}.npy'))
+
+    def iscell(self):
+        return self._array('iscell.npy')
+
+    def traces(self, name='F', rois=None, frames=None):
+        """
+        Read part of a trace array.
+        Only the chunks that overlap frames are read.
+        Args:
+            name (str):
+                'F', 'Fneu', 'spks', 'F_chan2' or 'Fneu_chan2'.
+            rois (int, slice, list or np.ndarray):
+                ROIs to read. None for all.
+            frames (slice):
+                Frames to read (step must be 1 or None). None for all.
+
+        Returns:
+            np.ndarray:
+                Array of shape (n_rois selected, n_frames selected).
+        """
+        if name not in self.meta['traces']:
+            raise KeyError(f'{name} is not in the store. Stored traces: {self.names_traces}')
+        n_frames = self.meta['traces'][name]['n_frames']
+        chunk_frames = self.meta['chunk_frames']
+        rois = slice(None) if rois is None else ([rois] if isinstance(rois, (int, np.integer)) else rois)
+        frames = slice(None) if frames is None else frames
+        start, stop, step = frames.indices(n_frames)
+        if step != 1:
+            raise ValueError('frames must be a slice with step 1')
+
+        out = []
+        for i_chunk in range(start // chunk_frames, int(np.ceil(stop / chunk_frames))):
+            chunk = _load_chunk(self.dir_store / 'traces' / name / f'{i_chunk}.npy', self.meta['compression'])
+            offset = i_chunk * chunk_frames
+            out.append(np.asarray(chunk[rois, max(start - offset, 0) : min(stop - offset, chunk.shape[1])]))
+        if len(out) == 0:
+            n_rois = len(range(self.n_rois)[rois]) if isinstance(rois, slice) else len(rois)
+            return np.zeros((n_rois, 0), dtype=self.meta['dtype_traces'])
+        return np.concatenate(out, axis=1)
+
+
+def find_plane_dirs(save_folder):
+    """
+    Plane folders (and 'combined') in a suite2p save folder that
+     have a stat.npy.
+    """
+    return sorted([p.parent for p in Path(save_folder).glob('*/stat.npy')])
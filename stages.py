@@ -0,0 +1,314 @@
+"""
+The stages of a suite2p run, split so that they can run as separate
+ slurm jobs (see the fan out in dispatcher.py):
+    convert: tiffs -> one binary per plane (plus ops.npy per plane).
+    plane: registration, detection, extraction, classification of one plane.
+    combine: the 'combined' view over all planes.
+Mirrors what suite2p.run_s2p does in a single process.
+Given a reg_cache.registration_cache, registered planes are
+ reused across parameter sets that register the same way.
+Given a checkpoint.checkpoint_manifest, finished stages are recorded
+ and skipped when the run is started again (eg after a requeue).
+Given a profiling.stage_profiler, each stage's time, memory and I/O
+ are recorded.
+"""
+import contextlib
+from pathlib import Path
+
+import numpy as np
+import suite2p
+
+import reg_cache
+
+
+def get_save_folder(ops):
+    """
+    Folder that holds the plane folders (save_path0 / save_folder).
+    """
+    return Path(ops['save_path0']) / (ops.get('save_folder') or 'suite2p')
+
+
+def get_ops_paths(ops):
+    """
+    Paths of the ops.npy files of all planes, in plane order.
+    """
+    save_folder = get_save_folder(ops)
+    planes = sorted([p for p in save_folder.glob('plane*') if p.is_dir() and p.name[5:].isdigit()], key=lambda p: int(p.name[5:]))
+    return [p / 'ops.npy' for p in planes]
+
+
+def get_fast_plane_dir(ops, iplane):
+    """
+    Plane folder on fast_disk (where suite2p puts the binaries).
+    """
+    return Path(ops.get('fast_disk') or ops['save_path0']) / 'suite2p' / f'plane{iplane}'
+
+
+def convert(ops, db, cache=None, checkpoint=None, profiler=None):
+    """
+    Convert the raw data to one binary per plane.
+    Args:
+        ops (dict):
+            suite2p ops.
+        db (dict):
+            suite2p db. Overrides ops.
+        cache (reg_cache.registration_cache):
+            If every plane is in the cache, the registered planes
+             are restored instead of converting.
+        checkpoint (checkpoint.checkpoint_manifest):
+            If the conversion is recorded as done and the binaries
+             are still there, it is skipped.
+        profiler (profiling.stage_profiler):
+            Records the stage.
+
+    Returns:
+        list of Path:
+            Paths of the ops.npy file of each plane.
+    """
+    ops = {**suite2p.default_ops(), **ops, **db}
+    if not ops.get('fast_disk'):
+        ops['fast_disk'] = ops['save_path0']
+    ops['save_folder'] = ops.get('save_folder') or 'suite2p'
+    save_folder = get_save_folder(ops)
+    save_folder.mkdir(parents=True, exist_ok=True)
+
+    if (checkpoint is not None) and checkpoint.is_done('convert') and _is_converted(ops, checkpoint):
+        print('conversion already done, skipping')
+        return get_ops_paths(ops)
+
+    key = reg_cache.make_key(ops) if cache is not None else None
+    if (key is not None) and cache.has_all(key):
+        ## an entry can be evicted between has_all and its lock: then convert as on a miss
+        restored = True
+        for iplane in range(cache.n_planes(key)):
+            with cache.lock(key, iplane):
+                restored = cache.restore(key, iplane, ops_path=save_folder / f'plane{iplane}' / 'ops.npy', dir_fast_plane=get_fast_plane_dir(ops, iplane)) is not None
+            if not restored:
+                break
+        if restored:
+            if checkpoint is not None:
+                checkpoint.done('convert', n_planes=cache.n_planes(key), from_cache=True)
+            return get_ops_paths(ops)
+
+    if checkpoint is not None:
+        ## the binaries are written again. anything registered from them is stale
+        [checkpoint.clear(f'plane{iplane}') for iplane in range(len(get_ops_paths(ops)))]
+        checkpoint.start('convert')
+    with _profile(profiler, 'convert'):
+        if ops.get('mesoscan', False):
+            suite2p.io.mesoscan_to_binary(ops.copy())
+        else:
+            suite2p.io.tiff_to_binary(ops.copy())
+    ops_paths = get_ops_paths(ops)
+    if key is not None:
+        cache.set_n_planes(key, len(ops_paths))
+    if checkpoint is not None:
+        checkpoint.done('convert', n_planes=len(ops_paths))
+    return ops_paths
+
+
+def _is_converted(ops, checkpoint):
+    """
+    Whether every plane has its ops.npy and a binary it can be
+     registered from.
+    A registration that was interrupted has partly overwritten
+     data.bin, which can only be registered again if the raw
+     binary was kept (ops['keep_movie_raw']).
+    """
+    ops_paths = get_ops_paths(ops)
+    if len(ops_paths) == 0:
+        return False
+    for iplane, ops_path in enumerate(ops_paths):
+        if not ops_path.exists():
+            return False
+        op = np.load(ops_path, allow_pickle=True).item()
+        if _has_raw(op):
+            continue
+        if not Path(op.get('reg_file', '')).exists():
+            return False
+        if checkpoint.is_interrupted(f'plane{iplane}.registration') and ('yoff' not in op):
+            return False
+    return True
+
+
+def _has_raw(op):
+    return bool(op.get('keep_movie_raw', False)) and Path(op.get('raw_file', '')).exists()
+
+
+def register_plane(ops, db, iplane, cache=None, checkpoint=None, profiler=None):
+    """
+    Register one plane that was converted by convert, and keep
+     its binary. Skipped if the plane's ops already has the
+     registration results (refImg, yoff).
+    Args:
+        ops (dict):
+            suite2p ops.
+        db (dict):
+            suite2p db. Overrides ops.
+        iplane (int):
+            Index of the plane.
+        cache (reg_cache.registration_cache):
+            The registered plane is taken from the cache if it is
+             there, and stored in it if not.
+        checkpoint (checkpoint.checkpoint_manifest):
+            Records the registration of the plane.
+        profiler (profiling.stage_profiler):
+            Records the stage.
+    """
+    ops = {**suite2p.default_ops(), **ops, **db}
+    ops_path = get_ops_paths(ops)[iplane]
+    stage = f'plane{iplane}.registration'
+
+    key = reg_cache.make_key(ops) if cache is not None else None
+    with (cache.lock(key, iplane) if key is not None else contextlib.nullcontext()):
+        restored = False
+        if (key is not None) and cache.has(key, iplane):
+            restored = cache.restore(key, iplane, ops_path=ops_path, dir_fast_plane=get_fast_plane_dir(ops, iplane)) is not None
+        if (not restored) and ('yoff' not in np.load(ops_path, allow_pickle=True).item()):
+            op = _load_plane_ops(ops, ops_path)
+            if (checkpoint is not None) and checkpoint.is_interrupted(stage) and not _has_raw(op):
+                raise RuntimeError(f'registration of plane{iplane} was interrupted and data.bin is partly registered. Convert again, or set keep_movie_raw so that registration can restart from the raw binary.')
+            if checkpoint is not None:
+                checkpoint.start(stage)
+            op.update({'roidetect': False, 'spikedetect': False, 'delete_bin': False})
+            with _profile(profiler, stage) as extra:
+                op = suite2p.run_plane(op, ops_path=str(ops_path))
+                extra['timing'] = op.get('timing', None)
+            if key is not None:
+                cache.store(key, iplane, op)
+    if checkpoint is not None:
+        checkpoint.done(stage)
+
+
+def run_plane(ops, db, iplane, cache=None, checkpoint=None, profiler=None):
+    """
+    Run registration, detection, extraction and classification on
+     one plane that was converted by convert.
+    Each plane reads and writes only its own binary
+     (reg_file in the plane's ops.npy, under fast_disk).
+    Args:
+        ops (dict):
+            suite2p ops.
+        db (dict):
+            suite2p db. Overrides ops.
+        iplane (int):
+            Index of the plane.
+        cache (reg_cache.registration_cache):
+            If given, the registered plane is taken from the cache,
+             or registered and stored in the cache for the next
+             parameter set. suite2p skips registration when the
+             plane's ops already has refImg and yoff.
+        checkpoint (checkpoint.checkpoint_manifest):
+            If given, registration is checkpointed on its own and
+             a plane that is recorded as done is skipped.
+            Detection, extraction and classification run in one
+             suite2p.run_plane call, so they are recorded but
+             resume together.
+        profiler (profiling.stage_profiler):
+            Records the plane, with suite2p's ops['timing']
+             (registration, detection, extraction, ... times).
+
+    Returns:
+        dict:
+            ops of the plane after the run.
+    """
+    ops = {**suite2p.default_ops(), **ops, **db}
+    ops_path = get_ops_paths(ops)[iplane]
+    stage = f'plane{iplane}'
+
+    if (checkpoint is not None) and checkpoint.is_done(stage) and (ops_path.parent / 'iscell.npy').exists():
+        print(f'{stage} already done, skipping')
+        return np.load(ops_path, allow_pickle=True).item()
+
+    if (cache is not None) or (checkpoint is not None):
+        register_plane(ops=ops, db=db, iplane=iplane, cache=cache, checkpoint=checkpoint, profiler=profiler)
+
+    if checkpoint is not None:
+        checkpoint.start(stage)
+    with _profile(profiler, stage) as extra:
+        op = suite2p.run_plane(_load_plane_ops(ops, ops_path), ops_path=str(ops_path))
+        extra['timing'] = op.get('timing', None)
+    if checkpoint is not None:
+        for stage_sub, name_file in [('detection', 'stat.npy'), ('extraction', 'F.npy'), ('classification', 'iscell.npy')]:
+            if (ops_path.parent / name_file).exists():
+                checkpoint.done(f'{stage}.{stage_sub}')
+        ## the raw binary was only kept so that registration could restart
+        if op.get('delete_bin', False) and Path(op.get('raw_file', '')).exists():
+            [Path(op[key]).unlink() for key in ['raw_file', 'raw_file_chan2'] if Path(op.get(key, '')).exists()]
+        checkpoint.done(stage)
+    return op
+
+
+def _profile(profiler, stage, **info):
+    """
+    profiler.profile(stage), or a context that does nothing if
+     there is no profiler.
+    """
+    return profiler.profile(stage, **info) if profiler is not None else contextlib.nullcontext({})
+
+
+def _load_plane_ops(ops, ops_path):
+    """
+    Load a plane's ops.npy and put the user's ops over it.
+    """
+    op = np.load(ops_path, allow_pickle=True).item()
+    ## same as suite2p.run_s2p: user ops win, but keep the paths made during conversion
+    for key in suite2p.default_ops().keys():
+        if key not in ['data_path', 'save_path0', 'fast_disk', 'save_folder', 'subfolders'] and key in ops:
+            op[key] = ops[key]
+    return op
+
+
+def combine(ops, db, checkpoint=None, profiler=None):
+    """
+    Make the 'combined' folder from all planes.
+    Args:
+        ops (dict):
+            suite2p ops.
+        db (dict):
+            suite2p db. Overrides ops.
+        checkpoint (checkpoint.checkpoint_manifest):
+            Records that the combined view was made.
+        profiler (profiling.stage_profiler):
+            Records the stage.
+
+    Returns:
+        dict:
+            ops of the combined view.
+    """
+    ops = {**suite2p.default_ops(), **ops, **db}
+    with _profile(profiler, 'combine'):
+        output_ops = suite2p.io.combined(str(get_save_folder(ops)), save=True)
+    if checkpoint is not None:
+        checkpoint.done('combine')
+    return output_ops
+
+
+def run_all(ops, db, cache=None, checkpoint=None, profiler=None):
+    """
+    All stages in one process: convert, every plane, combine.
+    Used instead of suite2p.run_s2p when a cache or a checkpoint
+     is given.
+    Args:
+        ops (dict):
+            suite2p ops.
+        db (dict):
+            suite2p db. Overrides ops.
+        cache (reg_cache.registration_cache):
+            See convert and run_plane.
+        checkpoint (checkpoint.checkpoint_manifest):
+            See convert and run_plane. Resumes from the first
+             stage that is not done.
+        profiler (profiling.stage_profiler):
+            See convert and run_plane.
+
+    Returns:
+        dict:
+            ops of the combined view if there is more than one
+             plane and ops['combined'], else ops of the last plane.
+    """
+    ops_paths = convert(ops=ops, db=db, cache=cache, checkpoint=checkpoint, profiler=profiler)
+    output_ops = [run_plane(ops=ops, db=db, iplane=iplane, cache=cache, checkpoint=checkpoint, profiler=profiler) for iplane in range(len(ops_paths))][-1]
+    if len(ops_paths) > 1 and {**ops, **db}.get('combined', True):
+        output_ops = combine(ops=ops, db=db, checkpoint=checkpoint, profiler=profiler)
+    return output_ops
@@ -0,0 +1,185 @@
+"""
+Staging of a job's input files to node local scratch ($TMPDIR).
+With staging, the job is submitted while the raw data is still being
+ copied from MICROSCOPE to data1 (in the background on the transfer
+ node, see master_controller.ipynb). The job copies each file to local
+ scratch as soon as it is complete on data1, with several readers at
+ once. suite2p then reads the local copies and writes its binaries
+ (fast_disk) and outputs to local scratch. The outputs are copied back
+ to dir_save once at the end.
+What overlaps with the upstream copy is the submission, the queue wait
+ and the copy to local scratch, not the compute: stage_inputs returns
+ only when every file is staged, and suite2p starts after that (it
+ converts all tiffs in one pass, so it can't take files as they come).
+Used by remote_run_s2p.py.
+"""
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+
+def get_local_scratch():
+    """
+    Node local scratch directory of the job ($TMPDIR, else /tmp).
+    """
+    return Path(os.environ.get('TMPDIR', '/tmp'))
+
+
+def _list_files(dirs_src, patterns):
+    """
+    {path: (size, mtime)} of the files in dirs_src matching patterns.
+    """
+    out = {}
+    for dir_src in dirs_src:
+        for pattern in patterns:
+            for path in Path(dir_src).glob(pattern):
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                if path.is_file():
+                    out[path] = (st.st_size, st.st_mtime)
+    return out
+
+
+def stage_inputs(
+    dirs_src,
+    dir_dst,
+    patterns=('*.tif', '*.tiff'),
+    path_marker=None,
+    workers=8,
+    interval=10,
+    settle_s=120,
+    timeout=60*60*6,
+    verbose=True,
+):
+    """
+    Copy input files to local scratch while they are still arriving.
+    A file is copied once its size and mtime have not changed between
+     two listings and it was last modified more than interval seconds ago.
+    Staging is done when path_marker exists (written when the upstream
+     copy finishes) and every file is copied.
+     Without a marker, it is done when no file has changed for settle_s.
+    Args:
+        dirs_src (list of str):
+            Directories of the input files (db['data_path']).
+        dir_dst (str):
+            Local directory to copy the files to. Files keep their
+             path relative to their source directory.
+        patterns (tuple of str):
+            Glob patterns of the input files.
+        path_marker (str):
+            File that appears when the upstream copy is complete.
+             None: wait until nothing changed for settle_s.
+        workers (int):
+            Number of files copied at once.
+        interval (float):
+            Seconds between listings of the source directories.
+        settle_s (float):
+            See path_marker.
+        timeout (float):
+            Seconds to wait for the upstream copy before raising
+             TimeoutError.
+        verbose (bool):
+            Whether to print progress.
+
+    Returns:
+        list of Path:
+            Sorted paths of the staged files.
+    """
+    dirs_src = [Path(d) for d in ([dirs_src] if isinstance(dirs_src, (str, Path)) else dirs_src)]
+    dir_dst = Path(dir_dst)
+    dir_dst.mkdir(parents=True, exist_ok=True)
+
+    def path_dst(path_src):
+        dir_src = [d for d in dirs_src if d in path_src.parents][0]
+        ## files of a second source directory go into a subfolder so that names can't collide
+        prefix = Path(f'src{dirs_src.index(dir_src)}') if len(dirs_src) > 1 else Path('.')
+        return dir_dst / prefix / path_src.relative_to(dir_src)
+
+    def copy(path_src):
+        dst = path_dst(path_src)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(str(path_src), str(dst))
+        return path_src, dst
+
+    tic = time.time()
+    seen_prev = {}
+    submitted = {}
+    staged = []
+    t_last_change = time.time()
+    n_bytes = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        while True:
+            seen = _list_files(dirs_src, patterns)
+            if seen != seen_prev:
+                t_last_change = time.time()
+            ## a file is complete when it looks the same as one poll ago and has not been written to for a while
+            for path, size_mtime in seen.items():
+                if seen_prev.get(path, None) == size_mtime and (time.time() - size_mtime[1] > interval) and submitted.get(path, None) != size_mtime:
+                    submitted[path] = size_mtime
+                    futures.append(pool.submit(copy, path))
+            seen_prev = seen
+
+            done = [f for f in futures if f.done()]
+            for f in done:
+                path_src, dst = f.result()
+                staged.append(dst)
+                n_bytes += dst.stat().st_size
+                if verbose:
+                    print(f'staged {path_src} -> {dst}')
+            futures = [f for f in futures if not f.done()]
+
+            upstream_done = Path(path_marker).exists() if path_marker is not None else (time.time() - t_last_change > settle_s)
+            all_submitted = all([submitted.get(path, None) == size_mtime for path, size_mtime in seen.items()])
+            if upstream_done and all_submitted and len(futures) == 0 and len(seen) > 0:
+                break
+            if time.time() - tic > timeout:
+                raise TimeoutError(f'input files in {dirs_src} not complete after {timeout} s')
+            if len(futures) > 0:
+                wait(futures, timeout=interval, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(interval)
+
+    t = time.time() - tic
+    if verbose:
+        print(f'staged {len(set(staged))} files, {n_bytes/1024**3:.2f} GB in {t:.1f} s ({n_bytes/1024**2/max(t, 1e-9):.1f} MB/s)')
+    return sorted(set(staged))
+
+
+def copy_back(dir_src, dir_dst, workers=8, verbose=True):
+    """
+    Copy a local directory tree (the outputs) to dir_dst,
+     several files at once.
+    Args:
+        dir_src (str):
+            Local directory.
+        dir_dst (str):
+            Destination (eg dir_save on data1). Existing files are overwritten.
+        workers (int):
+            Number of files copied at once.
+        verbose (bool):
+            Whether to print a summary.
+
+    Returns:
+        int:
+            Number of bytes copied.
+    """
+    dir_src, dir_dst = Path(dir_src), Path(dir_dst)
+    paths = [p for p in dir_src.rglob('*') if p.is_file()]
+    tic = time.time()
+
+    def copy(path):
+        dst = dir_dst / path.relative_to(dir_src)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(str(path), str(dst))
+        return path.stat().st_size
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        n_bytes = sum(pool.map(copy, paths))
+    if verbose:
+        print(f'copied back {len(paths)} files, {n_bytes/1024**3:.2f} GB to {dir_dst} in {time.time() - tic:.1f} s')
+    return n_bytes
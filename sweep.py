@@ -0,0 +1,135 @@
+"""
+Helpers for expanding a declarative parameter sweep into a list
+ of parameter sets for dispatcher.py.
+"""
+import copy
+import itertools
+import json
+
+
+def set_nested(params, key, value):
+    """
+    Set a value in a nested dictionary.
+    Args:
+        params (dict):
+            Nested dictionary. Modified in place.
+        key (str or list of str):
+            Dot separated path ('ops.threshold_scaling')
+             or list of keys (['ops', 'threshold_scaling']).
+        value (object):
+            Value to set.
+    """
+    keys = key.split('.') if isinstance(key, str) else list(key)
+    d = params
+    for k in keys[:-1]:
+        d = d.setdefault(k, {})
+    d[keys[-1]] = value
+
+
+def get_nested(params, key, default=None):
+    """
+    Get a value from a nested dictionary.
+    Args:
+        params (dict):
+            Nested dictionary.
+        key (str or list of str):
+            Dot separated path or list of keys.
+        default (object):
+            Returned if the key does not exist.
+    """
+    keys = key.split('.') if isinstance(key, str) else list(key)
+    d = params
+    for k in keys:
+        if not isinstance(d, dict) or k not in d:
+            return default
+        d = d[k]
+    return d
+
+
+def expand_sweep(params_template, sweep=None):
+    """
+    Expand a sweep spec into a deduplicated list of parameter sets.
+    Args:
+        params_template (dict):
+            Base parameters (eg params_template in dispatcher.py).
+        sweep (dict or list of dict):
+            {key: list of values}, where key is a dot separated
+             path into params_template ('ops.threshold_scaling').
+            All combinations of the values are made (grid).
+            A list of such dicts is the union of their grids.
+            Keys that are tuples of paths are swept together,
+             with values given as tuples:
+             {('ops.diameter', 'ops.spatial_scale'): [(10, 1), (16, 2)]}
+            None or {} gives [params_template].
+
+    Returns:
+        list of dict:
+            Parameter sets, in a stable order. Parameter sets
+             that are identical after expansion are kept once.
+    """
+    if sweep is None:
+        sweep = {}
+    sweeps = [sweep] if isinstance(sweep, dict) else list(sweep)
+
+    params_all = []
+    seen = set()
+    for sweep_i in sweeps:
+        keys = list(sweep_i.keys())
+        for values in itertools.product(*[sweep_i[k] for k in keys]):
+            params = copy.deepcopy(params_template)
+            for key, value in zip(keys, values):
+                if isinstance(key, tuple):
+                    [set_nested(params, k, v) for k, v in zip(key, value)]
+                else:
+                    set_nested(params, key, value)
+            fingerprint = json.dumps(params, sort_keys=True)
+            if fingerprint not in seen:
+                seen.add(fingerprint)
+                params_all.append(params)
+    return params_all
+
+
+def find_changing_params(params_list, sweep=None):
+    """
+    Find which swept keys actually take different values across
+     a list of parameter sets.
+    Args:
+        params_list (list of dict):
+            Output of expand_sweep.
+        sweep (dict or list of dict):
+            The sweep spec that was expanded.
+
+    Returns:
+        list of dict:
+            For each parameter set, {key: value} for every swept
+             key whose value is not the same in all sets.
+    """
+    sweeps = [] if sweep is None else ([sweep] if isinstance(sweep, dict) else list(sweep))
+    keys = []
+    for sweep_i in sweeps:
+        for key in sweep_i.keys():
+            for k in (key if isinstance(key, tuple) else [key]):
+                if k not in keys:
+                    keys.append(k)
+    keys = [k for k in keys if len(set(json.dumps(get_nested(p, k)) for p in params_list)) > 1]
+    return [{k: get_nested(p, k) for k in keys} for p in params_list]
+
+
+def select_task_params(params_loaded, task_id=None):
+    """
+    Pick the parameters of one task out of a parameter file.
+    A job array shares one file {'params': [params_0, params_1, ...]};
+     a single job has its parameters directly.
+    Args:
+        params_loaded (dict):
+            Contents of the parameter json file.
+        task_id (int or str):
+            Index into params_loaded['params'] (eg SLURM_ARRAY_TASK_ID).
+
+    Returns:
+        dict:
+            Parameters of the task.
+    """
+    if isinstance(params_loaded.get('params', None), list):
+        return params_loaded['params'][int(task_id)]
+    return params_loaded
@@ -0,0 +1,370 @@
+"""
+Summary table of a parameter sweep, computed on the server.
+Comparing the runs of a sweep (dispatcher.py) used to mean downloading
+ every job folder and loading stat.npy / iscell.npy of each one.
+This script reads the job folders under dir_save where they are, several
+ at once, and writes one row per job to a small table
+ (dir_save/sweep_summary.csv, or .parquet) that is the only thing
+ downloaded:
+    - ROI count, cell count and cell fraction
+    - ROI size distribution (pixels per ROI)
+    - rigid / nonrigid registration offsets and corrXY
+    - runtime (from log.txt) and wall time / peak RSS (from profile.jsonl)
+    - the swept params that differ between jobs (parameters_batch.json)
+Rows are cached in dir_save/.sweep_summary_cache.json, keyed by job
+ folder, with the size and mtime of the files they were computed from.
+ A rerun only reads the jobs that are new or changed (eg still running,
+ or iscell.npy edited in the GUI).
+The last line printed is 'SWEEP_SUMMARY {json}'.
+Run from the controller with util.summarize_sweep, or directly:
+    python sweep_summary.py dir_save --prefix jobNum_ --workers 8
+Needs numpy (stat.npy, ops.npy are pickled). Parquet also needs pandas
+ and pyarrow.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+
+marker_summary = 'SWEEP_SUMMARY '
+name_cache = '.sweep_summary_cache.json'
+
+## bump when the metrics change, so that cached rows are recomputed
+version = 1
+
+## leading columns of the table. params come after, as 'param.{key}'
+columns_first = [
+    'job', 'jobNum', 'status', 'n_planes', 'n_rois', 'n_cells', 'cell_fraction',
+    'npix_mean', 'npix_p10', 'npix_median', 'npix_p90', 'npix_median_cells',
+    'n_frames', 'reg_offset_rms_px', 'reg_offset_max_px', 'reg_nr_offset_max_px', 'reg_corrXY_mean',
+    'runtime_s', 'n_runs', 'wall_s_profile', 'peak_rss_GB', 'n_stages_failed', 'error',
+]
+
+
+def find_job_dirs(dir_save, prefix='jobNum_'):
+    """
+    Job folders of a sweep: {prefix}{jobNum}, sorted by jobNum.
+    """
+    pattern = re.compile(re.escape(prefix) + r'(\d+)$')
+    dirs = [p for p in Path(dir_save).iterdir() if p.is_dir() and pattern.match(p.name)]
+    return sorted(dirs, key=lambda p: int(pattern.match(p.name).group(1)))
+
+
+def find_plane_dirs(dir_job):
+    """
+    suite2p plane folders of a job (not 'combined'), in plane order.
+    """
+    dirs = [p.parent for p in Path(dir_job).glob('*/plane*/ops.npy') if p.parent.name[5:].isdigit()]
+    return sorted(dirs, key=lambda p: (str(p.parent), int(p.name[5:])))
+
+
+def fingerprint_job(dir_job):
+    """
+    {relative path: [size, int mtime]} of the files a job's row is
+     computed from. The row is recomputed when this changes.
+    """
+    dir_job = Path(dir_job)
+    paths = [dir_job / 'log.txt', dir_job / 'profile.jsonl']
+    for dir_plane in find_plane_dirs(dir_job):
+        paths += [dir_plane / name for name in ['ops.npy', 'stat.npy', 'iscell.npy']]
+        paths += [dir_plane / 'roi_store' / 'pix_offsets.npy']
+    out = {}
+    for path in paths:
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        out[str(path.relative_to(dir_job))] = [st.st_size, int(st.st_mtime)]
+    return out
+
+
+def _roi_npix(dir_plane):
+    """
+    Pixels per ROI of a plane. From the ROI store if there is one
+     (no unpickling), else from stat.npy.
+    """
+    path_offsets = Path(dir_plane) / 'roi_store' / 'pix_offsets.npy'
+    if path_offsets.exists():
+        return np.diff(np.load(str(path_offsets)))
+    stats = np.load(str(Path(dir_plane) / 'stat.npy'), allow_pickle=True)
+    return np.array([stat['npix'] if 'npix' in stat else len(stat['ypix']) for stat in stats], dtype=np.int64)
+
+
+def parse_log_times(path_log):
+    """
+    Runtime of a job from the 'BATCH RUN STARTED / FINISHED' lines that
+     remote_run_s2p.py writes to log.txt.
+    A job with several stages (or reruns) writes several pairs. The
+     runtime is from the first start to the last finish.
+
+    Returns:
+        runtime_s (float or None):
+            None if the job has not finished.
+        n_runs (int):
+            Number of 'STARTED' lines.
+    """
+    times = {'STARTED': [], 'FINISHED': []}
+    if not Path(path_log).exists():
+        return None, 0
+    with open(path_log, 'r', errors='replace') as f:
+        for line in f:
+            match = re.search(r'BATCH RUN (STARTED|FINISHED)\..*time: (.+)$', line.strip())
+            if match is None:
+                continue
+            try:
+                times[match.group(1)].append(datetime.strptime(match.group(2).strip(), '%a %b %d %H:%M:%S %Y'))
+            except ValueError:
+                continue
+    n_runs = len(times['STARTED'])
+    if n_runs == 0 or len(times['FINISHED']) == 0 or max(times['FINISHED']) < max(times['STARTED']):
+        return None, n_runs
+    return (max(times['FINISHED']) - min(times['STARTED'])).total_seconds(), n_runs
+
+
+def _read_profile(path_jsonl):
+    records = []
+    if not Path(path_jsonl).exists():
+        return records
+    with open(path_jsonl, 'r', errors='replace') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def summarize_job(dir_job):
+    """
+    Metrics of one job folder.
+    Args:
+        dir_job (str):
+            Job folder ({dir_save}/{prefix}{jobNum}).
+
+    Returns:
+        dict:
+            One row of the table (see columns_first). Values are
+             None where they can't be computed; 'error' holds the
+             reason if reading an output failed.
+    """
+    dir_job = Path(dir_job)
+    row = {'job': dir_job.name}
+    row['runtime_s'], row['n_runs'] = parse_log_times(dir_job / 'log.txt')
+
+    ## stages don't nest, so their wall times add up. reruns (eg requeued jobs) are included
+    records = _read_profile(dir_job / 'profile.jsonl')
+    row['wall_s_profile'] = round(sum([r.get('wall_s') or 0 for r in records]), 1) if records else None
+    rss = [r['peak_rss_GB'] for r in records if r.get('peak_rss_GB') is not None]
+    row['peak_rss_GB'] = max(rss) if rss else None
+    row['n_stages_failed'] = len([r for r in records if r.get('status') == 'failed'])
+
+    dirs_plane = find_plane_dirs(dir_job)
+    row['n_planes'] = len(dirs_plane)
+    npix_all, iscell_all, offsets, offsets_nr, corrXY, n_frames = [], [], [], [], [], []
+    try:
+        for dir_plane in dirs_plane:
+            ops = np.load(str(dir_plane / 'ops.npy'), allow_pickle=True).item()
+            if 'xoff' in ops and 'yoff' in ops:
+                offsets.append(np.stack([np.asarray(ops['yoff'], dtype=np.float64), np.asarray(ops['xoff'], dtype=np.float64)], axis=1))
+                n_frames.append(len(ops['xoff']))
+            if 'xoff1' in ops and 'yoff1' in ops:
+                offsets_nr.append(np.hypot(np.asarray(ops['yoff1'], dtype=np.float64), np.asarray(ops['xoff1'], dtype=np.float64)).max())
+            if 'corrXY' in ops:
+                corrXY.append(np.asarray(ops['corrXY'], dtype=np.float64))
+            if not (dir_plane / 'stat.npy').exists():
+                continue
+            npix = _roi_npix(dir_plane)
+            iscell = np.load(str(dir_plane / 'iscell.npy'), allow_pickle=True)[:, 0].astype(bool)
+            npix_all.append(npix)
+            iscell_all.append(iscell[:len(npix)])
+        row['error'] = None
+    except Exception as e:
+        row['error'] = f'{type(e).__name__}: {e}'
+
+    if len(npix_all) > 0:
+        npix, iscell = np.concatenate(npix_all), np.concatenate(iscell_all)
+        row['n_rois'] = int(len(npix))
+        row['n_cells'] = int(iscell.sum())
+        row['cell_fraction'] = round(float(iscell.mean()), 4) if len(npix) > 0 else None
+        if len(npix) > 0:
+            row['npix_mean'] = round(float(npix.mean()), 2)
+            row['npix_p10'], row['npix_median'], row['npix_p90'] = [round(float(v), 2) for v in np.percentile(npix, [10, 50, 90])]
+        row['npix_median_cells'] = float(np.median(npix[iscell])) if iscell.any() else None
+    if len(offsets) > 0:
+        offsets = np.concatenate(offsets, axis=0)
+        dist = np.hypot(offsets[:, 0], offsets[:, 1])
+        row['n_frames'] = int(max(n_frames))
+        row['reg_offset_rms_px'] = round(float(np.sqrt(np.mean(dist**2))), 3)
+        row['reg_offset_max_px'] = round(float(dist.max()), 3)
+    if len(offsets_nr) > 0:
+        row['reg_nr_offset_max_px'] = round(float(max(offsets_nr)), 3)
+    if len(corrXY) > 0:
+        row['reg_corrXY_mean'] = round(float(np.concatenate(corrXY).mean()), 4)
+
+    if row['n_planes'] > 0 and len(npix_all) == row['n_planes'] and row['runtime_s'] is not None and row['error'] is None:
+        row['status'] = 'complete'
+    elif row['n_runs'] > 0:
+        row['status'] = 'incomplete'
+    else:
+        row['status'] = 'not_started'
+    return row
+
+
+def _load_changing_params(dir_save):
+    """
+    [{key: value}] of the swept params that differ between jobs,
+     indexed by jobNum. [] if there is no parameters_batch.json.
+    """
+    path = Path(dir_save) / 'parameters_batch.json'
+    if not path.exists():
+        return []
+    with open(path, 'r') as f:
+        return json.load(f).get('params_changing', [])
+
+
+def _to_cell(val):
+    if val is None:
+        return ''
+    if isinstance(val, (dict, list, tuple)):
+        return json.dumps(val)
+    return val
+
+
+def write_table(rows, path_out):
+    """
+    Write rows (list of dict) to a .csv or .parquet file, atomically.
+    Columns: columns_first, then the other keys in order of appearance.
+    """
+    import csv
+
+    columns = [c for c in columns_first if any(c in r for r in rows)]
+    for r in rows:
+        columns += [k for k in r.keys() if k not in columns]
+
+    path_out = Path(path_out)
+    path_tmp = path_out.with_name(path_out.name + '.tmp')
+    if path_out.suffix == '.parquet':
+        import pandas as pd
+        ## nested param values don't fit parquet's column types
+        df = pd.DataFrame([{c: (json.dumps(r.get(c)) if isinstance(r.get(c), (dict, list, tuple)) else r.get(c, None)) for c in columns} for r in rows], columns=columns)
+        df.to_parquet(str(path_tmp), index=False)
+    elif path_out.suffix == '.csv':
+        with open(path_tmp, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for r in rows:
+                writer.writerow([_to_cell(r.get(c, None)) for c in columns])
+    else:
+        raise ValueError(f'unknown table format: {path_out.suffix}. Use .csv or .parquet')
+    os.replace(path_tmp, path_out)
+    return path_out
+
+
+def summarize_sweep(dir_save, prefix='jobNum_', path_out=None, workers=8, force=False, verbose=False):
+    """
+    Summarize all job folders of a sweep into one table.
+    Args:
+        dir_save (str):
+            Folder of the sweep (dir_save of dispatcher.py).
+        prefix (str):
+            Job folder prefix (name_job of dispatcher.py).
+        path_out (str):
+            Table to write (.csv or .parquet).
+             None: dir_save/sweep_summary.csv.
+        workers (int):
+            Number of job folders read at once (processes: unpickling
+             stat.npy / ops.npy is CPU bound).
+        force (bool):
+            Recompute every job, ignoring the cache.
+        verbose (bool):
+            Whether to print each job as it is summarized.
+
+    Returns:
+        dict:
+            Summary: 'path_table', 'n_jobs', 'n_computed', 'n_cached',
+             'n_complete', 'time' and 'errors' ([job, error]).
+    """
+    tic = time.time()
+    dir_save = Path(dir_save).resolve()
+    path_out = Path(path_out) if path_out is not None else dir_save / 'sweep_summary.csv'
+    path_cache = dir_save / name_cache
+
+    cache = {}
+    if path_cache.exists() and not force:
+        try:
+            with open(path_cache, 'r') as f:
+                cache = json.load(f)
+        except json.JSONDecodeError:
+            cache = {}
+    if cache.get('version', None) != version:
+        cache = {'version': version, 'jobs': {}}
+
+    dirs_job = find_job_dirs(dir_save, prefix=prefix)
+    fingerprints = {d.name: fingerprint_job(d) for d in dirs_job}
+    to_compute = [d for d in dirs_job if cache['jobs'].get(d.name, {}).get('fingerprint', None) != fingerprints[d.name]]
+
+    if len(to_compute) > 0:
+        ## fork: when sent with 'python -c' (util.summarize_sweep) there is no module file for the workers to import
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, len(to_compute))), mp_context=multiprocessing.get_context('fork')) as pool:
+            for dir_job, row in zip(to_compute, pool.map(summarize_job, [str(d) for d in to_compute])):
+                cache['jobs'][dir_job.name] = {'fingerprint': fingerprints[dir_job.name], 'row': row}
+                if verbose:
+                    print(f"summarized {dir_job.name}: {row['status']}, {row.get('n_rois')} ROIs", flush=True)
+    ## jobs whose folders are gone are dropped
+    cache['jobs'] = {d.name: cache['jobs'][d.name] for d in dirs_job}
+
+    params_changing = _load_changing_params(dir_save)
+    rows = []
+    for dir_job in dirs_job:
+        row = dict(cache['jobs'][dir_job.name]['row'])
+        row['jobNum'] = int(dir_job.name[len(prefix):])
+        if row['jobNum'] < len(params_changing):
+            row.update({f'param.{k}': v for k, v in params_changing[row['jobNum']].items()})
+        rows.append(row)
+
+    write_table(rows, path_out)
+    path_tmp = path_cache.with_name(path_cache.name + '.tmp')
+    with open(path_tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(path_tmp, path_cache)
+
+    return {
+        'path_table': str(path_out),
+        'n_jobs': len(dirs_job),
+        'n_computed': len(to_compute),
+        'n_cached': len(dirs_job) - len(to_compute),
+        'n_complete': len([r for r in rows if r['status'] == 'complete']),
+        'time': round(time.time() - tic, 3),
+        'errors': [[r['job'], r['error']] for r in rows if r.get('error')],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summary table of the job folders of a parameter sweep.')
+    parser.add_argument('dir_save')
+    parser.add_argument('--prefix', default='jobNum_')
+    parser.add_argument('--path-out', default=None, help='.csv or .parquet. default: dir_save/sweep_summary.csv')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--force', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    summary = summarize_sweep(
+        dir_save=args.dir_save,
+        prefix=args.prefix,
+        path_out=args.path_out,
+        workers=args.workers,
+        force=args.force,
+        verbose=args.verbose,
+    )
+    print(marker_summary + json.dumps(summary), flush=True)
+    sys.exit(0)
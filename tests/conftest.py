@@ -0,0 +1,184 @@
+import os
+import socket
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import paramiko
+import pytest
+
+## the modules are flat files at the root of the repo (see dispatcher.py)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+class _stub_handle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class _stub_sftp(paramiko.SFTPServerInterface):
+    """
+    SFTP server on the local filesystem. Paths are used as they are.
+    """
+    def _call(self, fn, *args):
+        try:
+            fn(*args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def list_folder(self, path):
+        try:
+            out = []
+            for name in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o666)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _stub_handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, oldpath, newpath)
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, path)
+
+    def chattr(self, path, attr):
+        if attr._flags & attr.FLAG_AMTIME:
+            return self._call(os.utime, path, (attr.st_atime, attr.st_mtime))
+        return paramiko.SFTP_OK
+
+    def canonicalize(self, path):
+        return os.path.normpath(path)
+
+
+class _stub_server(paramiko.ServerInterface):
+    """
+    Accepts any password. Exec requests run in local bash.
+     A shell request runs a bash that reads commands from the channel.
+    """
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        return self._start(channel, ['bash'])
+
+    def check_channel_exec_request(self, channel, command):
+        return self._start(channel, ['bash', '-c', command.decode()])
+
+    def _start(self, channel, args):
+        def _run():
+            p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+            def _stdin():
+                try:
+                    for data in iter(lambda: channel.recv(2**16), b''):
+                        p.stdin.write(data)
+                        p.stdin.flush()
+                    p.stdin.close()
+                except BrokenPipeError:
+                    ## the command exited without reading all of its input
+                    pass
+
+            def _stderr():
+                for data in iter(lambda: p.stderr.read1(2**16), b''):
+                    channel.sendall_stderr(data)
+
+            threading.Thread(target=_stdin, daemon=True).start()
+            thread_err = threading.Thread(target=_stderr, daemon=True)
+            thread_err.start()
+            try:
+                for data in iter(lambda: p.stdout.read1(2**16), b''):
+                    channel.sendall(data)
+                thread_err.join()
+                channel.send_exit_status(p.wait())
+                channel.shutdown_write()
+                channel.close()
+            except (OSError, EOFError):
+                ## the client closed the channel (eg on a timeout)
+                p.kill()
+        threading.Thread(target=_run, daemon=True).start()
+        return True
+
+
+@pytest.fixture(scope='session')
+def ssh_port():
+    """
+    Port of an SSH / SFTP server on 127.0.0.1 that serves the local
+     filesystem and runs exec commands in local bash.
+    """
+    key = paramiko.RSAKey.generate(2048)
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(50)
+
+    def _serve():
+        while True:
+            conn, _ = sock.accept()
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _stub_sftp)
+            transport.start_server(server=_stub_server())
+
+    threading.Thread(target=_serve, daemon=True).start()
+    yield sock.getsockname()[1]
+    sock.close()
+
+
+@pytest.fixture()
+def pool(ssh_port):
+    import util
+    pool = util.connection_pool(username='user', password='password', verbose=False)
+    pool._transports[('127.0.0.1', 22)] = pool._connect('127.0.0.1', ssh_port)
+    yield pool
+    pool.close()
@@ -0,0 +1,42 @@
+import multiprocessing
+
+from checkpoint import checkpoint_manifest
+
+
+def test_stages_and_clear(tmp_path):
+    checkpoint = checkpoint_manifest(tmp_path / 'checkpoint.json', verbose=False)
+    assert checkpoint.read() == {}
+    assert checkpoint.status('convert') is None
+
+    checkpoint.start('convert')
+    assert checkpoint.is_interrupted('convert') and not checkpoint.is_done('convert')
+    checkpoint.done('convert', n_frames=10)
+    assert checkpoint.is_done('convert')
+    assert checkpoint.read()['convert']['n_frames'] == 10
+
+    for stage in ['plane0.registration', 'plane0', 'plane01.registration']:
+        checkpoint.done(stage)
+    checkpoint.clear('plane0')
+    assert sorted(checkpoint.read().keys()) == ['convert', 'plane01.registration']
+
+    ## a new manifest object on the same file (eg a requeued job) sees the same stages
+    assert checkpoint_manifest(tmp_path / 'checkpoint.json', verbose=False).is_done('convert')
+
+
+def _mark_plane_done(path, iplane):
+    checkpoint = checkpoint_manifest(path, verbose=False)
+    for step in ['registration', 'detection', 'extraction', 'classification']:
+        checkpoint.done(f'plane{iplane}.{step}')
+    checkpoint.done(f'plane{iplane}')
+
+
+def test_concurrent_plane_jobs_keep_every_update(tmp_path):
+    path = tmp_path / 'checkpoint.json'
+    processes = [multiprocessing.Process(target=_mark_plane_done, args=(path, iplane)) for iplane in range(6)]
+    [p.start() for p in processes]
+    [p.join() for p in processes]
+
+    assert all([p.exitcode == 0 for p in processes])
+    manifest = checkpoint_manifest(path, verbose=False).read()
+    assert len(manifest) == 6 * 5
+    assert all([manifest[f'plane{iplane}']['status'] == 'done' for iplane in range(6)])
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+import reg_cache
+import util
+
+
+def _make_tree(dir_root):
+    files = {'a.tif': os.urandom(300_000), 'sub/b.tif': os.urandom(20_000), 'sub/empty.txt': b''}
+    for path_rel, data in files.items():
+        (dir_root / path_rel).parent.mkdir(parents=True, exist_ok=True)
+        (dir_root / path_rel).write_bytes(data)
+    return files
+
+
+@pytest.mark.parametrize('hash_type', ['blake2b', 'sha3_256'])
+def test_put_and_get_record_verified_hashes(pool, tmp_path, hash_type):
+    files = _make_tree(tmp_path / 'src')
+    (tmp_path / 'remote').mkdir()
+    sftp = pool.sftp('127.0.0.1')
+
+    summary = sftp.put_dir(tmp_path / 'src', str(tmp_path / 'remote'), verbose=False, workers=2, hash_type=hash_type, path_manifest=str(tmp_path / 'manifest_put.json'))
+    summary_get = sftp.get_dir(str(tmp_path / 'remote'), tmp_path / 'back', verbose=False, workers=2, hash_type=hash_type, path_manifest=str(tmp_path / 'manifest_get.json'))
+
+    ## both summaries are keyed by remote path, both manifests by path relative to the tree
+    for name_manifest, summary_i in [('manifest_put.json', summary), ('manifest_get.json', summary_get)]:
+        with open(tmp_path / name_manifest) as f:
+            manifest = json.load(f)
+        assert set(manifest) == set(files)
+        for path_rel, data in files.items():
+            digest = hashlib.new(hash_type, data).hexdigest()
+            assert manifest[path_rel]['hash'] == digest
+            assert manifest[path_rel]['hash_type'] == hash_type
+            assert manifest[path_rel]['size'] == len(data)
+            assert summary_i['hashes'][f"{tmp_path / 'remote'}/{path_rel}"] == digest
+    for path_rel, data in files.items():
+        assert (tmp_path / 'back' / path_rel).read_bytes() == data
+    assert not [p for p in (tmp_path / 'remote').rglob('*' + util.suffix_partial)]
+
+
+def _corrupt_b(monkeypatch):
+    """
+    The server sees different bytes for b.tif.
+    """
+    hash_remote = util._hash_remote
+    monkeypatch.setattr(util, '_hash_remote', lambda transport, paths, hash_type: {
+        p: ('0' * 128 if 'b.tif' in p else d) for p, d in hash_remote(transport, paths, hash_type).items()
+    })
+
+
+def test_bad_upload_is_not_finalized(pool, tmp_path, monkeypatch):
+    _make_tree(tmp_path / 'src')
+    (tmp_path / 'remote').mkdir()
+    sftp = pool.sftp('127.0.0.1')
+    _corrupt_b(monkeypatch)
+
+    with pytest.raises(IOError, match='1 of 3 files failed.*mismatch'):
+        sftp.put_dir(tmp_path / 'src', str(tmp_path / 'remote'), verbose=False, hash_type='blake2b')
+    assert (tmp_path / 'remote' / 'a.tif').exists()
+    assert not (tmp_path / 'remote' / 'sub' / 'b.tif').exists()
+    assert not (tmp_path / 'remote' / 'sub' / ('b.tif' + util.suffix_partial)).exists()
+
+
+def test_bad_download_is_raised(pool, tmp_path, monkeypatch):
+    _make_tree(tmp_path / 'remote')
+    sftp = pool.sftp('127.0.0.1')
+    _corrupt_b(monkeypatch)
+
+    with pytest.raises(IOError, match='1 of 3 files failed.*mismatch'):
+        sftp.get_dir(str(tmp_path / 'remote'), tmp_path / 'back', verbose=False, workers=2, hash_type='blake2b', path_manifest=str(tmp_path / 'manifest.json'))
+    ## nothing is recorded as verified
+    assert not (tmp_path / 'manifest.json').exists()
+
+
+def test_registration_cache_trusts_the_manifest(pool, tmp_path, monkeypatch):
+    _make_tree(tmp_path / 'src')
+    (tmp_path / 'data').mkdir()
+    sftp = pool.sftp('127.0.0.1')
+    sftp.put_dir(tmp_path / 'src', str(tmp_path / 'data'), verbose=False, hash_type='blake2b', path_manifest=str(tmp_path / 'data' / reg_cache.name_manifest))
+    hashes = reg_cache.load_transfer_hashes([str(tmp_path / 'data')])
+
+    def _no_read(path):
+        raise AssertionError(f'{path} was read')
+    monkeypatch.setattr(reg_cache, '_hash_file_sample', _no_read)
+    path = tmp_path / 'data' / 'a.tif'
+    assert reg_cache._hash_input_file(path, hashes) == f"blake2b:{hashlib.blake2b(path.read_bytes()).hexdigest()}"
+
+    ## a file changed since the transfer is hashed again
+    path.write_bytes(b'changed')
+    with pytest.raises(AssertionError, match='was read'):
+        reg_cache._hash_input_file(path, hashes)
@@ -0,0 +1,48 @@
+import pytest
+
+import util
+
+
+@pytest.fixture()
+def pool_local(ssh_port):
+    pool = util.connection_pool(username='user', password='password', verbose=False)
+    yield pool
+    pool.close()
+
+
+def test_ssh_and_sftp_share_one_transport(pool_local, ssh_port, tmp_path):
+    sftp = pool_local.sftp('127.0.0.1', port=ssh_port)
+    ssh = pool_local.ssh('127.0.0.1', port=ssh_port, open_shell=False, verbose=False)
+    result = pool_local.run('127.0.0.1', 'echo hello', port=ssh_port)
+
+    assert pool_local.n_connects == 1
+    assert ssh.transport is pool_local.get_transport('127.0.0.1', ssh_port)
+    assert sftp.sftp.get_channel().get_transport() is ssh.transport
+    assert result.stdout == 'hello\n'
+
+    (tmp_path / 'a.txt').write_text('a')
+    assert sftp.isdir_remote(str(tmp_path))
+
+
+def test_dropped_transport_reconnects(pool_local, ssh_port):
+    transport = pool_local.get_transport('127.0.0.1', ssh_port)
+    transport.close()
+
+    transport_new = pool_local.get_transport('127.0.0.1', ssh_port)
+    assert transport_new is not transport
+    assert transport_new.is_active() and transport_new.is_authenticated()
+    assert pool_local.n_connects == 2
+    assert pool_local.run('127.0.0.1', 'echo hello', port=ssh_port).stdout == 'hello\n'
+
+
+def test_close_drops_only_the_given_host(pool_local, ssh_port):
+    transport = pool_local.get_transport('127.0.0.1', ssh_port)
+    pool_local._transports[('other', 22)] = pool_local._connect('127.0.0.1', ssh_port)
+
+    pool_local.close('other')
+    assert list(pool_local._transports.keys()) == [('127.0.0.1', ssh_port)]
+    assert transport.is_active()
+
+    pool_local.close()
+    assert pool_local._transports == {}
+    assert not transport.is_active()
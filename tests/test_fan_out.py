@@ -0,0 +1,73 @@
+import backends
+
+
+## stands in for remote_run_s2p.py: path_params, dir_save, stage
+SCRIPT = '''
+echo "$3 ${SLURM_ARRAY_TASK_ID:-none}"
+sleep 0.2
+[ "$3:${SLURM_ARRAY_TASK_ID:-}" != "$(cat "$1")" ]
+'''
+
+
+def _submit_fan_out(backend, dir_job, nplanes):
+    """
+    Submits convert -> plane array -> combine the way dispatcher.py does.
+    """
+    path_script = dir_job / 'remote_run_s2p.sh'
+    path_script.write_text(SCRIPT)
+    path_params_job = dir_job / 'params.json'
+    resources = {'cpus': 1, 'mem_GB': 1}
+    id_convert = backend.submit(
+        args_script=[path_script, path_params_job, dir_job, 'convert'],
+        path_log=dir_job / 'print_log_convert_%j.log',
+        resources=resources,
+    )
+    id_planes = backend.submit(
+        args_script=[path_script, path_params_job, dir_job, 'plane'],
+        path_log=dir_job / 'print_log_plane%a_%A.log',
+        resources=resources,
+        array=f'0-{nplanes-1}',
+        after_ok=[id_convert],
+    )
+    id_combine = backend.submit(
+        args_script=[path_script, path_params_job, dir_job, 'combine'],
+        path_log=dir_job / 'print_log_combine_%j.log',
+        resources=resources,
+        after_ok=[id_planes],
+    )
+    return id_convert, id_planes, id_combine
+
+
+def test_planes_run_together_between_convert_and_combine(tmp_path):
+    (tmp_path / 'params.json').write_text('')
+    backend = backends.local_backend(max_cpus=8, max_mem_GB=100, cmd_python='/bin/sh', interval=0.02, verbose=False)
+    id_convert, id_planes, id_combine = _submit_fan_out(backend, tmp_path, nplanes=3)
+    states = backend.wait(timeout=30)
+    backend.close()
+
+    assert set(states.values()) == {'COMPLETED'}
+    tasks = {t.id: t for t in backend._tasks}
+    planes = [tasks[f'{id_planes}_{i}'] for i in range(3)]
+    assert all([p.time_start >= tasks[id_convert].time_end for p in planes])
+    assert tasks[id_combine].time_start >= max([p.time_end for p in planes])
+    ## the planes overlap instead of running one after another
+    assert max([p.time_start for p in planes]) < min([p.time_end for p in planes])
+    for i in range(3):
+        assert (tmp_path / f'print_log_plane{i}_{id_planes}.log').read_text().strip() == f'plane {i}'
+    assert (tmp_path / f'print_log_combine_{id_combine}.log').read_text().strip() == 'combine none'
+
+
+def test_failed_plane_cancels_combine(tmp_path):
+    (tmp_path / 'params.json').write_text('plane:1')
+    backend = backends.local_backend(max_cpus=8, max_mem_GB=100, cmd_python='/bin/sh', interval=0.02, verbose=False)
+    id_convert, id_planes, id_combine = _submit_fan_out(backend, tmp_path, nplanes=3)
+    states = backend.wait(timeout=30)
+    backend.close()
+
+    assert states == {
+        id_convert: 'COMPLETED',
+        f'{id_planes}_0': 'COMPLETED',
+        f'{id_planes}_1': 'FAILED',
+        f'{id_planes}_2': 'COMPLETED',
+        id_combine: 'CANCELLED',
+    }
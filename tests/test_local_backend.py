@@ -0,0 +1,71 @@
+import backends
+
+
+def _backend(**kwargs):
+    ## jobs are shell commands: args_script = ['-c', cmd]
+    return backends.local_backend(**{'cmd_python': '/bin/sh', 'interval': 0.02, 'verbose': False, **kwargs})
+
+
+def _max_overlap(tasks):
+    events = sorted([(t.time_start, 1) for t in tasks] + [(t.time_end, -1) for t in tasks])
+    n, n_max = 0, 0
+    for _, step in events:
+        n += step
+        n_max = max(n_max, n)
+    return n_max
+
+
+def test_admission_control(tmp_path):
+    backend = _backend(max_cpus=2, max_mem_GB=100)
+    for i in range(4):
+        backend.submit(['-c', 'sleep 0.3'], path_log=str(tmp_path / f'log_{i}_%j.txt'), resources={'cpus': 1, 'mem_GB': 1})
+    ## needs all memory: runs alone
+    backend.submit(['-c', 'sleep 0.3'], path_log=str(tmp_path / 'log_big_%j.txt'), resources={'cpus': 1, 'mem_GB': 100})
+    states = backend.wait(timeout=30)
+    backend.close()
+
+    assert set(states.values()) == {'COMPLETED'}
+    tasks = backend._tasks
+    assert _max_overlap(tasks[:4]) == 2
+    big = tasks[4]
+    assert all([(t.time_end <= big.time_start) or (t.time_start >= big.time_end) for t in tasks[:4]])
+
+
+def test_array_throttle(tmp_path):
+    backend = _backend(max_cpus=8, max_mem_GB=100)
+    job_id = backend.submit(['-c', 'echo task {task_id} $SLURM_ARRAY_TASK_ID; sleep 0.2'], path_log=str(tmp_path / 'log_%A_%a.txt'), resources={'cpus': 1, 'mem_GB': 1}, array='0-3%2')
+    states = backend.wait(timeout=30)
+    backend.close()
+
+    assert states == {f'{job_id}_{i}': 'COMPLETED' for i in range(4)}
+    assert _max_overlap(backend._tasks) == 2
+    assert (tmp_path / f'log_{job_id}_3.txt').read_text().strip() == 'task 3 3'
+
+
+def test_after_ok_order_and_cancel(tmp_path):
+    backend = _backend(max_cpus=8, max_mem_GB=100)
+    resources = {'cpus': 1, 'mem_GB': 1}
+    id_first = backend.submit(['-c', 'sleep 0.3'], path_log=str(tmp_path / 'first.txt'), resources=resources)
+    id_second = backend.submit(['-c', 'true'], path_log=str(tmp_path / 'second.txt'), resources=resources, after_ok=[id_first])
+    id_fail = backend.submit(['-c', 'false'], path_log=str(tmp_path / 'fail.txt'), resources=resources)
+    id_after_fail = backend.submit(['-c', 'true'], path_log=str(tmp_path / 'after_fail.txt'), resources=resources, after_ok=[id_fail])
+    states = backend.wait(timeout=30)
+    backend.close()
+
+    assert states == {id_first: 'COMPLETED', id_second: 'COMPLETED', id_fail: 'FAILED', id_after_fail: 'CANCELLED'}
+    tasks = {t.id: t for t in backend._tasks}
+    assert tasks[id_second].time_start >= tasks[id_first].time_end
+
+
+def test_failed_start_cancels_dependents(tmp_path):
+    backend = _backend(max_cpus=8, max_mem_GB=100, cmd_python=str(tmp_path / 'missing_python'))
+    resources = {'cpus': 1, 'mem_GB': 1}
+    id_first = backend.submit(['-c', 'true'], path_log=str(tmp_path / 'first.txt'), resources=resources)
+    id_second = backend.submit(['-c', 'true'], path_log=str(tmp_path / 'second.txt'), resources=resources, after_ok=[id_first])
+    states = backend.wait(timeout=10)
+    ## the scheduler is still alive
+    assert backend._thread.is_alive()
+    backend.close()
+
+    assert states == {id_first: 'FAILED', id_second: 'CANCELLED'}
+    assert 'FAILED to start' in (tmp_path / 'first.txt').read_text()
@@ -0,0 +1,43 @@
+import util
+
+
+def test_missing_literal_path_is_polled_again(pool, tmp_path):
+    path_log = tmp_path / 'print_log_123.log'
+    follower = util.log_follower(str(path_log), sftp=pool.sftp('127.0.0.1'), from_start=False)
+    ## the job is still pending: no log yet
+    assert follower.poll() == []
+    assert follower.poll() == []
+
+    ## a file that shows up after the first poll is read from its start
+    path_log.write_text('line 1\nline 2\npart')
+    assert follower.poll() == [(str(path_log), 'line 1'), (str(path_log), 'line 2')]
+    with open(path_log, 'a') as f:
+        f.write('ial\n')
+    assert follower.poll() == [(str(path_log), 'partial')]
+
+
+def test_ssh_glob_with_spaces_and_shell_characters(pool, tmp_path):
+    dir_job = tmp_path / "job 1 $(touch pwned); 'x'"
+    dir_job.mkdir()
+    (dir_job / 'print_log_123.log').write_text('a\n')
+    (dir_job / 'print_log_456.log').write_text('b\n')
+    (dir_job / 'other.log').write_text('c\n')
+    ssh = pool.ssh('127.0.0.1', open_shell=False, verbose=False)
+    follower = util.log_follower(str(dir_job / 'print_log_%j.log'), ssh=ssh)
+    assert sorted(follower.poll()) == [(str(dir_job / 'print_log_123.log'), 'a'), (str(dir_job / 'print_log_456.log'), 'b')]
+    assert not (tmp_path / 'pwned').exists()
+
+
+def test_ssh_offsets_count_raw_bytes(pool, tmp_path):
+    path_log = tmp_path / 'log.txt'
+    ## latin-1 bytes that are not valid utf-8, and a multi byte character split over two reads
+    path_log.write_bytes(b'caf\xe9 1\nline 2\n\xe2\x82')
+    ssh = pool.ssh('127.0.0.1', open_shell=False, verbose=False)
+    follower = util.log_follower(str(path_log), ssh=ssh)
+    assert follower.poll() == [(str(path_log), 'caf� 1'), (str(path_log), 'line 2')]
+    assert follower.offsets[str(path_log)] == path_log.stat().st_size
+
+    with open(path_log, 'ab') as f:
+        f.write(b'\xac 3\nline 4\n')
+    assert follower.poll() == [(str(path_log), '€ 3'), (str(path_log), 'line 4')]
+    assert follower.poll() == []
@@ -0,0 +1,36 @@
+import util
+
+
+def test_isdir_remote_counts_one_lookup(pool, tmp_path):
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'file.txt').write_bytes(b'x')
+    sftp = pool.sftp('127.0.0.1', cache_ttl=60)
+
+    assert sftp.isdir_remote(str(tmp_path / 'dir'))
+    assert not sftp.isdir_remote(str(tmp_path / 'file.txt'))
+    assert not sftp.isdir_remote(str(tmp_path / 'missing'))
+    assert sftp.cache.stats['misses'] == 3 and sftp.cache.stats['hits'] == 0
+
+    assert sftp.isdir_remote(str(tmp_path / 'dir'))
+    assert not sftp.isdir_remote(str(tmp_path / 'file.txt'))
+    assert sftp.cache.stats['misses'] == 3 and sftp.cache.stats['hits'] == 2
+
+    sftp.stat_remote(str(tmp_path / 'file.txt'))
+    assert sftp.cache.stats['hits'] == 3
+
+
+def test_mkdir_safe_existing_counts_one_lookup(pool, tmp_path):
+    (tmp_path / 'dir').mkdir()
+    sftp = pool.sftp('127.0.0.1', cache_ttl=60)
+
+    sftp.mkdir_safe(str(tmp_path / 'dir'), ignore_existing=True)
+    assert sftp.cache.stats['misses'] == 1
+    sftp.mkdir_safe(str(tmp_path / 'dir'), ignore_existing=True)
+    assert sftp.cache.stats['misses'] == 1 and sftp.cache.stats['hits'] == 1
+
+
+def test_count_without_lookup():
+    cache = util.remote_metadata_cache()
+    assert cache.get('stat', '/a', count=False) is None
+    cache.count(hit=False)
+    assert cache.stats['misses'] == 1
@@ -0,0 +1,45 @@
+import pytest
+
+
+class _counter():
+    """
+    Counts the calls of some methods of a paramiko.SFTPClient.
+    """
+    def __init__(self, sftp, names):
+        self.counts = {name: 0 for name in names}
+        for name in names:
+            setattr(sftp, name, self._wrap(name, getattr(sftp, name)))
+
+    def _wrap(self, name, fn):
+        def _fn(*args, **kwargs):
+            self.counts[name] += 1
+            return fn(*args, **kwargs)
+        return _fn
+
+
+@pytest.mark.parametrize('cache_ttl', [None, 60])
+def test_mkdir_p(pool, tmp_path, cache_ttl):
+    sftp = pool.sftp('127.0.0.1', cache_ttl=cache_ttl)
+    counter = _counter(sftp.sftp, ['stat', 'mkdir', 'chdir'])
+    path = tmp_path / 'a' / 'b' / 'c'
+
+    assert sftp.mkdir_p(str(path)) is True
+    assert path.is_dir()
+    ## c, b, a are missing and tmp_path exists
+    assert counter.counts == {'stat': 4, 'mkdir': 3, 'chdir': 0}
+    assert sftp.sftp.getcwd() is None
+
+    assert sftp.mkdir_p(str(path)) is False
+    assert sftp.mkdir_p(str(tmp_path / 'a')) is False
+    if cache_ttl is None:
+        assert counter.counts == {'stat': 6, 'mkdir': 3, 'chdir': 0}
+    else:
+        ## everything is known from the first call
+        assert counter.counts == {'stat': 4, 'mkdir': 3, 'chdir': 0}
+
+
+def test_mkdir_p_under_a_file_raises(pool, tmp_path):
+    (tmp_path / 'file').write_bytes(b'')
+    sftp = pool.sftp('127.0.0.1')
+    with pytest.raises(IOError):
+        sftp.mkdir_p(str(tmp_path / 'file' / 'sub'))
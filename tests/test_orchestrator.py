@@ -0,0 +1,138 @@
+import time
+
+import orchestrator
+from test_slurm_job_monitor import _write_fake_scheduler, phases_fan_out
+
+
+def _orchestrator(tmp_path, names, pool=None, **kwargs):
+    sessions = [orchestrator.make_session(name, dir_S2pOutput_remote=str(tmp_path / 'out' / '{session_}')) for name in names]
+    return orchestrator.orchestrator(pool, sessions, path_state=tmp_path / 'state.json', **{'interval': 0.01, 'verbose': False, **kwargs})
+
+
+class _fake_steps():
+    """
+    Replaces the remote steps of an orchestrator and records when they ran.
+    """
+    def __init__(self, orch, n_polls=3, fail_copy=None):
+        self.orch = orch
+        self.n_polls = n_polls
+        self.fail_copy = fail_copy or {}
+        self.events = []
+        self.resumed = {}
+        self.polls = {}
+        orch._copy = self._copy
+        orch._submit = self._submit
+        orch._retrieve = self._retrieve
+        orch._poll_compute = self._poll_compute
+
+    def _copy(self, session):
+        self.events.append((session['name'], 'copy', time.time()))
+        time.sleep(0.05)
+        if self.fail_copy.get(session['name'], 0) > 0:
+            self.fail_copy[session['name']] -= 1
+            raise OSError('copy failed')
+
+    def _submit(self, session, resumed=False):
+        self.events.append((session['name'], 'submit', time.time()))
+        self.resumed[session['name']] = resumed
+        return ['1']
+
+    def _retrieve(self, session):
+        self.events.append((session['name'], 'retrieve', time.time()))
+
+    def _poll_compute(self, name):
+        self.polls[name] = self.polls.get(name, 0) + 1
+        if self.polls[name] >= self.n_polls:
+            self.events.append((name, 'compute', time.time()))
+            self.orch._set(name, 'compute', status='done', end=time.time())
+
+    def stages(self, name):
+        return [stage for n, stage, _ in self.events if n == name]
+
+
+def test_sessions_overlap_within_the_limits(tmp_path):
+    names = ['A/1', 'A/2', 'A/3']
+    orch = _orchestrator(tmp_path, names, max_copy=1, max_compute=1)
+    steps = _fake_steps(orch, n_polls=30)
+    state = orch.run(timeout=30)
+
+    assert all([orch.next_stage(name) is None for name in names])
+    assert all([steps.stages(name) == ['copy', 'submit', 'compute', 'retrieve'] for name in names])
+    ## one copy at a time: each copy starts after the one before ended
+    t_copy = [t for _, stage, t in steps.events if stage == 'copy']
+    assert all([t1 - t0 >= 0.05 for t0, t1 in zip(t_copy[:-1], t_copy[1:])])
+    ## one session on the cluster at a time: a session is submitted only after the one before finished computing
+    t = {(n, stage): t for n, stage, t in steps.events}
+    assert t[('A/2', 'submit')] >= t[('A/1', 'compute')]
+    assert t[('A/3', 'submit')] >= t[('A/2', 'compute')]
+    ## the copies don't wait for the cluster
+    assert t[('A/3', 'copy')] < t[('A/1', 'compute')]
+    assert state['A/1']['job_ids'] == ['1']
+
+
+def test_failed_copy_is_retried_then_stops_the_session(tmp_path):
+    orch = _orchestrator(tmp_path, ['A/1', 'A/2'], max_attempts=2)
+    steps = _fake_steps(orch, fail_copy={'A/1': 1, 'A/2': 5})
+    state = orch.run(timeout=30)
+
+    assert state['A/1']['stages']['copy']['attempts'] == 2
+    assert orch.next_stage('A/1') is None
+    assert state['A/2']['stages']['copy']['status'] == 'failed'
+    assert 'OSError: copy failed' in state['A/2']['stages']['copy']['error']
+    assert orch.is_finished('A/2')
+    assert steps.stages('A/2') == ['copy', 'copy']
+
+
+def test_resume_from_the_state_file(tmp_path):
+    orch = _orchestrator(tmp_path, ['A/1', 'A/2'])
+    _fake_steps(orch)
+    orch.run(timeout=30)
+    ## A/2 was submitting when the last run stopped
+    orch.state['A/2']['stages']['submit']['status'] = 'running'
+    for stage in ['compute', 'retrieve']:
+        orch.state['A/2']['stages'][stage]['status'] = 'pending'
+    orch._save_state()
+
+    orch_resumed = _orchestrator(tmp_path, ['A/1', 'A/2', 'A/3'])
+    assert orch_resumed.state['A/2']['stages']['submit']['status'] == 'interrupted'
+    steps = _fake_steps(orch_resumed)
+    orch_resumed.run(timeout=30)
+
+    assert steps.stages('A/1') == []
+    assert steps.stages('A/2') == ['submit', 'compute', 'retrieve']
+    assert steps.resumed == {'A/2': True, 'A/3': False}
+    assert steps.stages('A/3') == ['copy', 'submit', 'compute', 'retrieve']
+
+
+def test_submit_runs_the_dispatcher_once(pool, tmp_path):
+    orch = _orchestrator(tmp_path, ['A/1'], pool=pool, hostname_transfer='127.0.0.1', hostname_compute='127.0.0.1')
+    session = orch.sessions['A/1']
+    ## stands in for dispatcher.py: writes the job ids next to itself
+    path_dispatcher = tmp_path / 'dispatcher.py'
+    path_dispatcher.write_text('import sys\nopen(sys.argv[1] + "/job_ids.txt", "a").write("11\\n12\\n")\n')
+    orch.path_dispatcher_local = str(path_dispatcher)
+
+    assert orch._submit(session) == ['11', '12']
+    assert (tmp_path / 'out' / 'A_1' / 'dispatcher.py').exists()
+    ## a resumed submission that already wrote job ids does not run the dispatcher again
+    path_dispatcher.unlink()
+    assert orch._submit(session, resumed=True) == ['11', '12']
+
+
+def test_poll_compute_reports_jobs_that_never_run(pool, tmp_path):
+    dir_bin = tmp_path / 'bin'
+    _write_fake_scheduler(dir_bin, phases=phases_fan_out)
+    orch = _orchestrator(tmp_path, ['A/1'], pool=pool, hostname_compute='127.0.0.1', cmd_squeue=str(dir_bin / 'squeue'), cmd_sacct=str(dir_bin / 'sacct'))
+    for stage in ['copy', 'submit']:
+        orch.state['A/1']['stages'][stage]['status'] = 'done'
+    orch.state['A/1']['job_ids'] = ['200', '201', '202']
+
+    for _ in range(len(phases_fan_out) + 1):
+        if orch.state['A/1']['stages']['compute']['status'] == 'failed':
+            break
+        orch._poll_compute('A/1')
+    info = orch.state['A/1']['stages']['compute']
+    assert info['status'] == 'failed'
+    assert "'201_1': 'FAILED'" in info['error']
+    assert "'202': 'PENDING (DependencyNeverSatisfied)'" in info['error']
+    assert orch.is_finished('A/1')
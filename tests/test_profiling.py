@@ -0,0 +1,43 @@
+import pytest
+
+import profiling
+import util
+
+
+def test_profile_records_stages(tmp_path):
+    profiler = profiling.stage_profiler(tmp_path / 'profile.jsonl', info={'name_job': 'job0'})
+    with profiler.profile('convert') as extra:
+        (tmp_path / 'out.bin').write_bytes(b'\0' * 2**20)
+        extra['timing'] = {'total': 1.0}
+    with pytest.raises(ValueError):
+        with profiler.profile('plane0.registration', iplane=0):
+            raise ValueError('bad frame')
+
+    records = profiling.read_records(tmp_path / 'profile.jsonl')
+    assert [(r['stage'], r['status']) for r in records] == [('convert', 'done'), ('plane0.registration', 'failed')]
+    assert records[0]['timing'] == {'total': 1.0} and records[0]['name_job'] == 'job0'
+    assert records[1]['error'] == 'ValueError: bad frame' and records[1]['iplane'] == 0
+    assert records[0]['wall_s'] >= 0 and records[0]['peak_rss_GB'] > 0
+
+
+def test_read_records_skips_cut_off_lines(tmp_path):
+    (tmp_path / 'profile.jsonl').write_text('{"stage": "convert", "status": "done"}\n{"stage": "pla')
+    assert profiling.read_records(tmp_path / 'profile.jsonl') == [{'stage': 'convert', 'status': 'done'}]
+
+
+def test_summary_table_columns_match_keys():
+    records = [{'stage': 'convert', 'status': 'done', 'wall_s': 10.0, 'cpu_s': 20.0, 'peak_rss_GB': 1.5, 'read_GB': 0.0, 'read_all_GB': 3.25, 'written_all_GB': 4.5}]
+    header, _, line = profiling.summary_table(records).splitlines()
+    values = dict(zip(header.split(), line.split()))
+    assert values == {'stage': 'convert', 'status': 'done', 'wall_s': '10.0', 'cpu_s': '20.0', 'cores': '2.0', 'peak_rss_GB': '1.50', 'read_all_GB': '3.25', 'written_all_GB': '4.50'}
+
+
+def test_summarize_stage_profiles_merges_planes():
+    records = [
+        {'stage': 'plane0.registration', 'status': 'done', 'wall_s': 10.0, 'read_all_GB': 1.0},
+        {'stage': 'plane1.registration', 'status': 'failed', 'wall_s': 30.0, 'read_all_GB': 3.0},
+    ]
+    summary = util.summarize_stage_profiles(records)
+    assert summary['plane*.registration']['n'] == 2 and summary['plane*.registration']['n_failed'] == 1
+    assert summary['plane*.registration']['wall_s_max'] == 30.0
+    assert summary['plane*.registration']['read_all_GB_mean'] == 2.0
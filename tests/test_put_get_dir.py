@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+
+def _make_tree(dir_root):
+    files = {
+        'a.bin': os.urandom(300_000),
+        'b.txt': b'small',
+        'sub/c.bin': os.urandom(50_000),
+        'sub/deeper/d.bin': os.urandom(1000),
+        'sub/empty.txt': b'',
+    }
+    for path_rel, data in files.items():
+        (dir_root / path_rel).parent.mkdir(parents=True, exist_ok=True)
+        (dir_root / path_rel).write_bytes(data)
+    (dir_root / 'empty_dir').mkdir()
+    return files
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_round_trip(pool, tmp_path, workers):
+    files = _make_tree(tmp_path / 'src')
+    (tmp_path / 'remote').mkdir()
+    sftp = pool.sftp('127.0.0.1')
+
+    summary = sftp.put_dir(tmp_path / 'src', str(tmp_path / 'remote'), verbose=False, workers=workers)
+    summary_get = sftp.get_dir(str(tmp_path / 'remote'), tmp_path / 'back', verbose=False, workers=workers)
+
+    for path_rel, data in files.items():
+        assert (tmp_path / 'remote' / path_rel).read_bytes() == data
+        assert (tmp_path / 'back' / path_rel).read_bytes() == data
+    assert (tmp_path / 'back' / 'empty_dir').is_dir()
+    if workers > 1:
+        n_bytes = sum(len(data) for data in files.values())
+        assert (summary['n_files'], summary['n_bytes']) == (len(files), n_bytes)
+        assert (summary_get['n_files'], summary_get['n_bytes']) == (len(files), n_bytes)
+
+
+def test_parallel_failure_is_raised_after_the_rest_is_done(pool, tmp_path):
+    _make_tree(tmp_path / 'src')
+    (tmp_path / 'remote').mkdir()
+    ## a directory where a file should go
+    (tmp_path / 'remote' / 'b.txt').mkdir()
+    sftp = pool.sftp('127.0.0.1')
+
+    with pytest.raises(IOError, match='1 of 5 files failed'):
+        sftp.put_dir(tmp_path / 'src', str(tmp_path / 'remote'), verbose=False, workers=4)
+    assert (tmp_path / 'remote' / 'sub' / 'c.bin').read_bytes() == (tmp_path / 'src' / 'sub' / 'c.bin').read_bytes()
+
+
+def test_transfer_uses_channels_of_one_transport(pool, tmp_path):
+    _make_tree(tmp_path / 'src')
+    (tmp_path / 'remote').mkdir()
+    sftp = pool.sftp('127.0.0.1')
+    transport = sftp.transport
+    sftp.put_dir(tmp_path / 'src', str(tmp_path / 'remote'), verbose=False, workers=4)
+    ## no new login: the same transport, and the worker channels are closed again
+    assert sftp.transport is transport and transport.is_active()
+    assert len([c for c in transport._channels.values() if not c.closed]) == 1
@@ -0,0 +1,81 @@
+import os
+import shutil
+import stat
+
+import numpy as np
+
+import reg_cache
+
+
+def test_store_keeps_reg_file_writable(tmp_path):
+    dir_fast = tmp_path / 'fast_disk' / 'suite2p' / 'plane0'
+    dir_fast.mkdir(parents=True)
+    reg_file = dir_fast / 'data.bin'
+    reg_file.write_bytes(np.arange(1000, dtype=np.int16).tobytes())
+
+    cache = reg_cache.registration_cache(tmp_path / 'cache', verbose=False)
+    with cache.lock('key', 0):
+        cache.store('key', 0, {'reg_file': str(reg_file), 'Ly': 10, 'Lx': 10})
+    assert cache.has('key', 0)
+
+    ## suite2p opens the registered binary with memmap 'r+' for detection
+    assert stat.S_IMODE(os.stat(reg_file).st_mode) & stat.S_IWUSR
+    mm = np.memmap(str(reg_file), mode='r+', dtype=np.int16)
+    assert mm[10] == 10
+    del mm
+
+    ## and so does a later job that restores the entry
+    dir_fast_2 = tmp_path / 'fast_disk_2' / 'plane0'
+    ops_path = tmp_path / 'save' / 'suite2p' / 'plane0' / 'ops.npy'
+    with cache.lock('key', 0):
+        op = cache.restore('key', 0, ops_path=ops_path, dir_fast_plane=dir_fast_2)
+    assert stat.S_IMODE(os.stat(op['reg_file']).st_mode) & stat.S_IWUSR
+    with open(op['reg_file'], 'r+b') as f:
+        assert len(f.read()) == 2000
+
+
+def _stored_cache(tmp_path, quota_GB=None):
+    reg_file = tmp_path / 'fast_disk' / 'plane0' / 'data.bin'
+    reg_file.parent.mkdir(parents=True)
+    reg_file.write_bytes(np.arange(1000, dtype=np.int16).tobytes())
+    cache = reg_cache.registration_cache(tmp_path / 'cache', quota_GB=quota_GB, verbose=False)
+    with cache.lock('key', 0):
+        cache.store('key', 0, {'reg_file': str(reg_file)})
+    return cache, reg_file
+
+
+def _restore(cache, tmp_path, name):
+    ops_path = tmp_path / name / 'suite2p' / 'plane0' / 'ops.npy'
+    with cache.lock('key', 0):
+        return cache.restore('key', 0, ops_path=ops_path, dir_fast_plane=tmp_path / name / 'fast_disk' / 'plane0')
+
+
+def test_writes_to_job_binaries_do_not_reach_the_cache(tmp_path):
+    cache, reg_file = _stored_cache(tmp_path)
+    path_cached = cache.path_entry('key', 0) / 'data.bin'
+    assert not stat.S_IMODE(os.stat(path_cached).st_mode) & stat.S_IWUSR
+
+    ## the job that stored the entry, and a job that restored it, write to their binaries
+    reg_file.write_bytes(b'\0' * 2000)
+    op = _restore(cache, tmp_path, 'job2')
+    with open(op['reg_file'], 'r+b') as f:
+        f.write(b'\xff' * 100)
+
+    assert path_cached.read_bytes() == np.arange(1000, dtype=np.int16).tobytes()
+    assert np.array_equal(np.fromfile(_restore(cache, tmp_path, 'job3')['reg_file'], dtype=np.int16), np.arange(1000))
+
+
+def test_restore_of_an_evicted_entry_is_a_miss(tmp_path):
+    cache, _ = _stored_cache(tmp_path)
+    shutil.rmtree(cache.path_entry('key', 0))
+    assert _restore(cache, tmp_path, 'job2') is None
+
+
+def test_locked_entry_is_not_evicted(tmp_path):
+    cache, _ = _stored_cache(tmp_path)
+    cache.quota_GB = 0
+    with cache.lock('key', 0):
+        assert cache.evict() == []
+        assert cache.has('key', 0)
+    assert cache.evict() == [('key', 0)]
+    assert not cache.has('key', 0)
@@ -0,0 +1,92 @@
+import json
+import os
+
+import pytest
+
+import remote_copy
+import util
+
+
+def _make_source(dir_src):
+    (dir_src / 'sub').mkdir(parents=True)
+    (dir_src / 'small.tif').write_bytes(b's' * 10)
+    (dir_src / 'sub' / 'big.tif').write_bytes(b'b' * 1000)
+    (dir_src / ('left_over.tif' + remote_copy.suffix_partial)).write_bytes(b'x')
+
+
+def test_copies_only_new_and_changed_files(tmp_path):
+    dir_src, dir_dst = tmp_path / 'src', tmp_path / 'dst'
+    _make_source(dir_src)
+
+    summary = remote_copy.copy_tree(str(dir_src), str(dir_dst), workers=2)
+    assert (summary['n_files'], summary['n_copied'], summary['n_skipped'], summary['n_bytes_copied']) == (2, 2, 0, 1010)
+    assert (dir_dst / 'sub' / 'big.tif').read_bytes() == b'b' * 1000
+    assert not (dir_dst / ('left_over.tif' + remote_copy.suffix_partial)).exists()
+    assert int(os.stat(dir_dst / 'small.tif').st_mtime) == int(os.stat(dir_src / 'small.tif').st_mtime)
+
+    summary = remote_copy.copy_tree(str(dir_src), str(dir_dst))
+    assert (summary['n_copied'], summary['n_skipped']) == (0, 2)
+
+    (dir_src / 'small.tif').write_bytes(b'changed')
+    (dir_src / 'new.tif').write_bytes(b'n')
+    (dir_dst / 'only_in_target.txt').write_text('kept')
+    summary = remote_copy.copy_tree(str(dir_src), str(dir_dst), dry_run=True)
+    assert (summary['n_copied'], summary['n_to_copy']) == (0, 2)
+    summary = remote_copy.copy_tree(str(dir_src), str(dir_dst))
+    assert (summary['n_copied'], summary['n_skipped']) == (2, 1)
+    assert (dir_dst / 'small.tif').read_bytes() == b'changed'
+    assert (dir_dst / 'only_in_target.txt').read_text() == 'kept'
+
+    with pytest.raises(FileNotFoundError):
+        remote_copy.copy_tree(str(tmp_path / 'missing'), str(dir_dst))
+
+
+def test_plan_copy_largest_first():
+    manifest_src = {'a': [1, 10.0], 'b': [100, 10.0], 'c': [50, 10.0], 'd': [5, 10.7]}
+    manifest_dst = {'c': [50, 10.2], 'd': [5, 11.0]}
+    assert remote_copy.plan_copy(manifest_src, manifest_dst) == (['b', 'd', 'a'], ['c'])
+
+
+def test_checksums_and_manifest(tmp_path):
+    dir_src, dir_dst = tmp_path / 'src', tmp_path / 'dst'
+    _make_source(dir_src)
+    path_manifest = str(dir_dst / '.transfer_manifest.json')
+
+    summary = remote_copy.copy_tree(str(dir_src), str(dir_dst), checksum='md5', path_manifest=path_manifest)
+    assert summary['checksums']['sub/big.tif'] == remote_copy.hash_file(str(dir_src / 'sub' / 'big.tif'), checksum='md5')
+    (dir_src / 'small.tif').write_bytes(b'changed')
+    remote_copy.copy_tree(str(dir_src), str(dir_dst), path_manifest=path_manifest)
+
+    with open(path_manifest) as f:
+        manifest = json.load(f)
+    assert set(manifest) == {'small.tif', 'sub/big.tif'}
+    ## the unchanged file keeps the hash of the earlier copy. the one copied without a checksum has none
+    assert manifest['sub/big.tif']['hash'] == summary['checksums']['sub/big.tif']
+    assert manifest['sub/big.tif']['hash_type'] == 'md5'
+    assert 'hash' not in manifest['small.tif']
+
+
+def test_mismatch_leaves_no_file(tmp_path, monkeypatch):
+    dir_src, dir_dst = tmp_path / 'src', tmp_path / 'dst'
+    _make_source(dir_src)
+    monkeypatch.setattr(remote_copy, 'hash_file', lambda path, checksum, chunk_size: 'bad')
+
+    summary = remote_copy.copy_tree(str(dir_src), str(dir_dst), checksum='md5')
+    assert summary['n_copied'] == 0
+    assert sorted([path_rel for path_rel, _ in summary['errors']]) == ['small.tif', 'sub/big.tif']
+    assert 'checksum mismatch' in summary['errors'][0][1]
+    assert remote_copy.build_manifest(str(dir_dst)) == {}
+    assert not any([p.name.endswith(remote_copy.suffix_partial) for p in dir_dst.rglob('*')])
+
+
+def test_remote_copy_over_ssh(pool, tmp_path):
+    dir_src, dir_dst = tmp_path / 'src dir', tmp_path / 'dst'
+    _make_source(dir_src)
+    ssh = pool.ssh('127.0.0.1', open_shell=False, verbose=False)
+
+    summary = util.remote_copy(ssh, str(dir_src), str(dir_dst), workers=2, checksum='blake2b', timeout=30, verbose=False)
+    assert (summary['n_copied'], summary['n_bytes_copied']) == (2, 1010)
+    assert (dir_dst / 'small.tif').read_bytes() == b's' * 10
+
+    with pytest.raises(RuntimeError, match='gave no summary'):
+        util.remote_copy(ssh, str(tmp_path / 'missing'), str(dir_dst), timeout=30, verbose=False)
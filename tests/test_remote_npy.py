@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+import util
+
+
+keys = [
+    (),
+    5,
+    -1,
+    slice(10, 20),
+    slice(None, None, -3),
+    (slice(3, 9), slice(100, 300)),
+    (slice(None), 4),
+    (4, slice(-50, None)),
+    (Ellipsis, 2),
+    (np.array([1, 5, 2]), slice(0, 10)),
+    (np.arange(40) % 3 == 0,),
+    (slice(2, 4), slice(None, None, -2)),
+]
+
+
+def _save(path, array, **kwargs):
+    with open(path, 'wb') as f:
+        np.lib.format.write_array(f, array, **kwargs)
+
+
+@pytest.fixture()
+def sftp(pool):
+    return pool.sftp('127.0.0.1')
+
+
+@pytest.mark.parametrize('order', ['C', 'F'])
+def test_slices_match_numpy(sftp, tmp_path, order):
+    array = np.asarray(np.random.default_rng(0).random((40, 500)), order=order).astype(np.float32, order=order)
+    array_3d = np.arange(40 * 6 * 5, dtype=np.int16).reshape(40, 6, 5).copy(order=order)
+    _save(tmp_path / 'F.npy', array)
+    _save(tmp_path / 'mov.npy', array_3d, version=(2, 0))
+
+    with sftp.open_npy(str(tmp_path / 'F.npy'), block_size=512) as F, sftp.open_npy(str(tmp_path / 'mov.npy'), block_size=512) as mov:
+        assert (F.shape, F.dtype, F.fortran_order, len(F)) == (array.shape, array.dtype, order == 'F', 40)
+        for key in keys:
+            np.testing.assert_array_equal(F[key], array[key])
+            np.testing.assert_array_equal(mov[key], array_3d[key])
+        np.testing.assert_array_equal(mov[3, 2:4, 1], array_3d[3, 2:4, 1])
+        np.testing.assert_array_equal(np.asarray(F), array)
+        with pytest.raises(IndexError):
+            F[0, 0, 0]
+
+
+def test_reads_only_the_selected_rows(sftp, tmp_path):
+    array = np.arange(1000 * 256, dtype=np.float32).reshape(1000, 256)  ## 1 KiB per row
+    _save(tmp_path / 'F.npy', array)
+
+    F = sftp.open_npy(str(tmp_path / 'F.npy'), block_size=1024, cache_blocks=64, prefetch_blocks=1)
+    n_bytes_header = F.stats['n_bytes_fetched']
+    np.testing.assert_array_equal(F[500:510], array[500:510])
+    ## the 10 (or 11, unaligned) blocks of the rows plus one prefetched block
+    assert F.stats['n_bytes_fetched'] - n_bytes_header <= 12 * 1024
+
+    n_fetched = F.stats['n_blocks_fetched']
+    F[500:510]
+    assert F.stats['n_blocks_fetched'] == n_fetched
+    assert F.stats['n_block_hits'] >= 10
+
+    ## a request larger than the cache is served whole, then the cache shrinks back to its size
+    np.testing.assert_array_equal(F[:], array)
+    F[0]
+    assert len(F._blocks) == 64
+    F.close()
+
+
+def test_object_arrays_need_load(sftp, tmp_path):
+    stat = np.array([{'ypix': np.arange(3)}, {'ypix': np.arange(2)}], dtype=object)
+    np.save(tmp_path / 'stat.npy', stat, allow_pickle=True)
+    np.save(tmp_path / 'scalar.npy', np.float64(2.5))
+
+    remote = sftp.open_npy(str(tmp_path / 'stat.npy'))
+    with pytest.raises(TypeError, match='allow_pickle'):
+        remote[0]
+    assert [len(s['ypix']) for s in remote.load(allow_pickle=True)] == [3, 2]
+    assert sftp.open_npy(str(tmp_path / 'scalar.npy'))[()] == 2.5
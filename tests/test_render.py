@@ -0,0 +1,58 @@
+import colorsys
+
+import numpy as np
+import pytest
+
+import render
+
+
+def test_hsv_to_rgb_matches_colorsys():
+    rng = np.random.default_rng(0)
+    hsvs = rng.random((500, 3))
+    hsvs[:50, 1] = 0  ## grey
+    hsvs[50:100, 0] = np.repeat(np.arange(6) / 6, 9)[:50]  ## edges of the hue sectors
+    expected = np.array([colorsys.hsv_to_rgb(*hsv) for hsv in hsvs])
+    np.testing.assert_allclose(render.hsv_to_rgb(hsvs), expected, atol=1e-12)
+
+
+def test_roi_overlay_matches_the_loop():
+    Ly, Lx = 64, 80
+    stats, iscell = render.make_fake_stats(150, Ly, Lx, radius=5, seed=2)
+    hues = np.random.default_rng(3).random(len(stats))
+    rgbs = render.roi_overlay(stats, iscell, Ly, Lx, hues=hues)
+    rgbs_loop = render._roi_overlay_loop(stats, iscell, Ly, Lx, hues=hues)
+    assert rgbs.shape == (2, Ly, Lx, 3) and rgbs.dtype == np.float32
+    np.testing.assert_allclose(rgbs, rgbs_loop, atol=1e-6)
+
+
+def test_later_roi_is_on_top():
+    stats = [
+        {'ypix': np.array([0, 0]), 'xpix': np.array([0, 1]), 'lam': np.array([1.0, 0.5])},
+        {'ypix': np.array([0]), 'xpix': np.array([1]), 'lam': np.array([2.0])},
+    ]
+    rgbs = render.roi_overlay(stats, np.array([1, 1]), 2, 2, hues=np.array([0.0, 1/3]))
+    np.testing.assert_allclose(rgbs[1, 0, 0], [1, 0, 0], atol=1e-6)
+    np.testing.assert_allclose(rgbs[1, 0, 1], [0, 1, 0], atol=1e-6)
+    assert not rgbs[0].any()
+
+
+def test_no_rois():
+    assert not render.roi_overlay([], np.zeros(0), 4, 5).any()
+
+
+def test_downsample():
+    image = np.arange(5 * 7, dtype=np.float32).reshape(5, 7)
+    np.testing.assert_allclose(render.downsample(image, 2), [[4, 6, 8], [18, 20, 22]])
+    assert render.downsample(np.zeros((4, 6, 3)), 2).shape == (2, 3, 3)
+
+
+def test_save_thumbnails(tmp_path):
+    pytest.importorskip('matplotlib')
+    paths = render.save_thumbnails({'gray': np.zeros((100, 30)), 'rgb': np.ones((10, 10, 3))}, tmp_path, max_size=40)
+    assert [p.name for p in paths] == ['gray.png', 'rgb.png']
+    assert all([p.exists() for p in paths])
+
+
+def test_benchmark_runs():
+    out = render.benchmark(n_rois=20, Ly=32, Lx=32, n_repeats=1)
+    assert out['max_diff'] < 1e-6
@@ -0,0 +1,120 @@
+import math
+
+import numpy as np
+import pytest
+
+import resources
+
+tifffile = pytest.importorskip('tifffile')
+
+
+def _write_tiff(path, n_pages, Ly=32, Lx=48, **kwargs):
+    tifffile.imwrite(str(path), np.zeros((n_pages, Ly, Lx), dtype=np.int16), **kwargs)
+
+
+def test_read_tiff_info_skips_files_still_being_copied(tmp_path):
+    _write_tiff(tmp_path / 'a.tif', 10)
+    _write_tiff(tmp_path / 'b.tif', 10)
+    ## a file that was just created, and one with only part of its header
+    (tmp_path / 'c.tif').write_bytes(b'')
+    (tmp_path / 'd.tif').write_bytes((tmp_path / 'a.tif').read_bytes()[:6])
+
+    assert resources._read_tiff_header(tmp_path / 'c.tif') is None
+    assert resources._read_tiff_header(tmp_path / 'd.tif') is None
+    info = resources.read_tiff_info(tmp_path)
+    assert (info['n_files'], info['n_skipped'], info['n_pages']) == (2, 2, 20)
+    assert (info['Ly'], info['Lx'], info['bytes_per_px']) == (32, 48, 2)
+
+
+def test_parse_slurm_time_and_mem():
+    assert resources.parse_slurm_time('1-02:03:04') == 86400 + 2*3600 + 3*60 + 4
+    assert resources.parse_slurm_time('05:30.5') == 330.5
+    assert resources.parse_slurm_time('UNLIMITED') is None
+    assert resources.parse_slurm_mem('1024K') == 2**20
+    assert resources.parse_slurm_mem('2.5G') == int(2.5 * 2**30)
+    assert resources.parse_slurm_mem('0') == 0
+    assert resources.parse_slurm_mem('') is None
+    assert resources.format_slurm_time(86400 + 3661.2) == '1-01:01:02'
+
+
+def test_predict_scales_with_data_size_and_ops():
+    tiff_info = {'n_pages': 2000, 'Ly': 512, 'Lx': 512, 'nplanes': None, 'nchannels': None}
+    ops = {'nplanes': 1, 'nchannels': 1, 'nonrigid': False}
+    p = resources.predict(tiff_info, ops)
+    assert (p['n_frames'], p['cpus']) == (2000, 8)
+
+    p_long = resources.predict({**tiff_info, 'n_pages': 20000}, ops)
+    assert p_long['time_s'] > p['time_s']
+    assert p_long['mem_GB'] >= p['mem_GB']
+    assert resources.predict(tiff_info, {**ops, 'nonrigid': True})['mem_GB'] > p['mem_GB']
+    ## ops win over the ScanImage metadata when deinterleaving
+    assert resources.predict({**tiff_info, 'nplanes': 4}, {**ops, 'nplanes': 2})['n_frames'] == 1000
+
+
+def test_estimate_resources_sweep_history_and_limits(tmp_path):
+    tiff_info = {'n_pages': 2000, 'Ly': 512, 'Lx': 512}
+    ops = [{'nonrigid': False}, {'nonrigid': True}]
+    estimate = resources.estimate_resources(tiff_info, ops, safety_mem=1, safety_time=1)
+    assert estimate['prediction']['mem_GB'] == resources.predict(tiff_info, ops[1])['mem_GB']
+    assert estimate['scale'] == {'mem': 1.0, 'time': 1.0, 'n': 0}
+    assert estimate['time_str'] == resources.format_slurm_time(estimate['time_s'])
+
+    path_history = tmp_path / 'history.json'
+    prediction = estimate['prediction']
+    resources.save_history(path_history, [
+        {'job_id': '1', 'state': 'COMPLETED', 'prediction': prediction, 'requested': {},
+         'max_rss_GB': 2 * prediction['mem_GB'], 'elapsed_s': 3 * prediction['time_s']},
+    ])
+    estimate_scaled = resources.estimate_resources(tiff_info, ops, path_history=path_history, safety_mem=1, safety_time=1, limits={'mem_GB': (1, 10**6)})
+    assert estimate_scaled['scale'] == {'mem': 2.0, 'time': 3.0, 'n': 1}
+    assert estimate_scaled['time_s'] == math.ceil(3 * prediction['time_s'])
+
+    estimate_clipped = resources.estimate_resources(tiff_info, ops, limits={'mem_GB': (1, 4), 'time_s': (10**7, 10**8)})
+    assert (estimate_clipped['mem_GB'], estimate_clipped['time_s']) == (4, 10**7)
+
+
+def test_fit_history_scale_failed_runs_only_push_up():
+    prediction = {'mem_GB': 10, 'time_s': 100}
+    requested = {'mem_GB': 20, 'time_s': 200}
+    history = [
+        {'state': 'COMPLETED', 'prediction': prediction, 'requested': requested, 'max_rss_GB': 5, 'elapsed_s': 50},
+        {'state': 'OUT_OF_MEMORY', 'prediction': prediction, 'requested': requested, 'max_rss_GB': 20, 'elapsed_s': 10},
+        {'state': 'TIMEOUT', 'prediction': prediction, 'requested': requested, 'max_rss_GB': 1, 'elapsed_s': 200},
+        {'state': None, 'prediction': prediction, 'requested': requested, 'max_rss_GB': None, 'elapsed_s': None},
+    ]
+    assert resources.fit_history_scale(history) == {'mem': 3.0, 'time': 3.0, 'n': 3}
+    assert resources.fit_history_scale([]) == {'mem': 1.0, 'time': 1.0, 'n': 0}
+
+
+def test_update_history_folds_tasks_and_steps(tmp_path):
+    path_sacct = tmp_path / 'sacct'
+    path_sacct.write_text('\n'.join([
+        '#!/bin/bash',
+        "cat <<'OUT'",
+        '100_0|COMPLETED|00:10:00|',
+        '100_0.batch|COMPLETED|00:10:00|2G',
+        '100_1|OUT_OF_MEMORY|00:05:00|',
+        '100_1.batch|OUT_OF_MEMORY|00:05:00|3584M',
+        '101|RUNNING|00:01:00|',
+        '103|CANCELLED by 123|00:00:30|',
+        'OUT',
+        '',
+    ]))
+    path_sacct.chmod(0o755)
+
+    path_history = tmp_path / 'history.json'
+    estimate = {'prediction': {'mem_GB': 1, 'time_s': 1}, 'mem_GB': 8, 'cpus': 4, 'time_s': 1800}
+    resources.record_submission(path_history, ['100', '101', '102', '103'], estimate)
+    history = resources.load_history(path_history)
+    history[2]['time_submitted'] -= 31 * 86400
+    resources.save_history(path_history, history)
+
+    history = resources.update_history(path_history, cmd_sacct=str(path_sacct))
+    assert [h['job_id'] for h in history] == ['100', '101', '103']
+    assert (history[0]['state'], history[0]['elapsed_s'], history[0]['max_rss_GB']) == ('OUT_OF_MEMORY', 600, 3.5)
+    assert history[1]['state'] is None
+    assert history[2]['state'] == 'CANCELLED'
+    assert resources.load_history(path_history) == history
+
+    ## a missing sacct leaves the history as it is
+    assert resources.update_history(path_history, cmd_sacct=str(tmp_path / 'missing')) == history
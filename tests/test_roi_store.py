@@ -0,0 +1,36 @@
+import numpy as np
+
+import roi_store
+
+
+def _stat(n_pix, **kwargs):
+    return {
+        'ypix': np.arange(n_pix),
+        'xpix': np.arange(n_pix),
+        'lam': np.ones(n_pix, dtype=np.float32),
+        'med': [n_pix, n_pix],
+        **kwargs,
+    }
+
+
+def test_roi_missing_a_key(tmp_path):
+    ## eg ROIs added by hand in the GUI have no 'skew'
+    stats = np.array([_stat(3, skew=0.5, npix=3), _stat(2, npix=2), _stat(4, skew=1.5, npix=4, radius=2.0)], dtype=object)
+    np.save(str(tmp_path / 'stat.npy'), stats, allow_pickle=True)
+    np.save(str(tmp_path / 'F.npy'), np.zeros((3, 10), dtype=np.float32))
+
+    store = roi_store.roi_store(roi_store.write_roi_store(tmp_path, verbose=False))
+    assert set(store.keys_scalars) == {'med', 'skew', 'npix', 'radius'}
+    assert np.array_equal(store.scalar('npix'), [3, 2, 4])
+    assert np.array_equal(store.scalar('skew'), [0.5, np.nan, 1.5], equal_nan=True)
+    assert np.array_equal(store.scalar('radius'), [np.nan, np.nan, 2.0], equal_nan=True)
+    assert store.scalar('med').shape == (3, 2)
+    assert np.array_equal(store.pixels(1)[0], [0, 1])
+
+
+def test_array_missing_in_a_roi_is_not_stored(tmp_path):
+    stats = np.array([_stat(3), {k: v for k, v in _stat(2).items() if k != 'med'}], dtype=object)
+    np.save(str(tmp_path / 'stat.npy'), stats, allow_pickle=True)
+
+    store = roi_store.roi_store(roi_store.write_roi_store(tmp_path, verbose=False))
+    assert 'med' not in store.keys_scalars
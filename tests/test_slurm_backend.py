@@ -0,0 +1,9 @@
+import backends
+
+
+def test_slurm_dependent_job_is_killed_on_invalid_dependency():
+    backend = backends.slurm_backend(name_job='s2p', requeue_on_timeout=False)
+    resources = {'cpus': 1, 'mem_GB': 1, 'time_str': '0-01:00:00'}
+    text = backend.make_sbatch_config(path_log='log.txt', resources=resources, dependency='afterok:123')
+    assert '#SBATCH --dependency=afterok:123\n#SBATCH --kill-on-invalid-dep=yes\n' in text
+    assert '--kill-on-invalid-dep' not in backend.make_sbatch_config(path_log='log.txt', resources=resources)
@@ -0,0 +1,153 @@
+import util
+
+
+## an array job with 3 tasks, at most 2 at once: pending -> running -> completed.
+##  phases[i] is (squeue output, sacct output) of poll i
+phases = [
+    (
+        '100_[0-2%2]|s2p|PENDING|0:00|1:00:00|(JobArrayTaskLimit)',
+        '100_[0-2%2]|s2p|PENDING|00:00:00|01:00:00||0:0',
+    ),
+    (
+        '100_0|s2p|RUNNING|0:05|1:00:00|node1\n100_1|s2p|RUNNING|0:05|1:00:00|node2\n100_[2%2]|s2p|PENDING|0:00|1:00:00|(JobArrayTaskLimit)',
+        '100_0|s2p|RUNNING|00:00:05|01:00:00||0:0\n100_1|s2p|RUNNING|00:00:05|01:00:00||0:0\n100_[2%2]|s2p|PENDING|00:00:00|01:00:00||0:0',
+    ),
+    (
+        '100_2|s2p|RUNNING|0:07|1:00:00|node1',
+        '100_0|s2p|COMPLETED|00:00:10|01:00:00||0:0\n100_0.batch|batch|COMPLETED|00:00:10||1024M|0:0\n'
+        '100_1|s2p|COMPLETED|00:00:11|01:00:00||0:0\n100_2|s2p|RUNNING|00:00:07|01:00:00||0:0',
+    ),
+    (
+        '',
+        '100_0|s2p|COMPLETED|00:00:10|01:00:00||0:0\n100_0.batch|batch|COMPLETED|00:00:10||1024M|0:0\n'
+        '100_1|s2p|COMPLETED|00:00:11|01:00:00||0:0\n100_2|s2p|COMPLETED|00:00:09|01:00:00||0:0\n100_2.batch|batch|COMPLETED|00:00:09||2G|0:0',
+    ),
+]
+
+
+def _write_fake_scheduler(dir_bin, phases=phases):
+    """
+    Fake squeue / sacct that print the next phase on every squeue call.
+    """
+    dir_bin.mkdir()
+    for i, (out_squeue, out_sacct) in enumerate(phases):
+        (dir_bin / f'squeue_{i}.txt').write_text(out_squeue + '\n')
+        (dir_bin / f'sacct_{i}.txt').write_text(out_sacct + '\n')
+    n_last = len(phases) - 1
+    (dir_bin / 'squeue').write_text(
+        '#!/bin/bash\n'
+        f'cd {dir_bin}\n'
+        'i=$(cat counter 2>/dev/null || echo 0)\n'
+        f'[ "$i" -gt {n_last} ] && i={n_last}\n'
+        'echo $((i + 1)) > counter\n'
+        'echo $i > phase\n'
+        'cat squeue_$i.txt\n'
+    )
+    (dir_bin / 'sacct').write_text(f'#!/bin/bash\ncd {dir_bin}\ncat sacct_$(cat phase).txt\n')
+    for name in ['squeue', 'sacct']:
+        (dir_bin / name).chmod(0o755)
+
+
+def test_expand_array_id():
+    assert util._expand_array_id('100_[0-2%2]') == ['100_0', '100_1', '100_2']
+    assert util._expand_array_id('100_[1,4-5]') == ['100_1', '100_4', '100_5']
+    assert util._expand_array_id('100_[0-6:3]') == ['100_0', '100_3', '100_6']
+    assert util._expand_array_id('100_7') == ['100_7']
+    assert util._expand_array_id('100') == ['100']
+
+
+def test_parse():
+    table = util._parse_squeue(phases[1][0])
+    assert {j: s.state for j, s in table.items()} == {'100_0': 'RUNNING', '100_1': 'RUNNING', '100_2': 'PENDING'}
+    assert table['100_0'].elapsed == 5
+
+    table = util._parse_sacct(phases[3][1])
+    assert set(table) == {'100_0', '100_1', '100_2'}
+    assert all(s.state == 'COMPLETED' for s in table.values())
+    assert table['100_0'].max_rss == 1024**3
+    assert table['100_2'].max_rss == 2 * 1024**3
+    assert table['100_1'].max_rss is None
+
+
+def test_wait_array_pending_running_completed(pool, tmp_path):
+    dir_bin = tmp_path / 'bin'
+    _write_fake_scheduler(dir_bin)
+    monitor = util.slurm_job_monitor(
+        ssh=pool.ssh('127.0.0.1', open_shell=False, verbose=False),
+        job_ids=['100'],
+        interval=0.05,
+        interval_max=0.1,
+        cmd_squeue=str(dir_bin / 'squeue'),
+        cmd_sacct=str(dir_bin / 'sacct'),
+        verbose=False,
+    )
+
+    table = monitor.query(force=True)
+    assert {j: s.state for j, s in table.items()} == {'100_0': 'PENDING', '100_1': 'PENDING', '100_2': 'PENDING'}
+    assert not monitor.done()
+
+    table = monitor.query(force=True)
+    assert monitor.summary() == {'RUNNING': 2, 'PENDING': 1}
+    ## the collapsed row of the first poll is gone
+    assert set(table) == {'100_0', '100_1', '100_2'}
+
+    table = monitor.wait(timeout=10)
+    assert monitor.done()
+    assert {j: s.state for j, s in table.items()} == {'100_0': 'COMPLETED', '100_1': 'COMPLETED', '100_2': 'COMPLETED'}
+    assert table['100_2'].max_rss == 2 * 1024**3
+
+
+def test_interval_backs_off_only_without_changes(pool, tmp_path):
+    dir_bin = tmp_path / 'bin'
+    _write_fake_scheduler(dir_bin)
+    monitor = util.slurm_job_monitor(
+        ssh=pool.ssh('127.0.0.1', open_shell=False, verbose=False),
+        job_ids=['100'],
+        interval=1,
+        interval_max=100,
+        cmd_squeue=str(dir_bin / 'squeue'),
+        cmd_sacct=str(dir_bin / 'sacct'),
+        verbose=False,
+    )
+    intervals = []
+    for _ in range(len(phases) + 2):
+        monitor.query(force=True)
+        intervals.append(monitor.interval)
+    ## every phase changes a state; the repeated last phase does not
+    assert intervals == [1, 1, 1, 1, 2, 4]
+
+
+## a fanned out run: conversion, a plane array with a failed task, and an afterok combine job
+phases_fan_out = [
+    (
+        '202|s2p|PENDING|0:00|2:00:00|(DependencyNeverSatisfied)',
+        '200|s2p|COMPLETED|00:01:00|06:00:00||0:0\n'
+        '201_0|s2p|COMPLETED|00:10:00|06:00:00||0:0\n201_1|s2p|FAILED|00:00:30|06:00:00||1:0\n'
+        '202|s2p|PENDING|00:00:00|02:00:00||0:0',
+    ),
+]
+
+
+def test_combine_that_never_runs_is_done(pool, tmp_path):
+    dir_bin = tmp_path / 'bin'
+    _write_fake_scheduler(dir_bin, phases=phases_fan_out)
+    monitor = util.slurm_job_monitor(
+        ssh=pool.ssh('127.0.0.1', open_shell=False, verbose=False),
+        job_ids=['200', '201', '202'],
+        interval=0.05,
+        cmd_squeue=str(dir_bin / 'squeue'),
+        cmd_sacct=str(dir_bin / 'sacct'),
+        verbose=False,
+    )
+    table = monitor.wait(timeout=10)
+    assert monitor.done()
+    assert table['202'].state == 'PENDING' and 'DependencyNeverSatisfied' in table['202'].reason
+    assert monitor.summary() == {'COMPLETED': 2, 'FAILED': 1, 'PENDING': 1}
+
+
+def test_pending_for_other_reasons_is_not_done():
+    monitor = util.slurm_job_monitor(ssh=None, job_ids=['300'], verbose=False)
+    monitor.table = util._parse_squeue('300|s2p|PENDING|0:00|2:00:00|(Dependency)')
+    assert not monitor.done()
+    monitor.table = util._parse_squeue('300|s2p|PENDING|0:00|2:00:00|(Priority)')
+    assert not monitor.done()
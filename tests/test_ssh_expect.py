@@ -0,0 +1,62 @@
+import time
+
+import util
+
+
+def _shell(pool, **kwargs):
+    return util.ssh_interface(transport=pool._transports[('127.0.0.1', 22)], open_shell=True, verbose=False, **kwargs)
+
+
+def test_expect_matches_across_reads(pool):
+    ssh = _shell(pool)
+    ssh.send("printf 'ab'; sleep 0.3; printf 'cd\\n'; echo DONE")
+    out, success = ssh.expect('bcd', total_timeout=5)
+    assert success and out.endswith('abcd')
+    ## the rest is still there for the next call
+    out, success = ssh.expect('DONE', total_timeout=5)
+    assert success and out.strip() == 'DONE'
+
+
+def test_expect_regex_and_timeout(pool):
+    ssh = _shell(pool)
+    ssh.send('echo job 12345 submitted')
+    out, success = ssh.expect(r'job (\d+) submitted', regex=True, total_timeout=5)
+    assert success and out.endswith('job 12345 submitted')
+
+    t_start = time.time()
+    out, success = ssh.expect('never printed', total_timeout=0.5)
+    assert not success and time.time() - t_start < 2
+
+
+def test_receive_returns_output_since_the_last_read(pool):
+    ssh = _shell(pool)
+    ssh.send('echo first')
+    assert ssh.expect('first', total_timeout=5)[1]
+    ssh.send('echo second')
+    time.sleep(0.3)
+    assert ssh.receive(timeout=5).strip() == 'second'
+
+
+def test_iter_output_has_its_own_cursor(pool):
+    ssh = _shell(pool)
+    ssh.send('echo one; echo two')
+    assert ssh.expect('two', total_timeout=5)[1]
+    ## expect consumed the output, iter_output still sees it from the start of the buffer
+    assert ''.join(ssh.iter_output(from_start=True, timeout=0.2)) == 'one\ntwo\n'
+
+
+def test_ring_buffer_drops_old_output(pool):
+    ssh = _shell(pool, buffer_size=1000)
+    ssh.send("head -c 5000 /dev/zero | tr '\\0' x; echo; echo END")
+    out, success = ssh.expect('END', total_timeout=5)
+    assert success
+    assert len(ssh._buf) <= 1000 and ssh._buf_end >= 5000
+    assert len(out) < 1000
+
+
+def test_expect_stops_when_the_shell_exits(pool):
+    ssh = _shell(pool)
+    ssh.send('exit')
+    t_start = time.time()
+    out, success = ssh.expect('never printed', total_timeout=10)
+    assert not success and time.time() - t_start < 5
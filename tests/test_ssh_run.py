@@ -0,0 +1,28 @@
+import time
+
+
+def test_run(pool):
+    ssh = pool.ssh('127.0.0.1', open_shell=False, verbose=False)
+    result = ssh.run('echo out; echo err >&2; exit 3', timeout=10)
+    assert (result.exit_code, result.stdout, result.stderr) == (3, 'out\n', 'err\n')
+    assert ssh.run("echo 'a b'", login_shell=True).stdout == 'a b\n'
+
+
+def test_timeout_stops_the_remote_command(pool, tmp_path):
+    ssh = pool.ssh('127.0.0.1', open_shell=False, verbose=False)
+    path_marker = tmp_path / 'marker'
+    ## prints nothing, so it is not stopped by a write to the closed channel
+    result = ssh.run(f'sleep 2.5; touch {path_marker}', timeout=0.3)
+    assert result.exit_code is None
+    time.sleep(3)
+    assert not path_marker.exists()
+
+
+def test_run_iter_closes_channel_when_stopped_early(pool):
+    ssh = pool.ssh('127.0.0.1', open_shell=False, verbose=False)
+    n_channels = len(ssh.transport._channels.values())
+    gen = ssh.run_iter('echo first; sleep 5')
+    assert next(gen) == ('stdout', 'first\n')
+    gen.close()
+    time.sleep(0.2)
+    assert len(ssh.transport._channels.values()) == n_channels
@@ -0,0 +1,67 @@
+import threading
+import time
+
+import pytest
+
+import staging
+
+
+def _write_slowly(path, n_chunks, chunk=b'x' * 1000, pause=0.02):
+    with open(path, 'wb') as f:
+        for _ in range(n_chunks):
+            f.write(chunk)
+            f.flush()
+            time.sleep(pause)
+
+
+def test_files_arriving_before_the_marker(tmp_path):
+    dir_src, dir_dst = tmp_path / 'src', tmp_path / 'dst'
+    dir_src.mkdir()
+    path_marker = tmp_path / 'copy_done'
+    (dir_src / 'a.tif').write_bytes(b'a' * 100)
+
+    def _upstream():
+        _write_slowly(dir_src / 'b.tiff', n_chunks=20)
+        time.sleep(0.2)
+        _write_slowly(dir_src / 'c.tif', n_chunks=5)
+        (dir_src / 'notes.txt').write_text('not an input')
+        path_marker.write_text('')
+    thread = threading.Thread(target=_upstream)
+    thread.start()
+    staged = staging.stage_inputs(dir_src, dir_dst, path_marker=path_marker, workers=2, interval=0.1, timeout=30, verbose=False)
+    thread.join()
+
+    assert staged == sorted([dir_dst / 'a.tif', dir_dst / 'b.tiff', dir_dst / 'c.tif'])
+    for path in staged:
+        assert path.read_bytes() == (dir_src / path.relative_to(dir_dst)).read_bytes()
+    assert not (dir_dst / 'notes.txt').exists()
+
+
+def test_several_source_dirs_and_settle(tmp_path):
+    dirs_src = [tmp_path / 'src0', tmp_path / 'src1']
+    for dir_src in dirs_src:
+        dir_src.mkdir()
+        (dir_src / 'a.tif').write_bytes(dir_src.name.encode())
+    staged = staging.stage_inputs([str(d) for d in dirs_src], tmp_path / 'dst', interval=0.05, settle_s=0.2, timeout=30, verbose=False)
+    assert staged == [tmp_path / 'dst' / 'src0' / 'a.tif', tmp_path / 'dst' / 'src1' / 'a.tif']
+    assert staged[1].read_bytes() == b'src1'
+
+
+def test_missing_marker_times_out(tmp_path):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'a.tif').write_bytes(b'a')
+    with pytest.raises(TimeoutError):
+        staging.stage_inputs(tmp_path / 'src', tmp_path / 'dst', path_marker=tmp_path / 'never', interval=0.05, timeout=0.5, verbose=False)
+
+
+def test_copy_back(tmp_path):
+    dir_src, dir_dst = tmp_path / 'save', tmp_path / 'dir_save'
+    (dir_src / 'suite2p' / 'plane0').mkdir(parents=True)
+    (dir_src / 'suite2p' / 'plane0' / 'F.npy').write_bytes(b'f' * 300)
+    (dir_src / 'log.txt').write_text('new')
+    dir_dst.mkdir()
+    (dir_dst / 'log.txt').write_text('old log')
+
+    assert staging.copy_back(dir_src, dir_dst, workers=2, verbose=False) == 303
+    assert (dir_dst / 'suite2p' / 'plane0' / 'F.npy').read_bytes() == b'f' * 300
+    assert (dir_dst / 'log.txt').read_text() == 'new'
@@ -0,0 +1,47 @@
+import sweep
+
+
+PARAMS_TEMPLATE = {'ops': {'threshold_scaling': 1.0, 'diameter': 12, 'spatial_scale': 0}, 'name': 'x'}
+
+
+def test_empty_sweep_is_the_template():
+    assert sweep.expand_sweep(PARAMS_TEMPLATE) == [PARAMS_TEMPLATE]
+    assert sweep.expand_sweep(PARAMS_TEMPLATE, {}) == [PARAMS_TEMPLATE]
+
+
+def test_grid_order_and_template_untouched():
+    params_all = sweep.expand_sweep(PARAMS_TEMPLATE, {'ops.threshold_scaling': [0.5, 1.0], 'ops.diameter': [8, 16]})
+    assert [(p['ops']['threshold_scaling'], p['ops']['diameter']) for p in params_all] == [(0.5, 8), (0.5, 16), (1.0, 8), (1.0, 16)]
+    assert PARAMS_TEMPLATE['ops']['diameter'] == 12
+    params_all[0]['ops']['diameter'] = -1
+    assert params_all[1]['ops']['diameter'] == 16
+
+
+def test_tied_keys_and_union_deduplicated():
+    spec = [
+        {('ops.diameter', 'ops.spatial_scale'): [(10, 1), (16, 2)]},
+        {'ops.diameter': [10], 'ops.spatial_scale': [1]},  ## same as the first set
+        {'new.key': [3]},
+    ]
+    params_all = sweep.expand_sweep(PARAMS_TEMPLATE, spec)
+    assert len(params_all) == 3
+    assert [(p['ops']['diameter'], p['ops']['spatial_scale']) for p in params_all[:2]] == [(10, 1), (16, 2)]
+    assert params_all[2]['new'] == {'key': 3}
+
+
+def test_find_changing_params():
+    spec = {'ops.threshold_scaling': [1.0], 'ops.diameter': [8, 16]}
+    params_all = sweep.expand_sweep(PARAMS_TEMPLATE, spec)
+    assert sweep.find_changing_params(params_all, spec) == [{'ops.diameter': 8}, {'ops.diameter': 16}]
+    assert sweep.find_changing_params(params_all) == [{}, {}]
+
+
+def test_select_task_params():
+    params_all = sweep.expand_sweep(PARAMS_TEMPLATE, {'ops.diameter': [8, 16]})
+    assert sweep.select_task_params({'params': params_all}, '1') == params_all[1]
+    assert sweep.select_task_params(PARAMS_TEMPLATE) == PARAMS_TEMPLATE
+
+
+def test_get_nested_default():
+    assert sweep.get_nested(PARAMS_TEMPLATE, 'ops.diameter') == 12
+    assert sweep.get_nested(PARAMS_TEMPLATE, ['name', 'deeper'], default='d') == 'd'
@@ -0,0 +1,111 @@
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import sweep_summary
+import util
+
+
+def _write_log(path, n_started, n_finished):
+    lines = []
+    for i in range(n_started):
+        lines.append(f'BATCH RUN STARTED. stage: all. time: Mon Oct 12 10:0{i}:00 2026')
+    for i in range(n_finished):
+        lines.append(f'BATCH RUN FINISHED. time: Mon Oct 12 11:0{i}:30 2026')
+    path.write_text('\n'.join(lines))
+
+
+def _write_plane(dir_plane, npix, iscell, xoff=(0, 3), yoff=(0, 4)):
+    dir_plane.mkdir(parents=True)
+    stats = np.array([{'ypix': np.arange(n), 'xpix': np.arange(n), 'npix': n} for n in npix], dtype=object)
+    np.save(dir_plane / 'stat.npy', stats, allow_pickle=True)
+    np.save(dir_plane / 'iscell.npy', np.stack([np.array(iscell, dtype=np.float64), np.ones(len(iscell))], axis=1))
+    np.save(dir_plane / 'ops.npy', {'xoff': np.array(xoff), 'yoff': np.array(yoff), 'corrXY': np.array([0.5, 0.7])}, allow_pickle=True)
+
+
+def _make_sweep(dir_save):
+    ## jobNum_0: two planes, finished
+    dir_job = dir_save / 'jobNum_0'
+    _write_plane(dir_job / 'suite2p' / 'plane0', npix=[10, 20, 30], iscell=[1, 0, 1])
+    _write_plane(dir_job / 'suite2p' / 'plane1', npix=[40], iscell=[1])
+    _write_log(dir_job / 'log.txt', n_started=1, n_finished=1)
+    (dir_job / 'profile.jsonl').write_text(
+        json.dumps({'stage': 'convert', 'wall_s': 10.0, 'peak_rss_GB': 2.0}) + '\n'
+        + json.dumps({'stage': 'plane', 'wall_s': 20.5, 'peak_rss_GB': 3.5, 'status': 'failed'}) + '\n'
+        + 'not json\n'
+    )
+    ## jobNum_1: still running
+    dir_job = dir_save / 'jobNum_1'
+    dir_job.mkdir(parents=True)
+    _write_log(dir_job / 'log.txt', n_started=1, n_finished=0)
+    ## jobNum_2: a broken iscell.npy
+    dir_job = dir_save / 'jobNum_2'
+    _write_plane(dir_job / 'suite2p' / 'plane0', npix=[5], iscell=[1])
+    (dir_job / 'suite2p' / 'plane0' / 'iscell.npy').write_bytes(b'broken')
+    _write_log(dir_job / 'log.txt', n_started=1, n_finished=1)
+    (dir_save / 'not_a_job').mkdir()
+    with open(dir_save / 'parameters_batch.json', 'w') as f:
+        json.dump({'params_changing': [{'ops.diameter': 8}, {'ops.diameter': 12}, {'ops.diameter': 16}]}, f)
+
+
+def test_summarize_job(tmp_path):
+    _make_sweep(tmp_path)
+    row = sweep_summary.summarize_job(tmp_path / 'jobNum_0')
+    assert (row['status'], row['n_planes'], row['n_rois'], row['n_cells'], row['cell_fraction']) == ('complete', 2, 4, 3, 0.75)
+    assert (row['npix_mean'], row['npix_median'], row['npix_median_cells']) == (25.0, 25.0, 30.0)
+    assert (row['n_frames'], row['reg_offset_max_px'], row['reg_corrXY_mean']) == (2, 5.0, 0.6)
+    assert (row['runtime_s'], row['n_runs']) == (3630.0, 1)
+    assert (row['wall_s_profile'], row['peak_rss_GB'], row['n_stages_failed']) == (30.5, 3.5, 1)
+
+    row = sweep_summary.summarize_job(tmp_path / 'jobNum_1')
+    assert (row['status'], row['runtime_s'], row['n_planes']) == ('incomplete', None, 0)
+    row = sweep_summary.summarize_job(tmp_path / 'jobNum_2')
+    assert row['status'] == 'incomplete' and row['error'] is not None
+
+
+def test_summarize_sweep_caches_rows(tmp_path):
+    _make_sweep(tmp_path)
+    summary = sweep_summary.summarize_sweep(tmp_path, workers=2)
+    assert (summary['n_jobs'], summary['n_computed'], summary['n_complete']) == (3, 3, 1)
+    assert [job for job, _ in summary['errors']] == ['jobNum_2']
+
+    with open(summary['path_table'], newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [r['job'] for r in rows] == ['jobNum_0', 'jobNum_1', 'jobNum_2']
+    assert [r['param.ops.diameter'] for r in rows] == ['8', '12', '16']
+    assert rows[1]['n_rois'] == ''
+
+    summary = sweep_summary.summarize_sweep(tmp_path, workers=2)
+    assert (summary['n_computed'], summary['n_cached']) == (0, 3)
+
+    ## a cell curated in the GUI: only that job is read again
+    path_iscell = tmp_path / 'jobNum_0' / 'suite2p' / 'plane1' / 'iscell.npy'
+    np.save(path_iscell, np.array([[0.0, 1.0]]))
+    t = time.time() + 5
+    os.utime(path_iscell, (t, t))
+    summary = sweep_summary.summarize_sweep(tmp_path, workers=2)
+    assert (summary['n_computed'], summary['n_cached']) == (1, 2)
+    with open(summary['path_table'], newline='') as f:
+        assert next(csv.DictReader(f))['n_cells'] == '2'
+
+
+def test_summarize_sweep_over_ssh(pool, tmp_path):
+    _make_sweep(tmp_path / 'remote')
+    summary = util.summarize_sweep(
+        pool.ssh('127.0.0.1', open_shell=False, verbose=False),
+        str(tmp_path / 'remote'),
+        sftp=pool.sftp('127.0.0.1'),
+        path_local=str(tmp_path / 'local' / 'sweep_summary.csv'),
+        workers=2,
+        timeout=60,
+        cmd_python=sys.executable,
+        login_shell=False,
+        verbose=False,
+    )
+    assert (summary['n_jobs'], summary['n_complete']) == (3, 1)
+    with open(tmp_path / 'local' / 'sweep_summary.csv', newline='') as f:
+        assert [r['status'] for r in csv.DictReader(f)] == ['complete', 'incomplete', 'incomplete']
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+import util
+
+
+def _make_source(dir_src, data):
+    dir_src.mkdir()
+    (dir_src / 'a.bin').write_bytes(data)
+    os.utime(dir_src / 'a.bin', (1_000_000, 1_000_000))
+
+
+def test_complete_shorter_file_is_not_appended_to(pool, tmp_path):
+    data = os.urandom(300_000)
+    _make_source(tmp_path / 'src', data)
+    ## an older, shorter version that was uploaded in full
+    (tmp_path / 'dst').mkdir()
+    (tmp_path / 'dst' / 'a.bin').write_bytes(b'old version')
+
+    sftp = pool.sftp('127.0.0.1')
+    report = sftp.sync_dir(tmp_path / 'src', str(tmp_path / 'dst'), verbose=False)
+    assert report['upload'] == ['a.bin'] and report['resume'] == []
+    assert (tmp_path / 'dst' / 'a.bin').read_bytes() == data
+    assert int(os.stat(tmp_path / 'dst' / 'a.bin').st_mtime) == 1_000_000
+
+
+@pytest.mark.parametrize('hash_type', [None, 'blake2b'])
+def test_partial_upload_is_resumed(pool, tmp_path, hash_type):
+    data = os.urandom(300_000)
+    _make_source(tmp_path / 'src', data)
+    (tmp_path / 'dst').mkdir()
+    (tmp_path / 'dst' / ('a.bin' + util.suffix_partial)).write_bytes(data[:100_000])
+
+    sftp = pool.sftp('127.0.0.1')
+    report = sftp.sync_dir(tmp_path / 'src', str(tmp_path / 'dst'), hash_type=hash_type, path_manifest=tmp_path / 'manifest.json', verbose=False)
+    assert report['resume'] == ['a.bin']
+    assert report['n_bytes'] == 200_000
+    assert (tmp_path / 'dst' / 'a.bin').read_bytes() == data
+    assert not (tmp_path / 'dst' / ('a.bin' + util.suffix_partial)).exists()
+
+
+def test_corrupt_partial_is_not_finalized(pool, tmp_path):
+    data = os.urandom(300_000)
+    _make_source(tmp_path / 'src', data)
+    (tmp_path / 'dst').mkdir()
+    (tmp_path / 'dst' / ('a.bin' + util.suffix_partial)).write_bytes(os.urandom(100_000))
+
+    sftp = pool.sftp('127.0.0.1')
+    kwargs = dict(hash_type='blake2b', path_manifest=tmp_path / 'manifest.json', verbose=False)
+    with pytest.raises(IOError, match='mismatch'):
+        sftp.sync_dir(tmp_path / 'src', str(tmp_path / 'dst'), **kwargs)
+    ## nothing under the real name, and the bad partial file is gone
+    assert not (tmp_path / 'dst' / 'a.bin').exists()
+    assert not (tmp_path / 'dst' / ('a.bin' + util.suffix_partial)).exists()
+
+    report = sftp.sync_dir(tmp_path / 'src', str(tmp_path / 'dst'), **kwargs)
+    assert report['upload'] == ['a.bin']
+    assert (tmp_path / 'dst' / 'a.bin').read_bytes() == data
+    report = sftp.sync_dir(tmp_path / 'src', str(tmp_path / 'dst'), **kwargs)
+    assert report['skip'] == ['a.bin']
+
+
+def test_missing_target_uploads_everything(pool, tmp_path):
+    data = os.urandom(1000)
+    _make_source(tmp_path / 'src', data)
+    sftp = pool.sftp('127.0.0.1')
+    report = sftp.sync_dir(tmp_path / 'src', str(tmp_path / 'new' / 'dst'), verbose=False)
+    assert report['upload'] == ['a.bin']
+    assert (tmp_path / 'new' / 'dst' / 'a.bin').read_bytes() == data
+
+
+def test_listing_failure_is_raised_not_reuploaded(pool, tmp_path, monkeypatch):
+    data = os.urandom(1000)
+    _make_source(tmp_path / 'src', data)
+    (tmp_path / 'src' / 'sub').mkdir()
+    (tmp_path / 'src' / 'sub' / 'b.bin').write_bytes(data)
+    sftp = pool.sftp('127.0.0.1')
+    sftp.sync_dir(tmp_path / 'src', str(tmp_path / 'dst'), verbose=False)
+
+    listdir_attr = sftp.listdir_attr
+    def _listdir_attr(path, sftp=None):
+        if path.endswith('/sub'):
+            raise IOError(13, 'Permission denied')
+        return listdir_attr(path, sftp=sftp)
+    monkeypatch.setattr(sftp, 'listdir_attr', _listdir_attr)
+
+    with pytest.raises(IOError, match='sub'):
+        sftp.sync_dir(tmp_path / 'src', str(tmp_path / 'dst'), verbose=False)
@@ -0,0 +1,72 @@
+import os
+import shutil
+
+import pytest
+
+
+def _make_tree(dir_root):
+    files = {
+        'a.txt': b'hello',
+        'sub/b.bin': os.urandom(200_000),
+        'sub/deeper/c.npy': os.urandom(1000),
+        'empty.txt': b'',
+    }
+    for path_rel, data in files.items():
+        (dir_root / path_rel).parent.mkdir(parents=True, exist_ok=True)
+        (dir_root / path_rel).write_bytes(data)
+    return files
+
+
+def _compressions():
+    out = [None, 'gzip']
+    try:
+        import zstandard
+        if shutil.which('zstd') is not None:
+            out.append('zstd')
+    except ImportError:
+        pass
+    return out
+
+
+@pytest.mark.parametrize('compression', _compressions())
+def test_round_trip(pool, tmp_path, compression):
+    files = _make_tree(tmp_path / 'src')
+    sftp = pool.sftp('127.0.0.1')
+
+    summary = sftp.put_dir_tar(tmp_path / 'src', str(tmp_path / 'remote' / 'dst'), compression=compression, fallback=False, verbose=False)
+    assert summary['method'] == 'tar' and summary['n_bytes'] > 0
+    summary = sftp.get_dir_tar(str(tmp_path / 'remote' / 'dst'), tmp_path / 'back', compression=compression, fallback=False, verbose=False)
+    assert summary['method'] == 'tar'
+
+    for path_rel, data in files.items():
+        assert (tmp_path / 'remote' / 'dst' / path_rel).read_bytes() == data
+        assert (tmp_path / 'back' / path_rel).read_bytes() == data
+
+
+def test_get_missing_directory_raises_ioerror(pool, tmp_path):
+    sftp = pool.sftp('127.0.0.1')
+    with pytest.raises(IOError, match='exit status'):
+        sftp.get_dir_tar(str(tmp_path / 'missing'), tmp_path / 'back', compression='gzip', fallback=False, verbose=False)
+
+
+def test_get_corrupt_stream_raises_ioerror(pool, tmp_path, monkeypatch):
+    pytest.importorskip('zstandard')
+    _make_tree(tmp_path / 'src')
+    ## a 'zstd' on the remote that sends something that is not zstd, and exits 0
+    dir_bin = tmp_path / 'bin'
+    dir_bin.mkdir()
+    (dir_bin / 'zstd').write_text('#!/bin/bash\ncat > /dev/null\necho not a zstd frame\n')
+    (dir_bin / 'zstd').chmod(0o755)
+    monkeypatch.setenv('PATH', f"{dir_bin}:{os.environ['PATH']}")
+
+    sftp = pool.sftp('127.0.0.1')
+    with pytest.raises(IOError, match='ZstdError|Error'):
+        sftp.get_dir_tar(str(tmp_path / 'src'), tmp_path / 'back', compression='zstd', fallback=False, verbose=False)
+
+
+def test_put_failing_remote_raises_ioerror(pool, tmp_path):
+    _make_tree(tmp_path / 'src')
+    (tmp_path / 'not_a_dir').write_bytes(b'')
+    sftp = pool.sftp('127.0.0.1')
+    with pytest.raises(IOError, match='exit status'):
+        sftp.put_dir_tar(tmp_path / 'src', str(tmp_path / 'not_a_dir' / 'dst'), compression='gzip', fallback=False, verbose=False)
@@ -0,0 +1,53 @@
+from pathlib import PurePath
+
+import paramiko
+import pytest
+
+
+def _make_tree(dir_root):
+    for path_rel in ['a.txt', 'sub/b.txt', 'sub/deeper/c.txt', 'other/d.txt']:
+        (dir_root / path_rel).parent.mkdir(parents=True, exist_ok=True)
+        (dir_root / path_rel).write_bytes(b'x' * len(path_rel))
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_walk(pool, tmp_path, workers):
+    _make_tree(tmp_path / 'root')
+    sftp = pool.sftp('127.0.0.1')
+    entries = sftp.walk_remote(str(tmp_path / 'root'), workers=workers)
+    paths = [PurePath(e.path).relative_to(tmp_path / 'root').as_posix() for e in entries]
+    assert paths == sorted(['a.txt', 'other', 'other/d.txt', 'sub', 'sub/b.txt', 'sub/deeper', 'sub/deeper/c.txt'])
+    assert {PurePath(e.path).name: e.size for e in entries if not e.is_dir}['c.txt'] == len('sub/deeper/c.txt')
+    assert sftp.search_recursive(str(tmp_path / 'root'), search_pattern_re=r'^[bc]\.txt$', verbose=False, workers=workers) == [
+        str(tmp_path / 'root' / 'sub' / 'b.txt'), str(tmp_path / 'root' / 'sub' / 'deeper' / 'c.txt'),
+    ]
+
+
+@pytest.mark.parametrize('error', [paramiko.SSHException('channel closed'), EOFError()])
+@pytest.mark.parametrize('workers', [1, 3])
+def test_non_ioerror_is_raised_instead_of_hanging(pool, tmp_path, monkeypatch, workers, error):
+    _make_tree(tmp_path / 'root')
+    sftp = pool.sftp('127.0.0.1')
+    listdir_attr = sftp.listdir_attr
+
+    def _listdir_attr(path, sftp=None):
+        if path.endswith('/sub'):
+            raise error
+        return listdir_attr(path, sftp=sftp)
+    monkeypatch.setattr(sftp, 'listdir_attr', _listdir_attr)
+
+    with pytest.raises(IOError, match='sub'):
+        sftp.walk_remote(str(tmp_path / 'root'), workers=workers)
+
+
+def test_second_walk_is_served_from_the_cache(pool, tmp_path):
+    _make_tree(tmp_path / 'root')
+    sftp = pool.sftp('127.0.0.1', cache_ttl=60)
+    n_calls = []
+    listdir_attr = sftp.sftp.listdir_attr
+    sftp.sftp.listdir_attr = lambda path: n_calls.append(path) or listdir_attr(path)
+
+    entries = sftp.walk_remote(str(tmp_path / 'root'))
+    assert len(n_calls) == 4
+    assert sftp.walk_remote(str(tmp_path / 'root')) == entries
+    assert len(n_calls) == 4
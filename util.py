@@ -1,9 +1,34 @@
 import paramiko
 import time
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import os
 import stat
 import re
+import threading
+import queue
+import socket
+import base64
+import codecs
+import errno
+import shlex
+from collections import namedtuple, OrderedDict
+
+## slurm time / memory parsers are shared with the remote side scripts (resources.py only needs the standard library)
+try:
+    from .resources import parse_slurm_time, parse_slurm_mem
+except ImportError:
+    from resources import parse_slurm_time, parse_slurm_mem
+
+command_result = namedtuple('command_result', ['cmd', 'exit_code', 'stdout', 'stderr', 'time'])
+command_result.__doc__ = """
+Result of a non-interactive command.
+See ssh_interface.run.
+    cmd (str): The command that was run.
+    exit_code (int): Exit status of the command. None if it timed out.
+    stdout (str): Everything the command wrote to stdout.
+    stderr (str): Everything the command wrote to stderr.
+    time (float): Wall time in seconds.
+"""
 
 class ssh_interface():
     """
@@ -17,24 +42,56 @@ class ssh_interface():
         nbytes_toReceive=4096,
         recv_timeout=1,
         verbose=True,
+        buffer_size=2**22,
+        transport=None,
+        open_shell=True,
     ):
         """
         Args:
             nbytes_toReceive (int):
-                Number of bytes to receive at a time.
-                Caps the maximum message it can receive.
+                Number of bytes the background reader
+                 pulls from the channel at a time.
             recv_timeout (int):
                 Timeout for receiving data.
             verbose (bool):
                 Whether or not to print progress
+            buffer_size (int):
+                Maximum number of characters of output kept
+                 in the ring buffer. Older output is dropped.
+            transport (paramiko.Transport):
+                An already authenticated transport, eg from
+                 connection_pool. If given, connect is not
+                 needed and the transport is not closed by
+                 self.close.
+            open_shell (bool):
+                Only used if transport is given.
+                Whether or not to open an interactive shell.
+                Not needed if only self.run is used.
         """
         
         self.nbytes = nbytes_toReceive
         self.recv_timeout = recv_timeout
         self.verbose=verbose
+        self.buffer_size = buffer_size
         
         self.client = paramiko.SSHClient()
         self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.transport = transport
+
+        ## ring buffer of received output. Positions are absolute
+        ##  (number of characters received since connecting).
+        self._buf = ''
+        self._buf_start = 0
+        self._cursor = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._reader = None
+
+        if transport is not None and open_shell:
+            self.ssh = transport.open_session()
+            self.ssh.get_pty()
+            self.ssh.invoke_shell()
+            self._start_reader()
     
     def connect(
         self,
@@ -58,7 +115,52 @@ class ssh_interface():
                 sftp is always port 22.
         """
         self.client.connect(hostname=hostname, username=username, password=password, port=port, look_for_keys=False, allow_agent=False)
+        self.transport = self.client.get_transport()
         self.ssh = self.client.invoke_shell()
+        self._start_reader()
+
+    def _start_reader(self):
+        """
+        Start the background thread that drains the shell channel
+         into the ring buffer and wakes up anyone waiting on output.
+        """
+        self._buf, self._buf_start, self._cursor, self._closed = '', 0, 0, False
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        def _read():
+            self.ssh.settimeout(None)
+            while True:
+                try:
+                    data = self.ssh.recv(self.nbytes)
+                except (socket.error, EOFError):
+                    data = b''
+                with self._cond:
+                    if len(data) == 0:
+                        self._closed = True
+                        self._cond.notify_all()
+                        return
+                    self._buf += decoder.decode(data)
+                    n_over = len(self._buf) - self.buffer_size
+                    if n_over > 0:
+                        self._buf = self._buf[n_over:]
+                        self._buf_start += n_over
+                    self._cond.notify_all()
+
+        self._reader = threading.Thread(target=_read, daemon=True)
+        self._reader.start()
+
+    @property
+    def _buf_end(self):
+        return self._buf_start + len(self._buf)
+
+    def _read_buffer(self, start, end=None):
+        """
+        Return buffered output between absolute positions start and end.
+        Must be called while holding self._cond.
+        """
+        end = self._buf_end if end is None else end
+        start = max(start, self._buf_start)
+        return self._buf[start - self._buf_start : end - self._buf_start]
 
     def send(self, cmd='ls', append_enter=True):
         """
@@ -78,6 +180,9 @@ class ssh_interface():
     def receive(self, timeout=None, verbose=None):
         """
         Receive data from the remote server.
+        Returns all output that arrived since the last call to
+         receive or expect. Waits up to timeout for new output.
+        Raises socket.timeout if nothing arrives.
         Args:
             timeout (int):
                 Timeout for receiving data.
@@ -87,9 +192,13 @@ class ssh_interface():
         """
         if timeout is None:
             timeout = self.recv_timeout
-        self.ssh.settimeout(timeout)
         
-        out = self.ssh.recv(self.nbytes).decode('utf-8')
+        with self._cond:
+            self._cond.wait_for(lambda: (self._buf_end > self._cursor) or self._closed, timeout=timeout)
+            if self._buf_end <= self._cursor:
+                raise socket.timeout('nothing received')
+            out = self._read_buffer(self._cursor)
+            self._cursor = self._buf_end
         if verbose is None:
             verbose=self.verbose
         if verbose:
@@ -135,21 +244,25 @@ class ssh_interface():
         total_timeout=60,
         sleep_time = 0.1,
         verbose=None,
+        regex=False,
     ):
         """
         Wait for a string to appear in the output.
+        Matches over all output accumulated since the last call to
+         receive or expect, so a string split across several reads
+         is still found. Wakes up as soon as new output arrives.
         Args:
             str_success (str):
                 String to wait for.
             partial_match (bool):
                 Whether or not to allow a partial match.
             recv_timeout (float):
-                Timeout for receiving data per 
-                 check iteration.
+                Unused. Kept for compatibility; output is read
+                 by a background thread.
             total_timeout (float):
                 Total time to wait for the string.
             sleep_time (float):
-                Time to sleep between checks.
+                Maximum time to block between checks.
                 Allows for keyboard interrupts.
             verbose (bool):
                 Whether or not to print progress.
@@ -157,37 +270,55 @@ class ssh_interface():
                 1/True: will print recv outputs.
                 2: will print expect progress.
                 None: will default to self.verbose (1 or 2).
+            regex (bool):
+                If True, str_success is a regular expression
+                 searched for (partial_match) or fully matched.
+
+        Returns:
+            out (str):
+                Output consumed while waiting. On success, up to
+                 and including the match.
+            success (bool):
+                Whether or not the string was found.
         """
         t_start = time.time()
         
-        if recv_timeout is None:
-            recv_timeout = self.recv_timeout
         if verbose is None:
             verbose = self.verbose
-            
+
+        pattern = re.compile(str_success if regex else re.escape(str_success))
+        def _find(text):
+            if partial_match:
+                return pattern.search(text)
+            return pattern.fullmatch(text)
+
         success = False
-        out=''
-        while success is False:
-            if verbose==2:
-                print(f'=== expecting, t={time.time() - t_start} ===')
-            
-            try:
-                out = self.receive(timeout=recv_timeout, verbose=verbose>0)
-            except:
+        out = ''
+        with self._cond:
+            ## read under the lock, like every other use of the cursor and the buffer
+            pos_printed = self._cursor
+            while True:
                 if verbose==2:
-                    print("expect: nothing received")
-                    
-            if partial_match:
-                if str_success in out:
-                    success = True
-            else:
-                if str_success == out:
+                    print(f'=== expecting, t={time.time() - t_start} ===')
+                out = self._read_buffer(self._cursor)
+                if verbose:
+                    print(self._read_buffer(pos_printed), end='')
+                    pos_printed = self._buf_end
+                match = _find(out)
+                if match is not None:
                     success = True
-            
-            time.sleep(sleep_time)
+                    out = out[:match.end()]
+                    self._cursor = max(self._cursor, self._buf_start) + match.end()
+                    break
 
-            if time.time() - t_start > total_timeout:
-                break
+                t_left = total_timeout - (time.time() - t_start)
+                if t_left <= 0 or self._closed:
+                    self._cursor = self._buf_end
+                    break
+                n_seen = self._buf_end
+                self._cond.wait_for(lambda: (self._buf_end > n_seen) or self._closed, timeout=min(sleep_time, t_left))
+        if verbose:
+            print('')
         
         if verbose==2:
             if success:
@@ -196,12 +327,201 @@ class ssh_interface():
                 print(f'expect failed')
                 
         return out, success
+
+    def iter_output(self, from_start=False, timeout=None):
+        """
+        Iterate over the shell output as it arrives.
+        Uses its own cursor, so it does not consume output
+         from receive or expect.
+        Args:
+            from_start (bool):
+                If True, starts at the oldest output still in
+                 the buffer. If False, starts at new output.
+            timeout (float):
+                Stop after this many seconds without new output.
+                If None, only stops when the channel closes.
+
+        Yields:
+            str:
+                Chunks of output in the order they arrived.
+        """
+        with self._cond:
+            pos = self._buf_start if from_start else self._buf_end
+        while True:
+            with self._cond:
+                arrived = self._cond.wait_for(lambda: (self._buf_end > pos) or self._closed, timeout=timeout)
+                chunk = self._read_buffer(pos)
+                pos = self._buf_end
+                closed = self._closed
+            if len(chunk) > 0:
+                yield chunk
+            elif closed or not arrived:
+                return
         
+    def run(
+        self,
+        cmd,
+        timeout=None,
+        login_shell=False,
+        check=False,
+        verbose=None,
+    ):
+        """
+        Run a command non-interactively on its own exec channel.
+        Unlike send/expect, nothing is scraped from the shell:
+         stdout, stderr and the exit code come back separately.
+        Uses the transport that was authenticated by connect /
+         o2_connect, so no new login (or Duo push) is needed.
+        Args:
+            cmd (str):
+                Command to run.
+            timeout (float):
+                Seconds to wait for the command to finish.
+                If None, waits forever. On timeout, the channel
+                 is closed and exit_code is None. Closing the
+                 channel does not stop the remote command, so it
+                 is also run under the remote 'timeout', which
+                 kills it a second later.
+            login_shell (bool):
+                If True, runs the command in 'bash -lc' so that
+                 login files (module, conda) are loaded.
+            check (bool):
+                If True, raises RuntimeError on a non-zero exit code.
+            verbose (bool):
+                Whether or not to print stdout and stderr.
+                None: will default to self.verbose.
+
+        Returns:
+            command_result:
+                (cmd, exit_code, stdout, stderr, time)
+        """
+        out = {'stdout': [], 'stderr': []}
+        exit_code = None
+        t_start = time.time()
+        for name, text in self.run_iter(cmd, timeout=timeout, login_shell=login_shell, verbose=verbose):
+            if name == 'exit_code':
+                exit_code = text
+            else:
+                out[name].append(text)
+        result = command_result(cmd, exit_code, ''.join(out['stdout']), ''.join(out['stderr']), time.time() - t_start)
+        if check and result.exit_code != 0:
+            raise RuntimeError(f'command failed with exit code {result.exit_code}: {cmd}\n{result.stderr}')
+        return result
+
+    def run_iter(
+        self,
+        cmd,
+        timeout=None,
+        login_shell=False,
+        verbose=None,
+    ):
+        """
+        Run a command non-interactively and stream its output.
+        See self.run.
+        Args:
+            cmd (str):
+                Command to run.
+            timeout (float):
+                Seconds to wait for the command to finish.
+            login_shell (bool):
+                If True, runs the command in 'bash -lc'.
+            verbose (bool):
+                Whether or not to print output as it arrives.
+
+        Yields:
+            (str, str or int):
+                ('stdout', text) or ('stderr', text) as output arrives.
+                The last item is ('exit_code', int or None).
+        """
+        if verbose is None:
+            verbose = self.verbose
+        if login_shell:
+            cmd = f"bash -lc {shlex.quote(cmd)}"
+        if timeout is not None:
+            ## the remote side stops the command (and its children) a bit after
+            ##  the local timeout, since closing an exec channel does not
+            cmd = f"timeout --kill-after=10 {timeout + 1:g} bash -c {shlex.quote(cmd)}"
+
+        chan = self.transport.open_session()
+        try:
+            chan.settimeout(0.1)
+            chan.exec_command(cmd)
+            decoders = {name: codecs.getincrementaldecoder('utf-8')(errors='replace') for name in ['stdout', 'stderr']}
+            t_start = time.time()
+            timed_out = False
+            while True:
+                got = False
+                for name, ready, recv in [('stdout', chan.recv_ready, chan.recv), ('stderr', chan.recv_stderr_ready, chan.recv_stderr)]:
+                    if ready():
+                        text = decoders[name].decode(recv(self.nbytes))
+                        got = True
+                        if len(text) > 0:
+                            if verbose:
+                                print(text, end='')
+                            yield name, text
+                if got:
+                    continue
+                if chan.exit_status_ready() and not (chan.recv_ready() or chan.recv_stderr_ready()):
+                    break
+                if timeout is not None and (time.time() - t_start) > timeout:
+                    timed_out = True
+                    break
+                if not chan.closed:
+                    chan.status_event.wait(0.05)
+                else:
+                    time.sleep(0.01)
+            exit_code = None if timed_out else chan.recv_exit_status()
+        finally:
+            ## also when the caller stops iterating early
+            chan.close()
+        yield 'exit_code', exit_code
+
+    def run_many(
+        self,
+        cmds,
+        max_concurrent=8,
+        timeout=None,
+        login_shell=False,
+        verbose=None,
+    ):
+        """
+        Run several commands at once, each on its own exec channel
+         of the same authenticated transport.
+        Args:
+            cmds (list of str):
+                Commands to run.
+            max_concurrent (int):
+                Maximum number of commands running at once.
+            timeout (float):
+                Seconds to wait for each command to finish.
+            login_shell (bool):
+                If True, runs each command in 'bash -lc'.
+            verbose (bool):
+                Whether or not to print each result as it finishes.
+
+        Returns:
+            list of command_result:
+                In the same order as cmds.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        if verbose is None:
+            verbose = self.verbose
+
+        def _run(cmd):
+            result = self.run(cmd, timeout=timeout, login_shell=login_shell, verbose=False)
+            if verbose:
+                print(f'[exit {result.exit_code}, {result.time:.1f} s] {cmd}')
+            return result
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrent, len(cmds)))) as pool:
+            return list(pool.map(_run, cmds))
+
     def close(self):
-        self.ssh.close()
+        if getattr(self, 'ssh', None) is not None:
+            self.ssh.close()
         
     def __del__(self):
-        self.ssh.close()
+        self.close()
 
             
     def o2_connect(
@@ -262,8 +582,201 @@ class ssh_interface():
             total_timeout=60,
             verbose=verbose,
         )
+
+    def o2_login_shell(
+        self,
+        username='rh183',
+        passcode_method=1,
+        verbose=1,
+        total_timeout=60,
+    ):
+        """
+        Wait for the O2 shell prompt on an already open shell,
+         answering the Duo passcode prompt only if it shows up.
+        Used for shells opened on a pooled transport
+         (see connection_pool), where the server may or may
+         not ask for a passcode again.
+        Args:
+            username (str):
+                Username, used to recognize the shell prompt.
+            passcode_method (int):
+                Method to use for O2 passcode.
+                See self.o2_connect.
+            verbose (int):
+                See self.expect.
+            total_timeout (float):
+                Total time to wait for each prompt.
+
+        Returns:
+            bool:
+                Whether or not the shell prompt was reached.
+        """
+        str_prompt = re.escape(f'[{username}@')
+        out, success = self.expect(
+            str_success=rf'Passcode or option \(1-3\)|{str_prompt}',
+            regex=True,
+            total_timeout=total_timeout,
+            verbose=verbose,
+        )
+        if success and 'Passcode or option' in out:
+            self.send(cmd=str(passcode_method))
+            out, success = self.expect(
+                str_success=str_prompt,
+                regex=True,
+                total_timeout=total_timeout,
+                verbose=verbose,
+            )
+        return success
         
 
+## uploads are written under this suffix and renamed when complete (see _put_file)
+suffix_partial = '.partial'
+
+
+remote_entry = namedtuple('remote_entry', ['path', 'size', 'mtime', 'is_dir'])
+remote_entry.__doc__ = """
+One entry of a remote directory index.
+See sftp_interface.walk_remote.
+    path (str): Posix path of the entry on the remote.
+    size (int): Size in bytes.
+    mtime (int): Modification time (unix seconds).
+    is_dir (bool): Whether or not the entry is a directory.
+"""
+
+
+class remote_metadata_cache():
+    """
+    Size-limited, TTL-bounded cache of remote file system metadata.
+    Used by sftp_interface to avoid repeating stat, mkdir and
+     listdir round trips for paths it has already seen.
+    Entries are keyed by (kind, path) where kind is one of:
+        'stat': paramiko.SFTPAttributes of the path.
+        'isdir': True if the path is known to be an existing directory.
+        'listdir': list of paramiko.SFTPAttributes in the directory.
+    Thread safe.
+    """
+    def __init__(
+        self,
+        ttl=300,
+        max_size=100000,
+    ):
+        """
+        Args:
+            ttl (float):
+                Time in seconds after which an entry is dropped.
+            max_size (int):
+                Maximum number of entries.
+                Least recently used entries are evicted first.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, kind, path, count=True):
+        """
+        Get a cached value.
+        Args:
+            kind (str):
+                'stat', 'isdir' or 'listdir'.
+            path (str):
+                Remote path.
+            count (bool):
+                Whether to count the lookup as a hit or miss.
+                Use False when one lookup checks several kinds, and
+                 call count once for it.
+
+        Returns:
+            value or None:
+                None if the entry is missing or expired.
+        """
+        key = (kind, path)
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and (time.time() - item[0]) > self.ttl:
+                del self._entries[key]
+                item = None
+            if item is None:
+                self.misses += count
+                return None
+            self._entries.move_to_end(key)
+            self.hits += count
+            return item[1]
+
+    def count(self, hit):
+        """
+        Count one lookup made with get(..., count=False).
+        Args:
+            hit (bool):
+                Whether the lookup found an entry.
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def set(self, kind, path, value):
+        """
+        Set a cached value.
+        Args:
+            kind (str):
+                'stat', 'isdir' or 'listdir'.
+            path (str):
+                Remote path.
+            value (object):
+                Value to store.
+        """
+        key = (kind, path)
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, path):
+        """
+        Drop everything known about a path and the listing of its parent.
+        Call after the path is created, modified or removed.
+        Args:
+            path (str):
+                Remote path.
+        """
+        parent = PurePosixPath(path).parent.as_posix()
+        with self._lock:
+            for key in [('stat', path), ('isdir', path), ('listdir', path), ('listdir', parent)]:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Drop all entries. Counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self):
+        """
+        Returns:
+            dict:
+                'hits', 'misses', 'evictions', 'size' and 'hit_rate'.
+        """
+        with self._lock:
+            n = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'hit_rate': self.hits / n if n > 0 else 0.0,
+            }
+
+
 class sftp_interface():
     """
     Interface to sftp with a remote server.
@@ -275,6 +788,9 @@ class sftp_interface():
         self,
         hostname="transfer.rc.hms.harvard.edu",
         port=22,
+        cache_ttl=None,
+        cache_size=100000,
+        transport=None,
     ):
         """
         Args:
@@ -282,8 +798,26 @@ class sftp_interface():
                 Hostname of the remote server.
             port (int):
                 Port of the remote server.
+            cache_ttl (float):
+                Time in seconds to keep remote metadata
+                 (stat results, known directories, listings).
+                If None, no metadata cache is used.
+                See remote_metadata_cache.
+            cache_size (int):
+                Maximum number of entries in the metadata cache.
+            transport (paramiko.Transport):
+                An already authenticated transport, eg from
+                 connection_pool. If given, connect is not
+                 needed and the transport is not closed by
+                 self.close.
         """
-        self.transport = paramiko.Transport((hostname, port))  ## open a transport object
+        if transport is not None:
+            self.transport = transport
+            self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+        else:
+            self.transport = paramiko.Transport((hostname, port))  ## open a transport object
+        self._owns_transport = transport is None
+        self.cache = remote_metadata_cache(ttl=cache_ttl, max_size=cache_size) if cache_ttl is not None else None
         
     def connect(
         self,
@@ -302,7 +836,7 @@ class sftp_interface():
         self.transport.connect(None, username, password)  ## authorization
         self.sftp = paramiko.SFTPClient.from_transport(self.transport)  ## open sftp
     
-    def put_dir(self, source, target, verbose=True):
+    def put_dir(self, source, target, verbose=True, workers=1, hash_type=None, path_manifest=None):
         '''
         Uploads the contents of the source directory to the target path.
         All subdirectories in source are created under target recusively.
@@ -311,7 +845,47 @@ class sftp_interface():
                 Path to the source directory (local).
             target (str):
                 Path to the target directory (remote).
+            verbose (bool):
+                Whether or not to print progress.
+            workers (int):
+                Number of SFTP channels to upload with.
+                1: serial upload, one file at a time.
+                >1: directories are created first, then files
+                 are uploaded in parallel, largest first.
+                 See self._transfer_parallel.
+            hash_type (str):
+                Optional name of a hashlib algorithm (eg 'blake2b').
+                Files are hashed during the upload and verified
+                 against a hash made on the server.
+                 See self._transfer_parallel.
+            path_manifest (str):
+                Local json file to record the size, mtime and hash
+                 of each uploaded file in (keyed by path relative
+                 to source). Requires hash_type.
+        Returns:
+            dict or None:
+                If workers > 1 or hash_type, a summary of the transfer.
         '''
+        assert (path_manifest is None) or (hash_type is not None), 'path_manifest requires hash_type'
+        if workers > 1 or hash_type is not None:
+            source = Path(source).resolve()
+            target = PurePosixPath(target)
+            jobs = []
+            for dirpath, dirnames, filenames in os.walk(source):
+                dir_remote = (target / Path(dirpath).relative_to(source).as_posix()).as_posix()
+                for dirname in dirnames:
+                    self.mkdir_safe(f'{dir_remote}/{dirname}', ignore_existing=True)
+                for filename in filenames:
+                    path_local = Path(dirpath) / filename
+                    jobs.append((str(path_local), f'{dir_remote}/{filename}', path_local.stat().st_size))
+            summary = self._transfer_parallel(jobs, direction='put', workers=workers, verbose=verbose, hash_type=hash_type)
+            if path_manifest is not None:
+                _update_manifest(path_manifest, {
+                    Path(path_local).relative_to(source).as_posix(): (path_local, summary['hashes'][path_remote])
+                    for path_local, path_remote, _ in jobs
+                }, hash_type)
+            return summary
+
         source = Path(source).resolve()
         target = Path(target).resolve()
         
@@ -321,11 +895,13 @@ class sftp_interface():
                 if verbose:
                     print(f'uploading {source / item}   to   {target / item}')
                 self.sftp.put(str(source / item) , str(target / item))
+                if self.cache is not None:
+                    self.cache.invalidate((target / item).as_posix())
             else:
                 self.mkdir_safe(str(target / item) , ignore_existing=True)
                 self.put_dir(source / item , target / item)
 
-    def get_dir(self, source, target, verbose=True):
+    def get_dir(self, source, target, verbose=True, workers=1, hash_type=None, path_manifest=None):
         '''
         Downloads the contents of the source directory to the target path.
         All subdirectories in source are created under target recusively.
@@ -334,20 +910,355 @@ class sftp_interface():
                 Path to the source directory (remote).
             target (str):
                 Path to the target directory (local).
+            verbose (bool):
+                Whether or not to print progress.
+            workers (int):
+                Number of SFTP channels to download with.
+                The remote tree is always indexed first with
+                 self.walk_remote (using the same number of channels).
+                1: serial download, one file at a time.
+                >1: files are downloaded in parallel, largest first.
+                 See self._transfer_parallel.
+            hash_type (str):
+                Optional name of a hashlib algorithm (eg 'blake2b').
+                Files are hashed as they arrive and verified against
+                 a hash made on the server at the same time.
+                 See self._transfer_parallel.
+            path_manifest (str):
+                Local json file to record the size, mtime and hash
+                 of each downloaded file in (keyed by path relative
+                 to target). Requires hash_type.
+        Returns:
+            dict or None:
+                If workers > 1 or hash_type, a summary of the transfer.
         '''
-        source = Path(source).resolve()
+        assert (path_manifest is None) or (hash_type is not None), 'path_manifest requires hash_type'
+        source = PurePosixPath(source)
         target = Path(target).resolve()
-        
-        for item in self.sftp.listdir(str(source)):
-            if self.isdir_remote(str(source / item)):
-                (target / item).mkdir(parents=True, exist_ok=True)
-                self.get_dir(source / item , target / item)
+
+        target.mkdir(parents=True, exist_ok=True)
+        jobs = []
+        for entry in self.walk_remote(source.as_posix(), workers=workers):
+            path_local = target / PurePosixPath(entry.path).relative_to(source)
+            if entry.is_dir:
+                path_local.mkdir(parents=True, exist_ok=True)
             else:
-                if verbose:
-                    print(f'downloading {source / item}   to   {target / item}')
-                self.sftp.get(str(source / item) , str(target / item))
+                jobs.append((entry.path, str(path_local), entry.size))
+
+        if workers > 1 or hash_type is not None:
+            summary = self._transfer_parallel(jobs, direction='get', workers=workers, verbose=verbose, hash_type=hash_type)
+            if path_manifest is not None:
+                _update_manifest(path_manifest, {
+                    Path(path_local).relative_to(target).as_posix(): (path_local, summary['hashes'][path_remote])
+                    for path_remote, path_local, _ in jobs
+                }, hash_type)
+            return summary
+
+        for path_remote, path_local, size in jobs:
+            if verbose:
+                print(f'downloading {path_remote}   to   {path_local}')
+            self.sftp.get(path_remote, path_local)
+
+    def _transfer_parallel(self, jobs, direction='put', workers=4, verbose=True, fn_transfer=None, hash_type=None):
+        """
+        Transfers files over several SFTP channels opened on
+         the existing transport. Workers pull from a shared
+         queue that is ordered largest file first, so that
+         the big files do not end up alone at the tail.
+        Args:
+            jobs (list of tuple):
+                (path_source, path_target, size_bytes) for each file.
+            direction (str):
+                'put': local -> remote
+                'get': remote -> local
+            workers (int):
+                Number of SFTP channels to open.
+                Each channel shares the single authenticated
+                 transport, so no extra login is needed.
+            verbose (bool):
+                Whether or not to print progress.
+            fn_transfer (callable):
+                Optional function used to move a single file.
+                Called as fn_transfer(sftp, path_source, path_target).
+                If None, will use sftp.put or sftp.get.
+                With hash_type, it must return the hex digest of the file,
+                 and for 'put' leave it unfinalized at
+                 path_target + suffix_partial (see _put_file).
+            hash_type (str):
+                Optional name of a hashlib algorithm. Each file is
+                 hashed as its bytes pass through the transfer (no
+                 second read), and compared to a hash made on the
+                 server (see _hash_remote) on its own exec channel:
+                 for 'get' while the file downloads, for 'put' while
+                 the next file uploads.
+                Uploads stay under their partial name until the hashes
+                 match, so a bad upload never looks complete.
+                A mismatch fails the transfer like a transfer error.
+                 For 'put', the bad partial file is deleted.
+
+        Returns:
+            dict:
+                'n_files': number of files transferred.
+                'n_bytes': number of bytes transferred.
+                'time': wall time in seconds.
+                'throughput_MBps': aggregate throughput in MB/s.
+                'hashes': {remote path: hex digest} of the verified
+                 files (only with hash_type).
+        """
+        assert direction in ['put', 'get'], f"direction must be 'put' or 'get', got {direction}"
+
+        q = queue.Queue()
+        for job in sorted(jobs, key=lambda job: job[2], reverse=True):
+            q.put(job)
+
+        lock = threading.Lock()
+        progress = {'n_files': 0, 'n_bytes': 0}
+        errors = []
+        hashes_local, futures_remote = {}, {}
+        if hash_type is not None:
+            from concurrent.futures import ThreadPoolExecutor
+            executor_hash = ThreadPoolExecutor(max_workers=max(1, workers))
+
+        def _worker():
+            sftp = paramiko.SFTPClient.from_transport(self.transport)
+            try:
+                while True:
+                    try:
+                        path_source, path_target, size = q.get_nowait()
+                    except queue.Empty:
+                        return
+                    if verbose:
+                        print(f"{'uploading' if direction=='put' else 'downloading'} {path_source}   to   {path_target}")
+                    path_remote = path_target if direction == 'put' else path_source
+                    try:
+                        if hash_type is not None and direction == 'get':
+                            futures_remote[path_remote] = executor_hash.submit(_hash_remote, self.transport, [path_remote], hash_type)
+                        if fn_transfer is not None:
+                            digest = fn_transfer(sftp, path_source, path_target)
+                        elif hash_type is not None and direction == 'put':
+                            digest = _put_file(sftp, path_source, path_target, hash_type=hash_type, finalize=False)
+                        elif hash_type is not None:
+                            digest = _get_file(sftp, path_source, path_target, hash_type=hash_type)
+                        else:
+                            getattr(sftp, direction)(path_source, path_target)
+                        if hash_type is not None:
+                            hashes_local[path_remote] = digest
+                            if direction == 'put':
+                                futures_remote[path_remote] = executor_hash.submit(_hash_remote, self.transport, [path_remote + suffix_partial], hash_type)
+                    except Exception as e:
+                        with lock:
+                            errors.append((path_source, e))
+                        continue
+                    if direction == 'put' and self.cache is not None:
+                        self.cache.invalidate(path_target)
+                    with lock:
+                        progress['n_files'] += 1
+                        progress['n_bytes'] += size
+            finally:
+                sftp.close()
+
+        t_start = time.time()
+        threads = [threading.Thread(target=_worker, daemon=True) for _ in range(min(workers, max(len(jobs), 1)))]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        ## compare to the hashes made on the server. uploads are finalized only if they match
+        hashes = {}
+        if hash_type is not None:
+            sftp = paramiko.SFTPClient.from_transport(self.transport)
+            paths_local = {job[1]: job[0] for job in jobs} if direction == 'put' else {}
+            for path_remote, digest in hashes_local.items():
+                path_hashed = path_remote + suffix_partial if direction == 'put' else path_remote
+                error = None
+                try:
+                    digest_remote = futures_remote[path_remote].result().get(path_hashed)
+                except Exception:
+                    ## a dropped exec channel is not a bad file. try once more
+                    try:
+                        digest_remote = _hash_remote(self.transport, [path_hashed], hash_type).get(path_hashed)
+                    except Exception as e:
+                        digest_remote, error = None, e
+                try:
+                    if digest_remote == digest:
+                        if direction == 'put':
+                            _finalize_put(sftp, paths_local[path_remote], path_remote)
+                            if self.cache is not None:
+                                self.cache.invalidate(path_remote)
+                        hashes[path_remote] = digest
+                    else:
+                        errors.append((path_remote, error if error is not None else IOError(f'{hash_type} mismatch: local {digest}, remote {digest_remote}')))
+                        ## a corrupt partial file must not be resumed
+                        if direction == 'put' and error is None:
+                            sftp.remove(path_hashed)
+                except IOError as e:
+                    errors.append((path_remote, e))
+            sftp.close()
+            executor_hash.shutdown()
+        t_elapsed = time.time() - t_start
+
+        summary = {
+            'n_files': progress['n_files'],
+            'n_bytes': progress['n_bytes'],
+            'time': t_elapsed,
+            'throughput_MBps': progress['n_bytes'] / 1e6 / max(t_elapsed, 1e-9),
+            **({'hashes': hashes} if hash_type is not None else {}),
+        }
+        if verbose:
+            print(f"transferred {summary['n_files']} files, {summary['n_bytes']/1e9:.3f} GB in {t_elapsed:.1f} s  ({summary['throughput_MBps']:.1f} MB/s, {len(threads)} channels)" + (f", {len(hashes)} verified ({hash_type})" if hash_type is not None else ''))
+        if len(errors) > 0:
+            raise IOError(f'{len(errors)} of {len(jobs)} files failed to transfer. First failure: {errors[0][0]}: {errors[0][1]}')
+        return summary
 
         
+    def sync_dir(
+        self,
+        source,
+        target,
+        hash_type=None,
+        path_manifest=None,
+        resume=True,
+        dry_run=False,
+        workers=1,
+        verbose=True,
+    ):
+        """
+        Incrementally uploads the source directory to the target path.
+        Only files that are new or changed are sent.
+        Local files are compared to an index of the remote tree
+         made by self.walk_remote. A remote file is considered up to date
+         if its size and mtime match the local file. Uploads are
+         written to a partial file (suffix_partial) that is given the
+         local mtime and renamed when complete (and verified, with
+         hash_type).
+        An interrupted upload leaves its partial file, which is
+         resumed from its size if it is smaller than the local file
+         and the local file was not modified after it was written.
+        Args:
+            source (str):
+                Path to the source directory (local).
+            target (str):
+                Path to the target directory (remote).
+            hash_type (str):
+                Optional name of a hashlib algorithm (eg 'blake2b').
+                If set, uploaded files are hashed during the upload,
+                 verified against a hash made on the server and
+                 recorded in the manifest. A file whose mtime changed
+                 but whose size and hash did not is skipped.
+                Hashes in the manifest are trusted while the size and
+                 mtime of the file are unchanged, so files are not
+                 hashed again on later syncs.
+                Requires path_manifest.
+            path_manifest (str):
+                Path to a local json file that stores the manifest
+                 of the last sync. If None, no manifest is kept.
+            resume (bool):
+                Whether or not to resume partial remote files.
+                If False, partial files are uploaded again in full.
+                A complete remote file is never appended to.
+            dry_run (bool):
+                If True, nothing is transferred or created.
+                Only the report is returned.
+            workers (int):
+                Number of SFTP channels to upload with.
+            verbose (bool):
+                Whether or not to print progress.
+
+        Returns:
+            dict:
+                'upload': list of relative paths sent in full.
+                'resume': list of relative paths resumed.
+                'skip': list of relative paths already up to date.
+                'n_bytes': number of bytes to move.
+                'n_bytes_skipped': number of bytes not moved.
+                'transfer': summary from self._transfer_parallel
+                 (None if dry_run or nothing to do).
+        """
+        assert (hash_type is None) or (path_manifest is not None), 'hash_type requires path_manifest'
+        source = Path(source).resolve()
+        target = PurePosixPath(target)
+
+        manifest_old = _load_manifest(path_manifest)
+        manifest_new = {}
+
+        report = {'upload': [], 'resume': [], 'skip': [], 'n_bytes': 0, 'n_bytes_skipped': 0, 'transfer': None}
+        ## only a missing target means 'upload everything'. any other failure (an unreadable
+        ##  subdirectory, a dropped channel) is raised rather than re-uploading the whole tree
+        try:
+            self.sftp.stat(target.as_posix())
+            target_exists = True
+        except IOError as e:
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                raise
+            target_exists = False
+        if target_exists:
+            index_remote = {entry.path: entry for entry in self.walk_remote(target.as_posix(), workers=workers)}
+        else:
+            index_remote = {}
+            if not dry_run:
+                self.mkdir_p(target.as_posix())
+
+        jobs, offsets = [], {}
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            dir_remote = (target / Path(dirpath).relative_to(source).as_posix()).as_posix()
+            if (not dry_run) and (dirpath != str(source)) and (dir_remote not in index_remote):
+                self.mkdir_safe(dir_remote, ignore_existing=True)
+
+            for filename in sorted(filenames):
+                path_local = Path(dirpath) / filename
+                if path_manifest is not None and path_local == Path(path_manifest).resolve():
+                    continue
+                path_rel = path_local.relative_to(source).as_posix()
+                st = path_local.stat()
+                entry = {'size': st.st_size, 'mtime': int(st.st_mtime)}
+                entry_old = manifest_old.get(path_rel, {})
+                entry_remote = index_remote.get(f'{dir_remote}/{filename}')
+                size_remote = entry_remote.size if entry_remote is not None else None
+                if hash_type is not None:
+                    if (entry_old.get('size'), entry_old.get('mtime'), entry_old.get('hash_type')) == (entry['size'], entry['mtime'], hash_type):
+                        entry['hash'] = entry_old.get('hash')
+                    elif size_remote == entry['size'] and entry_remote.mtime != entry['mtime'] and (entry_old.get('size'), entry_old.get('hash_type')) == (entry['size'], hash_type):
+                        ## only touched? hash now, since an unchanged hash means no upload. other files are hashed during the upload
+                        entry['hash'] = _hash_file(path_local, hash_type=hash_type)
+                    entry['hash_type'] = hash_type
+                manifest_new[path_rel] = entry
+
+                if size_remote == entry['size'] and (
+                    entry_remote.mtime == entry['mtime'] or \
+                    (hash_type is not None and entry.get('hash') is not None and entry_old.get('hash') == entry['hash'] and entry_old.get('size') == size_remote)
+                ):
+                    report['skip'].append(path_rel)
+                    report['n_bytes_skipped'] += entry['size']
+                    continue
+
+                offset = 0
+                entry_partial = index_remote.get(f'{dir_remote}/{filename}{suffix_partial}')
+                if resume and (entry_partial is not None) and (0 < entry_partial.size < entry['size']) and (entry['mtime'] <= entry_partial.mtime):
+                    offset = entry_partial.size
+                    report['resume'].append(path_rel)
+                else:
+                    report['upload'].append(path_rel)
+                report['n_bytes'] += entry['size'] - offset
+                report['n_bytes_skipped'] += offset
+                offsets[str(path_local)] = offset
+                jobs.append((str(path_local), f'{dir_remote}/{filename}', entry['size'] - offset))
+
+        if verbose:
+            print(f"sync {source}  ->  {target}:  {len(report['upload'])} to upload, {len(report['resume'])} to resume, {len(report['skip'])} up to date.  {report['n_bytes']/1e9:.3f} GB to move, {report['n_bytes_skipped']/1e9:.3f} GB skipped.")
+        if dry_run:
+            return report
+
+        def _put_resume(sftp, path_source, path_target):
+            return _put_file(sftp, path_source, path_target, offset=offsets[path_source], hash_type=hash_type, finalize=hash_type is None)
+
+        if len(jobs) > 0:
+            report['transfer'] = self._transfer_parallel(jobs, direction='put', workers=workers, verbose=verbose, fn_transfer=_put_resume, hash_type=hash_type)
+            if hash_type is not None:
+                for path_local, path_remote, _ in jobs:
+                    manifest_new[Path(path_local).relative_to(source).as_posix()]['hash'] = report['transfer']['hashes'][path_remote]
+        _save_manifest(path_manifest, manifest_new)
+        return report
+
     def mkdir_safe(self, path_remote, mode=511, ignore_existing=False):
         '''
         Augments mkdir by adding an option to not fail if the folder exists.
@@ -362,37 +1273,52 @@ class sftp_interface():
                 If True, will not fail if the folder already exists.
                 If False, will fail if the folder already exists.
         '''
+        if ignore_existing and (self.cache is not None) and self.cache.get('isdir', path_remote):
+            return
         try:
             self.sftp.mkdir(path_remote, mode)
         except IOError:
             if ignore_existing:
-                pass
+                if self.cache is not None:
+                    ## one stat now so that later calls are free
+                    self._stat_to_cache(path_remote)
             else:
                 raise
+        else:
+            if self.cache is not None:
+                self.cache.invalidate(path_remote)
+                self.cache.set('isdir', path_remote, True)
     
     def mkdir_p(self, dir_remote):
         """
-        Change to this directory, recursively making new folders if needed.
+        Make a remote directory and any missing parents (like mkdir -p).
+        Components are checked from the deepest one up with isdir_remote,
+         so a directory that is known to the metadata cache costs no
+         round trip, and only the missing ones are made.
+        The working directory of self.sftp is not changed.
         Returns True if any folders were created.
         Args:
             dir_remote (str):
                 Path to the remote directory.
         """
-        if dir_remote == '/':
-            # absolute path so change directory to root
-            self.sftp.chdir('/')
-            return
-        if dir_remote == '':
-            # top-level relative directory must exist
-            return
-        try:
-            self.sftp.chdir(dir_remote) # sub-directory exists
-        except IOError:
-            dirname, basename = os.path.split(dir_remote.rstrip('/'))
-            self.mkdir_p(dirname) # make parent directories
-            self.sftp.mkdir(basename) # sub-directory missing, so created it
-            self.sftp.chdir(basename)
-            return True
+        missing = []
+        for path in [PurePosixPath(dir_remote), *PurePosixPath(dir_remote).parents]:
+            if path.as_posix() in ['.', '/'] or self.isdir_remote(path.as_posix()):
+                break
+            missing.append(path.as_posix())
+        for path in reversed(missing):
+            try:
+                self.sftp.mkdir(path)
+            except IOError:
+                ## made by someone else in the meantime
+                attr = self._stat_to_cache(path)
+                if (attr is None) or not stat.S_ISDIR(attr.st_mode):
+                    raise
+                continue
+            if self.cache is not None:
+                self.cache.invalidate(path)
+                self.cache.set('isdir', path, True)
+        return len(missing) > 0
     
     def isdir_remote(self, path):
         """
@@ -401,59 +1327,1878 @@ class sftp_interface():
             path (str):
                 Path to the remote directory.
         """
+        if self.cache is not None:
+            ## one lookup of two kinds: counted once
+            isdir = self.cache.get('isdir', path, count=False)
+            attr = None if isdir else self.cache.get('stat', path, count=False)
+            self.cache.count(hit=bool(isdir) or (attr is not None))
+            if isdir:
+                return True
+            if attr is not None:
+                return stat.S_ISDIR(attr.st_mode)
+        attr = self._stat_to_cache(path)
+        #Path does not exist, so by definition not a directory
+        return (attr is not None) and stat.S_ISDIR(attr.st_mode)
+
+    def _stat_to_cache(self, path):
+        """
+        Stat a remote path without looking in the cache, and cache the result.
+        Returns:
+            paramiko.SFTPAttributes or None:
+                None if the path does not exist.
+        """
         try:
-            return stat.S_ISDIR(self.sftp.stat(path).st_mode)
+            attr = self.sftp.stat(path)
         except IOError:
-            #Path does not exist, so by definition not a directory
-            return False
+            return None
+        if self.cache is not None:
+            self.cache.set('stat', path, attr)
+            if stat.S_ISDIR(attr.st_mode):
+                self.cache.set('isdir', path, True)
+        return attr
+
+    def stat_remote(self, path):
+        """
+        Stat a remote path, using the metadata cache if enabled.
+        Args:
+            path (str):
+                Path to the remote file or directory.
+
+        Returns:
+            paramiko.SFTPAttributes:
+                Attributes of the path.
+                Raises IOError if the path does not exist.
+        """
+        if self.cache is not None:
+            attr = self.cache.get('stat', path)
+            if attr is not None:
+                return attr
+        attr = self.sftp.stat(path)
+        if self.cache is not None:
+            self.cache.set('stat', path, attr)
+        return attr
+
+    def listdir_attr(self, path='.', sftp=None):
+        """
+        List a remote directory, using the metadata cache if enabled.
+        The attributes of each entry are cached too.
+        Args:
+            path (str):
+                Path to the remote directory.
+            sftp (paramiko.SFTPClient):
+                Client to list with.
+                If None, will use self.sftp.
+
+        Returns:
+            list of paramiko.SFTPAttributes:
+                One per entry, with .filename set.
+        """
+        if self.cache is not None:
+            attrs = self.cache.get('listdir', path)
+            if attrs is not None:
+                return attrs
+        attrs = (self.sftp if sftp is None else sftp).listdir_attr(path)
+        if self.cache is not None:
+            self.cache.set('listdir', path, attrs)
+            self.cache.set('isdir', path, True)
+            for attr in attrs:
+                path_entry = (PurePosixPath(path) / attr.filename).as_posix()
+                self.cache.set('stat', path_entry, attr)
+                if stat.S_ISDIR(attr.st_mode):
+                    self.cache.set('isdir', path_entry, True)
+        return attrs
+
+    def open_npy(self, path, **kwargs_npy):
+        """
+        Open a remote .npy file lazily. Only the parts that are
+         sliced are downloaded. See remote_npy.
+        Args:
+            path (str):
+                Path to the remote .npy file.
+            kwargs_npy (dict):
+                Passed to remote_npy (eg block_size, cache_blocks).
+
+        Returns:
+            remote_npy:
+                Sliceable view of the remote array.
+        """
+        return remote_npy(self, path, **kwargs_npy)
+
+    def cache_stats(self):
+        """
+        Returns:
+            dict or None:
+                Hit/miss counters of the metadata cache.
+                None if no cache is used.
+        """
+        return self.cache.stats if self.cache is not None else None
+
+    def walk_remote(self, path='.', workers=1):
+        """
+        Indexes a remote directory tree.
+        Each directory is listed with a single listdir_attr call
+         (or not at all if its listing is in the metadata cache).
+        Directories are crawled breadth-first. If workers > 1,
+         several directories are listed at once over separate
+         SFTP channels on the existing transport.
+        Args:
+            path (str):
+                Path to the remote directory to index.
+            workers (int):
+                Number of SFTP channels to list directories with.
+                1: uses self.sftp only.
+
+        Returns:
+            list of remote_entry:
+                One entry (path, size, mtime, is_dir) for every
+                 file and directory below path (path itself is
+                 not included). Sorted by path.
+        """
+        root = PurePosixPath(path)
+        q = queue.Queue()
+        q.put(root)
+        lock = threading.Lock()
+        entries = []
+        errors = []
+
+        def _worker(sftp):
+            while True:
+                cwd = q.get()
+                if cwd is None:
+                    q.task_done()
+                    return
+                ## any failure (eg SSHException or EOFError from a dropped channel) is reported
+                ##  at the end. task_done must still run, or q.join() waits forever
+                try:
+                    attrs = self.listdir_attr(cwd.as_posix(), sftp=sftp)
+                    for attr in attrs:
+                        is_dir = stat.S_ISDIR(attr.st_mode)
+                        with lock:
+                            entries.append(remote_entry((cwd / attr.filename).as_posix(), attr.st_size, attr.st_mtime, is_dir))
+                        if is_dir:
+                            q.put(cwd / attr.filename)
+                except Exception as e:
+                    with lock:
+                        errors.append((cwd.as_posix(), e))
+                finally:
+                    q.task_done()
+
+        if workers > 1:
+            sftps = [paramiko.SFTPClient.from_transport(self.transport) for _ in range(workers)]
+        else:
+            sftps = [self.sftp]
+        threads = [threading.Thread(target=_worker, args=(sftp,), daemon=True) for sftp in sftps]
+        [t.start() for t in threads]
+        q.join()
+        [q.put(None) for _ in threads]
+        [t.join() for t in threads]
+        if workers > 1:
+            [sftp.close() for sftp in sftps]
+
+        if len(errors) > 0:
+            raise IOError(f'failed to list {len(errors)} remote directories. First failure: {errors[0][0]}: {errors[0][1]}')
+        return sorted(entries, key=lambda entry: entry.path)
 
     def search_recursive(
         self, 
         path='.', 
         search_pattern_re='', 
-        verbose=True
+        verbose=True,
+        workers=1,
     ):
         """
         Searches a remote directory recursively for files matching a pattern.
         Args:
-            sftp (paramiko.SFTPClient):
-                SFTPClient object.
             path (str):
                 Current working directory.
             search_pattern_re (str):
                 Regular expression to search for.
             verbose (bool):
                 Whether or not to print the paths of the files found.
+            workers (int):
+                Number of SFTP channels to crawl with.
+                See self.walk_remote.
 
         Returns:
             list:
                 List of paths to the files found.
         """
         search_results = []
+        for entry in self.walk_remote(path, workers=workers):
+            if (not entry.is_dir) and re.search(search_pattern_re, PurePosixPath(entry.path).name):
+                search_results.append(entry.path)
+                if verbose:
+                    print(entry.path)
+        return search_results
+
+    def get_dir_tar(self, source, target, compression='zstd', fallback=True, verbose=True):
+        """
+        Downloads a remote directory as a single tar stream.
+        Runs 'tar | zstd' (or gzip) on the remote over an exec channel
+         of the existing transport and unpacks it locally as it
+         arrives. No archive is written on either side.
+        Much faster than get_dir for trees with many small files
+         (eg suite2p output folders).
+        Args:
+            source (str):
+                Path to the source directory (remote).
+            target (str):
+                Path to the target directory (local).
+            compression (str):
+                'zstd': requires zstd on the remote and the
+                 zstandard python package locally.
+                'gzip': requires gzip on the remote.
+                None: plain tar.
+            fallback (bool):
+                If True and the remote or local tools are missing,
+                 falls back to self.get_dir.
+            verbose (bool):
+                Whether or not to print progress.
+
+        Returns:
+            dict:
+                'n_bytes': number of bytes received over the wire.
+                'time': wall time in seconds.
+                'throughput_MBps': wire throughput in MB/s.
+                'method': 'tar' or 'get_dir'.
+
+        Raises:
+            IOError:
+                If the remote command exits with a non-zero status, or
+                 the stream can't be decompressed or unpacked.
+        """
+        import tarfile
+
+        compression = self._check_tar_tools(compression=compression, fallback=fallback)
+        if compression is False:
+            if verbose:
+                print('tar/compression tools not available, falling back to get_dir')
+            t_start = time.time()
+            self.get_dir(source, target, verbose=verbose)
+            return {'n_bytes': None, 'time': time.time() - t_start, 'throughput_MBps': None, 'method': 'get_dir'}
+
+        target = Path(target).resolve()
+        target.mkdir(parents=True, exist_ok=True)
+        cmd = f"tar -C {shlex.quote(PurePosixPath(source).as_posix())} -cf - ."
+        if compression is not None:
+            cmd += {'zstd': ' | zstd -c -1 -T0 -q', 'gzip': ' | gzip -c -1'}[compression]
+        cmd = f"set -o pipefail; {cmd}"
+
+        if verbose:
+            print(f'streaming {source}   to   {target}  (tar, compression={compression})')
+        t_start = time.time()
+        chan = self.transport.open_session()
+        chan.exec_command(f"bash -c {shlex.quote(cmd)}")
+        stream = _counting_reader(chan.makefile('rb'))
+        if compression == 'zstd':
+            import zstandard
+            stream_tar = zstandard.ZstdDecompressor().stream_reader(stream)
+            mode = 'r|'
+        else:
+            stream_tar = stream
+            mode = 'r|gz' if compression == 'gzip' else 'r|'
+        error_tar = None
+        try:
+            with tarfile.open(fileobj=stream_tar, mode=mode) as tar:
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extractall(path=str(target), filter='data')
+                else:
+                    tar.extractall(path=str(target))
+        except Exception as e:
+            ## tarfile, zstandard and gzip errors, or the stream ending early
+            error_tar = e
+        ## drain anything after the end-of-archive marker
+        try:
+            while stream.read(2**16):
+                pass
+        except Exception as e:
+            error_tar = error_tar if error_tar is not None else e
+        status = chan.recv_exit_status()
+        f_err = chan.makefile_stderr('rb')
+        err = f_err.read().decode('utf-8', errors='replace')
+        f_err.close()
+        stream.close()
+        chan.close()
+        if status != 0 or error_tar is not None:
+            raise IOError(f'tar download of {source} failed (remote exit status {status}): {err.strip()}' + (f' {type(error_tar).__name__}: {error_tar}' if error_tar is not None else ''))
+        return self._tar_summary(stream.n_bytes, time.time() - t_start, verbose=verbose)
+
+    def put_dir_tar(self, source, target, compression='zstd', fallback=True, verbose=True):
+        """
+        Uploads a local directory as a single tar stream.
+        The reverse of self.get_dir_tar: the local tree is packed
+         and compressed on the fly and unpacked on the remote by
+         'zstd -d | tar -x' over an exec channel.
+        Args:
+            source (str):
+                Path to the source directory (local).
+            target (str):
+                Path to the target directory (remote).
+                Created if it does not exist.
+            compression (str):
+                'zstd', 'gzip' or None.
+                See self.get_dir_tar.
+            fallback (bool):
+                If True and the remote or local tools are missing,
+                 falls back to self.put_dir.
+            verbose (bool):
+                Whether or not to print progress.
+
+        Returns:
+            dict:
+                See self.get_dir_tar.
+
+        Raises:
+            IOError:
+                If the remote command exits with a non-zero status, or
+                 the stream can't be packed or sent.
+        """
+        import tarfile
+
+        compression = self._check_tar_tools(compression=compression, fallback=fallback)
+        if compression is False:
+            if verbose:
+                print('tar/compression tools not available, falling back to put_dir')
+            t_start = time.time()
+            self.mkdir_p(PurePosixPath(target).as_posix())
+            self.put_dir(source, target, verbose=verbose)
+            return {'n_bytes': None, 'time': time.time() - t_start, 'throughput_MBps': None, 'method': 'put_dir'}
+
+        source = Path(source).resolve()
+        target = PurePosixPath(target).as_posix()
+        cmd = f"tar -C {shlex.quote(target)} -xf -"
+        if compression is not None:
+            cmd = {'zstd': 'zstd -d -c -q', 'gzip': 'gzip -d -c'}[compression] + ' | ' + cmd
+        cmd = f"set -o pipefail; mkdir -p {shlex.quote(target)} && {cmd}"
+
+        if verbose:
+            print(f'streaming {source}   to   {target}  (tar, compression={compression})')
+        t_start = time.time()
+        chan = self.transport.open_session()
+        chan.exec_command(f"bash -c {shlex.quote(cmd)}")
+        stream = _counting_writer(chan.makefile('wb'))
+        if compression == 'zstd':
+            import zstandard
+            stream_tar = zstandard.ZstdCompressor(level=1, threads=-1).stream_writer(stream, closefd=False)
+            mode = 'w|'
+        else:
+            stream_tar = stream
+            mode = 'w|gz' if compression == 'gzip' else 'w|'
+        error_tar = None
+        try:
+            with tarfile.open(fileobj=stream_tar, mode=mode) as tar:
+                tar.add(str(source), arcname='.')
+            if compression == 'zstd':
+                stream_tar.close()
+            stream.flush()
+            stream.close()
+        except Exception as e:
+            ## eg the channel closed because the remote side failed
+            error_tar = e
+        chan.shutdown_write()
+        status = chan.recv_exit_status()
+        f_err = chan.makefile_stderr('rb')
+        err = f_err.read().decode('utf-8', errors='replace')
+        f_err.close()
+        chan.close()
+        if status != 0 or error_tar is not None:
+            raise IOError(f'tar upload to {target} failed (remote exit status {status}): {err.strip()}' + (f' {type(error_tar).__name__}: {error_tar}' if error_tar is not None else ''))
+        if self.cache is not None:
+            self.cache.clear()
+        return self._tar_summary(stream.n_bytes, time.time() - t_start, verbose=verbose)
+
+    def _check_tar_tools(self, compression='zstd', fallback=True):
+        """
+        Checks that tar (and the compressor) exist on the remote,
+         and that the local decompressor can be imported.
+        Args:
+            compression (str):
+                'zstd', 'gzip' or None.
+            fallback (bool):
+                If True, returns False instead of raising when
+                 a tool is missing.
+
+        Returns:
+            str or None or False:
+                The compression to use, or False if the caller
+                 should fall back to a per-file transfer.
+        """
+        assert compression in ['zstd', 'gzip', None], f"compression must be 'zstd', 'gzip' or None, got {compression}"
+        tools = ['tar'] + ([compression] if compression is not None else [])
+        missing = []
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                missing.append('zstandard (local python package)')
+        chan = self.transport.open_session()
+        chan.exec_command(' && '.join([f'command -v {tool}' for tool in tools]))
+        if chan.recv_exit_status() != 0:
+            missing.append(f"one of {tools} (remote)")
+        chan.close()
+
+        if len(missing) == 0:
+            return compression
+        if fallback:
+            return False
+        raise RuntimeError(f'missing tools for tar transfer: {missing}')
+
+    def _tar_summary(self, n_bytes, t_elapsed, verbose=True):
+        summary = {
+            'n_bytes': n_bytes,
+            'time': t_elapsed,
+            'throughput_MBps': n_bytes / 1e6 / max(t_elapsed, 1e-9),
+            'method': 'tar',
+        }
+        if verbose:
+            print(f"streamed {n_bytes/1e9:.3f} GB over the wire in {t_elapsed:.1f} s  ({summary['throughput_MBps']:.1f} MB/s)")
+        return summary
 
-        def _recursive_search(search_results, sftp, cwd='.', search_pattern_re='', verbose=True):
-            contents = {name: stat.S_ISDIR(attr.st_mode)  for name, attr in zip(sftp.listdir(cwd), sftp.listdir_attr(cwd))}
-            for name, isdir  in contents.items():
-                if isdir:
-                    search_results = _recursive_search(
-                        search_results=search_results,
-                        sftp=sftp, 
-                        cwd=str(Path(cwd) / name), 
-                        search_pattern_re=search_pattern_re, 
-                        verbose=verbose
-                    )
-                elif re.search(search_pattern_re, name):
-                    path_found = str(Path(cwd) / name)
-                    search_results.append(path_found)
-                    if verbose:
-                        print(path_found)
-            return search_results
-
-        return _recursive_search(search_results, self.sftp, cwd=path, search_pattern_re=search_pattern_re, verbose=verbose)
-
     def close(self):
         self.sftp.close()
-        self.transport.close()
+        if self._owns_transport:
+            self.transport.close()
+
+
+class remote_npy():
+    """
+    Lazy, sliceable view of a remote .npy file over SFTP.
+    The header is parsed from the first block. Indexing fetches only
+     the byte ranges the selection needs, in fixed size blocks that are
+     kept in an LRU cache. Missing blocks of one request are fetched
+     together (pipelined, SFTPFile.readv), along with the next
+     prefetch_blocks blocks after each range, so that paging through
+     rows or frames is mostly served from the cache.
+    Use as:
+        F = sftp.open_npy(f'{dir_plane}/F.npy')
+        F.shape, F.dtype
+        F[10:20]            ## rows 10-19: only those bytes are read
+        F[:, 1000:2000]     ## one small range per row
+        iscell = sftp.open_npy(f'{dir_plane}/iscell.npy')[:]
+    Supported indexing: ints, slices, Ellipsis, and an int / bool array
+     on the first axis. Anything after the first two axes is applied to
+     the fetched rows. Object arrays (stat.npy, ops.npy) are pickled and
+     can't be sliced lazily: use self.load(allow_pickle=True), which
+     downloads the file.
+    """
+    def __init__(self, sftp, path, block_size=2**20, cache_blocks=256, prefetch_blocks=1):
+        """
+        Args:
+            sftp (sftp_interface or paramiko.SFTPClient):
+                Connected sftp.
+            path (str):
+                Path to the remote .npy file.
+            block_size (int):
+                Bytes per cached block.
+            cache_blocks (int):
+                Maximum number of blocks kept (block_size * cache_blocks
+                 bytes of memory).
+            prefetch_blocks (int):
+                Blocks read ahead after each requested range.
+        """
+        import numpy as np
+
+        self.path = path
+        self.block_size = int(block_size)
+        self.cache_blocks = int(cache_blocks)
+        self.prefetch_blocks = int(prefetch_blocks)
+        client = sftp.sftp if isinstance(sftp, sftp_interface) else sftp
+        self._f = client.open(path, 'rb')
+        self.size_file = self._f.stat().st_size
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'n_requests': 0, 'n_blocks_fetched': 0, 'n_bytes_fetched': 0, 'n_block_hits': 0}
+
+        ## header: magic (6 bytes), version (2), header length (2 or 4), header
+        import io
+        head = self._read_range(0, min(self.size_file, 12))
+        version = (head[6], head[7])
+        len_prefix = 2 if version == (1, 0) else 4
+        len_header = int.from_bytes(head[8:8+len_prefix], 'little')
+        self.offset = 8 + len_prefix + len_header
+        fp = io.BytesIO(self._read_range(0, self.offset))
+        np.lib.format.read_magic(fp)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+        self.shape, self.fortran_order, self.dtype = tuple(shape), fortran_order, np.dtype(dtype)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        import numpy as np
+        return int(np.prod(self.shape, dtype=np.int64))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f'remote_npy({self.path!r}, shape={self.shape}, dtype={self.dtype})'
+
+    def _fetch_blocks(self, idx_blocks):
+        """
+        Make sure blocks are in the cache. Missing ones are read
+         with one readv call.
+        """
+        missing = [i for i in idx_blocks if i not in self._blocks]
+        self.stats['n_block_hits'] += len(idx_blocks) - len(missing)
+        if len(missing) > 0:
+            chunks = [(i * self.block_size, min(self.block_size, self.size_file - i * self.block_size)) for i in missing]
+            for i, data in zip(missing, self._f.readv(chunks)):
+                self._blocks[i] = data
+                self.stats['n_blocks_fetched'] += 1
+                self.stats['n_bytes_fetched'] += len(data)
+        for i in idx_blocks:
+            self._blocks.move_to_end(i)
+        while len(self._blocks) > max(self.cache_blocks, len(idx_blocks)):
+            self._blocks.popitem(last=False)
+
+    def _read_ranges(self, ranges):
+        """
+        Read byte ranges of the file through the block cache.
+        Args:
+            ranges (list of tuple):
+                (start, stop) byte offsets.
+
+        Returns:
+            bytes:
+                The ranges, concatenated in order.
+        """
+        n_blocks_file = (self.size_file + self.block_size - 1) // self.block_size
+        idx_blocks = []
+        for start, stop in ranges:
+            if stop <= start:
+                continue
+            last = (stop - 1) // self.block_size
+            idx_blocks += list(range(start // self.block_size, min(last + 1 + self.prefetch_blocks, n_blocks_file)))
+        idx_blocks = list(OrderedDict.fromkeys(idx_blocks))
+        with self._lock:
+            self.stats['n_requests'] += 1
+            self._fetch_blocks(idx_blocks)
+            out = []
+            for start, stop in ranges:
+                pos = start
+                while pos < stop:
+                    i = pos // self.block_size
+                    block = self._blocks[i]
+                    out.append(block[pos - i * self.block_size : min(stop - i * self.block_size, len(block))])
+                    pos = min(stop, (i + 1) * self.block_size)
+        return b''.join(out)
+
+    def _read_range(self, start, stop):
+        return self._read_ranges([(start, stop)])
+
+    def _normalize_key(self, key):
+        """
+        Expand a key to one entry per axis (Ellipsis and missing axes
+         become full slices).
+        """
+        key = key if isinstance(key, tuple) else (key,)
+        n_ellipsis = sum([k is Ellipsis for k in key])
+        if n_ellipsis > 1:
+            raise IndexError('an index can only have a single ellipsis')
+        if n_ellipsis == 1:
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i+1:]
+        if len(key) > self.ndim:
+            raise IndexError(f'too many indices for array: array is {self.ndim}-dimensional, but {len(key)} were indexed')
+        return key + (slice(None),) * (self.ndim - len(key))
+
+    def __getitem__(self, key):
+        import numpy as np
+
+        if self.dtype.hasobject:
+            raise TypeError(f'{self.path} is an object array (pickled). Use .load(allow_pickle=True) to download it')
+        if self.ndim == 0:
+            return self.load()[key]
+        key = self._normalize_key(key)
+
+        ## Fortran order is C order of the transposed array
+        if self.fortran_order:
+            shape_c, key_c = self.shape[::-1], key[::-1]
+        else:
+            shape_c, key_c = self.shape, key
+
+        ## rows: first axis of the C ordered array
+        k0 = key_c[0]
+        if isinstance(k0, (int, np.integer)):
+            rows = np.array([range(shape_c[0])[k0]])
+        elif isinstance(k0, slice):
+            rows = np.arange(shape_c[0])[k0]
+        else:
+            rows = np.arange(shape_c[0])[np.asarray(k0)]
+        if rows.ndim != 1:
+            raise IndexError('only 1D index arrays are supported')
+
+        ## columns: a contiguous range of the second axis is read per row, the rest is applied after
+        n_row = int(np.prod(shape_c[1:], dtype=np.int64))
+        n_inner = int(np.prod(shape_c[2:], dtype=np.int64))
+        key_rest = key_c[1:]
+        col_start, col_stop = 0, (shape_c[1] if len(shape_c) > 1 else 1)
+        if len(shape_c) > 1:
+            k1 = key_c[1]
+            if isinstance(k1, slice) and k1.step in (None, 1):
+                col_start, col_stop, _ = k1.indices(shape_c[1])
+                col_stop = max(col_stop, col_start)
+                key_rest = (slice(None),) + key_c[2:]
+            elif isinstance(k1, (int, np.integer)):
+                col_start = range(shape_c[1])[k1]
+                col_stop = col_start + 1
+                key_rest = (0,) + key_c[2:]
+
+        itemsize = self.dtype.itemsize
+        ranges = []
+        for row in rows:
+            start = self.offset + (int(row) * n_row + col_start * n_inner) * itemsize
+            stop = self.offset + (int(row) * n_row + col_stop * n_inner) * itemsize
+            ## merge with the previous range if they touch (consecutive rows with full width)
+            if len(ranges) > 0 and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], stop)
+            else:
+                ranges.append((start, stop))
+        data = np.frombuffer(self._read_ranges(ranges), dtype=self.dtype)
+        out = data.reshape((len(rows), col_stop - col_start, *shape_c[2:]) if len(shape_c) > 1 else (len(rows),))
+        out = out[(slice(None),) + tuple(key_rest)] if len(shape_c) > 1 else out
+        if isinstance(k0, (int, np.integer)):
+            out = out[0]
+        if self.fortran_order:
+            out = out.T
+        out = np.array(out)
+        return out[()] if out.ndim == 0 else out
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[...] if not self.dtype.hasobject else self.load(allow_pickle=True)
+        return out.astype(dtype) if dtype is not None else out
+
+    def load(self, allow_pickle=False):
+        """
+        Download and load the whole file.
+        Args:
+            allow_pickle (bool):
+                Needed for object arrays (stat.npy, ops.npy).
+        """
+        import io
+        import numpy as np
+        out = np.load(io.BytesIO(self._read_range(0, self.size_file)), allow_pickle=allow_pickle)
+        return out
+
+    def close(self):
+        self._f.close()
+        self._blocks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class connection_pool():
+    """
+    Authenticates once per host and hands out ssh shells,
+     exec channels and sftp clients that all share the same
+     paramiko.Transport.
+    Transports are kept alive, and are re-authenticated
+     transparently if they drop.
+    Note that the password is kept (base64 encoded, see pw_encode)
+     for as long as the pool exists so that it can reconnect.
+    """
+    def __init__(
+        self,
+        username='rh183',
+        password='',
+        passcode_method=1,
+        keepalive=30,
+        timeout=60,
+        verbose=True,
+    ):
+        """
+        Args:
+            username (str):
+                Username to log in with.
+            password (str):
+                Password to log in with.
+            passcode_method (int):
+                Method to use for O2 passcode if the server
+                 asks for one during authentication.
+                See ssh_interface.o2_connect.
+            keepalive (int):
+                Seconds between keepalive packets.
+                0 disables keepalive.
+            timeout (float):
+                Timeout for connecting and authenticating.
+            verbose (bool):
+                Whether or not to print progress.
+        """
+        self.username = username
+        self._pw = pw_encode(password)
+        self.passcode_method = passcode_method
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.verbose = verbose
+
+        self._transports = {}
+        self._lock = threading.Lock()
+        self.n_connects = 0
+
+    def get_transport(self, hostname, port=22):
+        """
+        Get the authenticated transport for a host.
+        Connects (and authenticates) only if there is no live
+         transport for this host yet.
+        Args:
+            hostname (str):
+                Hostname of the remote server.
+            port (int):
+                Port of the remote server.
+
+        Returns:
+            paramiko.Transport:
+                Authenticated transport.
+        """
+        key = (hostname, port)
+        with self._lock:
+            transport = self._transports.get(key)
+            if transport is None or not transport.is_active() or not transport.is_authenticated():
+                if transport is not None:
+                    if self.verbose:
+                        print(f'connection to {hostname} dropped, reconnecting')
+                    transport.close()
+                transport = self._connect(hostname, port)
+                self._transports[key] = transport
+            return transport
+
+    def _connect(self, hostname, port=22):
+        """
+        Open and authenticate a new transport.
+        Tries password authentication first. If the server asks
+         for more (eg keyboard-interactive for Duo), answers
+         password prompts with the password and passcode prompts
+         with self.passcode_method.
+        """
+        sock = socket.create_connection((hostname, port), timeout=self.timeout)
+        transport = paramiko.Transport(sock)
+        transport.start_client(timeout=self.timeout)
+        try:
+            remaining = transport.auth_password(self.username, pw_decode(self._pw))
+        except paramiko.BadAuthenticationType as e:
+            remaining = e.allowed_types
+        if not transport.is_authenticated() and 'keyboard-interactive' in remaining:
+            def _handler(title, instructions, prompts):
+                answers = []
+                for prompt, echo in prompts:
+                    if 'passcode' in prompt.lower() or 'option' in prompt.lower():
+                        answers.append(str(self.passcode_method))
+                    else:
+                        answers.append(pw_decode(self._pw))
+                return answers
+            transport.auth_interactive(self.username, _handler)
+        if not transport.is_authenticated():
+            transport.close()
+            raise paramiko.AuthenticationException(f'could not authenticate to {hostname} as {self.username}')
+        if self.keepalive:
+            transport.set_keepalive(self.keepalive)
+        self.n_connects += 1
+        if self.verbose:
+            print(f'connected to {hostname} as {self.username}')
+        return transport
+
+    def ssh(self, hostname, port=22, open_shell=True, o2_login=True, **kwargs_ssh):
+        """
+        Get an ssh_interface on the pooled transport of a host.
+        Args:
+            hostname (str):
+                Hostname of the remote server.
+            port (int):
+                Port of the remote server.
+            open_shell (bool):
+                Whether or not to open an interactive shell.
+                Not needed if only ssh_interface.run is used.
+            o2_login (bool):
+                If True and a shell is opened, waits for the
+                 shell prompt, answering a Duo prompt if one
+                 shows up. See ssh_interface.o2_login_shell.
+            kwargs_ssh (dict):
+                Passed to ssh_interface.
+
+        Returns:
+            ssh_interface:
+                Does not close the pooled transport on close.
+        """
+        ssh = ssh_interface(transport=self.get_transport(hostname, port), open_shell=open_shell, **kwargs_ssh)
+        if open_shell and o2_login:
+            ssh.o2_login_shell(username=self.username, passcode_method=self.passcode_method, verbose=ssh.verbose)
+        return ssh
+
+    def sftp(self, hostname, port=22, **kwargs_sftp):
+        """
+        Get an sftp_interface on the pooled transport of a host.
+        Args:
+            hostname (str):
+                Hostname of the remote server.
+            port (int):
+                Port of the remote server.
+            kwargs_sftp (dict):
+                Passed to sftp_interface (eg cache_ttl).
+
+        Returns:
+            sftp_interface:
+                Does not close the pooled transport on close.
+        """
+        return sftp_interface(hostname=hostname, port=port, transport=self.get_transport(hostname, port), **kwargs_sftp)
+
+    def run(self, hostname, cmd, port=22, **kwargs_run):
+        """
+        Run a command on an exec channel of the pooled transport.
+        Args:
+            hostname (str):
+                Hostname of the remote server.
+            cmd (str):
+                Command to run.
+            port (int):
+                Port of the remote server.
+            kwargs_run (dict):
+                Passed to ssh_interface.run.
+
+        Returns:
+            command_result:
+                See ssh_interface.run.
+        """
+        return self.ssh(hostname, port=port, open_shell=False, verbose=self.verbose).run(cmd, **kwargs_run)
+
+    def close(self, hostname=None):
+        """
+        Close pooled transports.
+        Args:
+            hostname (str):
+                If None, closes all transports.
+        """
+        with self._lock:
+            for key in list(self._transports.keys()):
+                if hostname is None or key[0] == hostname:
+                    self._transports.pop(key).close()
+
+
+def _quote_glob(pattern):
+    """
+    Quotes a glob pattern for a remote shell. The wildcards (*, ?
+     and [...]) stay active, everything else is quoted, so that paths
+     with spaces or other shell characters match as they are.
+    """
+    parts = re.split(r'(\*|\?|\[[^\]/]*\])', pattern)
+    return ''.join([part if (ii % 2 == 1) else (shlex.quote(part) if part else '') for ii, part in enumerate(parts)])
+
+
+def slurm_log_pattern_to_glob(path_log):
+    """
+    Converts a slurm --output path (eg paths_log in dispatcher.py,
+     'print_log_%j.log') into a glob pattern ('print_log_*.log').
+    Args:
+        path_log (str):
+            Path with slurm filename patterns (%j, %A, %a, %x, %u, %N, ...).
+
+    Returns:
+        str:
+            Glob pattern.
+    """
+    return re.sub(r'%[0-9]*[AajJNnstux]', '*', path_log.replace('%%', '%'))
+
+
+class log_follower():
+    """
+    Follows one or more growing remote log files and yields only
+     the new lines, without re-reading what was already seen.
+    Keeps a byte offset per file. New bytes are read with an SFTP
+     seek/read, or with 'tail -c +N' over an exec channel.
+    Files matching the glob pattern(s) that appear later (eg the
+     slurm log of a job that just started) are picked up.
+    """
+    def __init__(
+        self,
+        patterns,
+        sftp=None,
+        ssh=None,
+        from_start=True,
+        max_bytes_per_read=2**24,
+        encoding='utf-8',
+    ):
+        """
+        Args:
+            patterns (str or list of str):
+                Remote paths or glob patterns of the log files.
+                Slurm patterns like '%j' are converted to '*'
+                 (see slurm_log_pattern_to_glob).
+            sftp (sftp_interface):
+                Used to list and read the logs.
+            ssh (ssh_interface):
+                Used instead of sftp if sftp is None.
+                Reads with 'tail -c +N' through ssh.run.
+            from_start (bool):
+                If True, lines already in the files are yielded.
+                If False, only lines written after the first
+                 poll are yielded.
+            max_bytes_per_read (int):
+                Maximum number of bytes fetched per file per poll.
+            encoding (str):
+                Encoding of the log files.
+        """
+        assert (sftp is not None) or (ssh is not None), 'one of sftp or ssh must be given'
+        patterns = [patterns] if isinstance(patterns, str) else list(patterns)
+        self.patterns = [slurm_log_pattern_to_glob(p) for p in patterns]
+        self.sftp = sftp
+        self.ssh = ssh
+        self.from_start = from_start
+        self.max_bytes_per_read = max_bytes_per_read
+        self.encoding = encoding
+
+        self.offsets = {}
+        self._partial = {}
+        self._decoders = {}
+        self._n_polls = 0
+
+    def _glob(self, pattern):
+        """
+        Expands a remote glob pattern.
+        Each directory that contains a wildcard component is
+         listed once.
+        """
+        import fnmatch
+        if self.sftp is None:
+            out = self.ssh.run(f'for f in {_quote_glob(pattern)}; do [ -f "$f" ] && echo "$f"; done', verbose=False).stdout
+            return sorted([line for line in out.splitlines() if line])
+
+        parts = PurePosixPath(pattern).parts
+        paths = [PurePosixPath(parts[0])]
+        for ii, part in enumerate(parts[1:]):
+            is_last = ii == len(parts) - 2
+            paths_new = []
+            for path in paths:
+                if not re.search(r'[*?[]', part):
+                    paths_new.append(path / part)
+                    continue
+                try:
+                    attrs = self.sftp.sftp.listdir_attr(path.as_posix())
+                except IOError:
+                    continue
+                paths_new += [path / attr.filename for attr in attrs if fnmatch.fnmatchcase(attr.filename, part) and (stat.S_ISDIR(attr.st_mode) != is_last)]
+            paths = paths_new
+        return sorted([p.as_posix() for p in paths])
+
+    def _size(self, path):
+        if self.sftp is None:
+            return None
+        try:
+            return self.sftp.sftp.stat(path).st_size
+        except IOError:
+            return None
+
+    def _read_from(self, path, offset):
+        """
+        Reads new bytes of a remote file starting at offset.
+        """
+        if self.sftp is not None:
+            with self.sftp.sftp.open(path, 'rb') as f:
+                f.seek(offset)
+                return f.read(self.max_bytes_per_read)
+        ## base64 so that the bytes arrive as they are: the offset must count bytes, not decoded text
+        result = self.ssh.run(f"tail -c +{offset+1} {shlex.quote(path)} | head -c {self.max_bytes_per_read} | base64", verbose=False)
+        return base64.b64decode(result.stdout)
+
+    def poll(self):
+        """
+        Check all matching files once for new content.
+
+        Returns:
+            list of (str, str):
+                (path, line) for every new complete line.
+                A trailing line without a newline is held back
+                 until it is completed.
+        """
+        lines = []
+        paths = sorted(set(sum([self._glob(p) for p in self.patterns], [])))
+        for path in paths:
+            size = self._size(path)
+            if size is None and self.sftp is not None:
+                ## a literal path that does not exist yet (eg the log of a pending job). poll it again later
+                continue
+            if path not in self.offsets:
+                ## files already there at the first poll start at their end if not from_start.
+                ##  files that show up later are read from the start.
+                self.offsets[path] = (size or 0) if (not self.from_start and self._n_polls == 0) else 0
+                self._partial[path] = ''
+                self._decoders[path] = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+            offset = self.offsets[path]
+            if size is not None:
+                if size < offset:
+                    ## file was truncated or replaced. start over
+                    offset = 0
+                    self._partial[path] = ''
+                if size == offset:
+                    continue
+            data = self._read_from(path, offset)
+            if len(data) == 0:
+                continue
+            self.offsets[path] = offset + len(data)
+            text = self._partial[path] + self._decoders[path].decode(data)
+            *complete, self._partial[path] = text.split('\n')
+            lines += [(path, line.rstrip('\r')) for line in complete]
+        self._n_polls += 1
+        return lines
+
+    def follow(
+        self,
+        interval=5,
+        interval_max=60,
+        timeout=None,
+    ):
+        """
+        Yield new lines as they are written.
+        The polling interval doubles (up to interval_max) while
+         nothing new shows up, and resets when it does.
+        Args:
+            interval (float):
+                Initial seconds between polls.
+            interval_max (float):
+                Maximum seconds between polls.
+            timeout (float):
+                Stop after this many seconds.
+                If None, follows forever.
+
+        Yields:
+            (str, str):
+                (path, line)
+        """
+        t_start = time.time()
+        wait = interval
+        while True:
+            lines = self.poll()
+            for line in lines:
+                yield line
+            wait = interval if len(lines) > 0 else min(wait * 2, interval_max)
+            if timeout is not None:
+                t_left = timeout - (time.time() - t_start)
+                if t_left <= 0:
+                    return
+                wait = min(wait, t_left)
+            time.sleep(wait)
+
+    def wait_for(
+        self,
+        marker='RUN COMPLETE',
+        interval=5,
+        interval_max=60,
+        timeout=None,
+        verbose=True,
+    ):
+        """
+        Wait until a line containing marker is written.
+        Lines are checked as they stream past and are not kept.
+        Args:
+            marker (str):
+                String to wait for.
+            interval (float):
+                Initial seconds between polls.
+            interval_max (float):
+                Maximum seconds between polls.
+            timeout (float):
+                Give up after this many seconds.
+                If None, waits forever.
+            verbose (bool):
+                Whether or not to print new lines.
+
+        Returns:
+            (bool, str):
+                Whether or not the marker was found,
+                 and the path of the file it was found in.
+        """
+        for path, line in self.follow(interval=interval, interval_max=interval_max, timeout=timeout):
+            if verbose:
+                print(line)
+            if marker in line:
+                return True, path
+        return False, None
+
+
+job_status = namedtuple('job_status', ['job_id', 'name', 'state', 'elapsed', 'time_limit', 'max_rss', 'exit_code', 'reason'])
+job_status.__doc__ = """
+Status of one slurm job. See slurm_job_monitor.
+    job_id (str): Slurm job id (eg '1234' or '1234_5' for array tasks).
+    name (str): Job name.
+    state (str): Slurm state (eg 'PENDING', 'RUNNING', 'COMPLETED', 'TIMEOUT').
+    elapsed (float): Elapsed time in seconds.
+    time_limit (float): Time limit in seconds. None if unknown.
+    max_rss (int): Peak resident memory over all job steps, in bytes. None if unknown.
+    exit_code (str): Slurm exit code ('exit:signal'). None while running.
+    reason (str): Pending reason or node list from squeue.
+"""
+
+
+class slurm_job_monitor():
+    """
+    Tracks the status of a set of slurm jobs with one squeue and
+     one sacct call per poll, for all jobs at once.
+    Results are cached, and the polling interval backs off while
+     nothing changes.
+    """
+    states_terminal = ['COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE']
+    ## pending reasons of jobs that will never start (eg an afterok job whose dependency failed,
+    ##  submitted without --kill-on-invalid-dep=yes). they are counted as terminal
+    reasons_never_run = ['DependencyNeverSatisfied']
+
+    def __init__(
+        self,
+        ssh,
+        job_ids=None,
+        path_job_ids=None,
+        interval=30,
+        interval_max=600,
+        cmd_squeue='squeue',
+        cmd_sacct='sacct',
+        verbose=True,
+    ):
+        """
+        Args:
+            ssh (ssh_interface):
+                Used to run squeue and sacct (through ssh.run)
+                 on a host that can talk to the scheduler.
+            job_ids (list of str):
+                Job ids to track.
+            path_job_ids (str or list of str):
+                Remote path(s) of job id files written by
+                 dispatcher.py (one job id per line).
+                Read on every poll, so new submissions are picked up.
+            interval (float):
+                Minimum seconds between scheduler queries.
+                Calls to self.query in between return the cache.
+            interval_max (float):
+                Maximum seconds between queries when backing off.
+            cmd_squeue (str):
+                squeue command. Can point at a stand-in script.
+            cmd_sacct (str):
+                sacct command. Can point at a stand-in script.
+            verbose (bool):
+                Whether or not to print the status summary.
+        """
+        self.ssh = ssh
+        self.job_ids = [str(j) for j in job_ids] if job_ids is not None else []
+        self.path_job_ids = [path_job_ids] if isinstance(path_job_ids, str) else (path_job_ids or [])
+        self.interval_min = interval
+        self.interval = interval
+        self.interval_max = interval_max
+        self.cmd_squeue = cmd_squeue
+        self.cmd_sacct = cmd_sacct
+        self.verbose = verbose
+
+        self.table = {}
+        self.t_last_query = None
+        self.n_queries = 0
+
+    def _load_job_ids(self):
+        """
+        Read job ids from the job id files (one cat for all files).
+        """
+        if len(self.path_job_ids) == 0:
+            return
+        out = self.ssh.run(f"cat {' '.join(shlex.quote(p) for p in self.path_job_ids)} 2>/dev/null", verbose=False).stdout
+        for job_id in out.split():
+            if job_id not in self.job_ids:
+                self.job_ids.append(job_id)
+
+    def query(self, force=False):
+        """
+        Get the status of all tracked jobs.
+        Only asks the scheduler if the current polling interval
+         has passed since the last query (or if force).
+        Args:
+            force (bool):
+                Whether or not to ignore the cache.
+
+        Returns:
+            dict:
+                {job_id: job_status}
+        """
+        if (not force) and (self.t_last_query is not None) and (time.time() - self.t_last_query) < self.interval:
+            return self.table
+
+        self._load_job_ids()
+        if len(self.job_ids) == 0:
+            return self.table
+        ids = ','.join(self.job_ids)
+        sep = '===SACCT==='
+        cmd = (
+            f"{self.cmd_squeue} -h -j {ids} -o '%i|%j|%T|%M|%l|%R' 2>/dev/null; "
+            f"echo '{sep}'; "
+            f"{self.cmd_sacct} -n -P -j {ids} --format=JobID,JobName,State,Elapsed,Timelimit,MaxRSS,ExitCode 2>/dev/null"
+        )
+        out = self.ssh.run(cmd, verbose=False).stdout
+        out_squeue, _, out_sacct = out.partition(sep)
+        ## rebuilt on every poll: rows that are gone (eg '1234_[3-9%2]' once its tasks started) must not linger
+        table = _parse_sacct(out_sacct)
+        ## squeue is authoritative for jobs that are still in the queue
+        for job_id, status in _parse_squeue(out_squeue).items():
+            status_acct = table.get(job_id)
+            table[job_id] = status._replace(max_rss=status_acct.max_rss if status_acct is not None else None)
+
+        changed = {j: s.state for j, s in table.items()} != {j: s.state for j, s in self.table.items()}
+        self.interval = self.interval_min if changed else min(self.interval * 2, self.interval_max)
+        self.table = table
+        self.t_last_query = time.time()
+        self.n_queries += 1
+        if self.verbose:
+            print(f'{time.ctime()}  {self.summary()}  (next query in >= {self.interval:.0f} s)')
+        return self.table
+
+    def summary(self):
+        """
+        Returns:
+            dict:
+                {state: number of jobs in that state}
+        """
+        counts = {}
+        for status in self.table.values():
+            counts[status.state] = counts.get(status.state, 0) + 1
+        return counts
+
+    def is_terminal(self, status):
+        """
+        Args:
+            status (job_status):
+                Status of one job.
+
+        Returns:
+            bool:
+                Whether the job has ended, or is pending for a reason
+                 that means it will never start (see reasons_never_run).
+        """
+        if status.state.split()[0] in self.states_terminal:
+            return True
+        return status.state.split()[0] == 'PENDING' and any([reason in (status.reason or '') for reason in self.reasons_never_run])
+
+    def done(self):
+        """
+        Returns:
+            bool:
+                Whether or not every tracked job is in a terminal state
+                 (see is_terminal).
+        """
+        return len(self.job_ids) > 0 and all(
+            (j in self.table) and self.is_terminal(self.table[j]) for j in self._top_level_ids()
+        )
+
+    def _top_level_ids(self):
+        ## an array job id '1234' stands for all of its tasks '1234_N'
+        ids = set()
+        for j in self.job_ids:
+            tasks = [k for k in self.table if k.startswith(f'{j}_')]
+            ids.update(tasks if len(tasks) > 0 else [j])
+        return ids
+
+    def wait(self, timeout=None):
+        """
+        Poll until every tracked job is in a terminal state.
+        Args:
+            timeout (float):
+                Give up after this many seconds.
+                If None, waits forever.
+
+        Returns:
+            dict:
+                {job_id: job_status}
+        """
+        t_start = time.time()
+        while True:
+            self.query()
+            if self.done():
+                return self.table
+            if timeout is not None and (time.time() - t_start) > timeout:
+                return self.table
+            time.sleep(max(0.0, self.interval - (time.time() - self.t_last_query)) + 0.01)
+
+
+def load_stage_profiles(sftp, dir_remote, name_file='profile.jsonl', workers=4):
+    """
+    Collect the per stage profiling records (written by profiling.py
+     in remote_run_s2p.py) of all jobs under a remote directory.
+    Args:
+        sftp (sftp_interface):
+            Connected sftp_interface.
+        dir_remote (str):
+            Remote directory to search (eg dir_save of a batch run).
+        name_file (str):
+            Name of the profiling files.
+        workers (int):
+            Number of SFTP channels to search with (see walk_remote).
+
+    Returns:
+        list of dict:
+            All records, each with 'path' (the file it came from).
+             Lines that can't be parsed are skipped.
+    """
+    import json
+
+    entries = sftp.walk_remote(dir_remote, workers=workers)
+    paths = [e.path for e in entries if (not e.is_dir) and PurePosixPath(e.path).name == name_file]
+
+    records = []
+    for path in paths:
+        with sftp.sftp.open(path, 'r') as f:
+            text = f.read().decode('utf-8', errors='replace')
+        for line in text.splitlines():
+            try:
+                records.append({**json.loads(line), 'path': path})
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def summarize_stage_profiles(records):
+    """
+    Summarize profiling records of many jobs by stage.
+    Plane indices are merged ('plane3.registration' -> 'plane*.registration').
+    Args:
+        records (list of dict):
+            Output of load_stage_profiles.
+
+    Returns:
+        dict:
+            {stage: {'n', 'n_failed', 'wall_s_mean', 'wall_s_max', 'cpu_s_mean',
+             'peak_rss_GB_max', 'read_all_GB_mean', 'written_all_GB_mean'}}
+    """
+    def mean(vals):
+        vals = [v for v in vals if v is not None]
+        return (sum(vals) / len(vals)) if len(vals) > 0 else None
+
+    def max_(vals):
+        vals = [v for v in vals if v is not None]
+        return max(vals) if len(vals) > 0 else None
+
+    groups = {}
+    for r in records:
+        groups.setdefault(re.sub(r'plane\d+', 'plane*', r['stage']), []).append(r)
+    return {stage: {
+        'n': len(rs),
+        'n_failed': sum([r.get('status') != 'done' for r in rs]),
+        'wall_s_mean': mean([r.get('wall_s') for r in rs]),
+        'wall_s_max': max_([r.get('wall_s') for r in rs]),
+        'cpu_s_mean': mean([r.get('cpu_s') for r in rs]),
+        'peak_rss_GB_max': max_([r.get('peak_rss_GB') for r in rs]),
+        'read_all_GB_mean': mean([r.get('read_all_GB') for r in rs]),
+        'written_all_GB_mean': mean([r.get('written_all_GB') for r in rs]),
+    } for stage, rs in groups.items()}
+
+
+def remote_copy(
+    ssh,
+    source,
+    target,
+    workers=8,
+    checksum=None,
+    path_manifest=None,
+    dry_run=False,
+    timeout=None,
+    cmd_python='python3',
+    path_helper=None,
+    verbose=True,
+):
+    """
+    Copy the new and changed files of a remote directory to another
+     remote directory, on the server, with remote_copy.py.
+    Replaces 'cp -r source/. target': unchanged files are skipped,
+     several files are copied at once (largest first), copies can be
+     verified with a checksum, and a summary comes back instead of a
+     shell prompt.
+    remote_copy.py is sent with the command (it does not need to be
+     on the server) and only needs python's standard library.
+    Args:
+        ssh (ssh_interface):
+            Connected ssh_interface (eg on the transfer node).
+             Uses ssh.run, so no shell is needed.
+        source (str):
+            Remote source directory.
+        target (str):
+            Remote destination directory.
+        workers (int):
+            Number of files copied at once.
+        checksum (str):
+            hashlib algorithm (eg 'blake2b') to verify each copied file
+             with. None: no verification.
+        path_manifest (str):
+            Remote json file to write the destination manifest to.
+             See remote_copy.copy_tree.
+        dry_run (bool):
+            Only report what would be copied.
+        timeout (float):
+            Seconds to wait for the copy. None: forever.
+        cmd_python (str):
+            Python on the server.
+        path_helper (str):
+            Local path of remote_copy.py. None: next to this file.
+        verbose (bool):
+            Whether to print a one line summary.
+
+    Returns:
+        dict:
+            Summary printed by remote_copy.py ('n_copied', 'n_skipped',
+             'n_bytes_copied', 'n_bytes_skipped', 'time',
+             'throughput_MBps', 'errors', 'checksums', ...).
+    """
+    args = [source, target, '--workers', str(workers)] + \
+        (['--checksum', checksum] if checksum is not None else []) + \
+        (['--path-manifest', path_manifest] if path_manifest is not None else []) + \
+        (['--dry-run'] if dry_run else [])
+    summary = _run_helper(
+        ssh=ssh,
+        path_helper=Path(__file__).resolve().parent / 'remote_copy.py' if path_helper is None else path_helper,
+        args=args,
+        marker='REMOTE_COPY_SUMMARY ',
+        timeout=timeout,
+        cmd_python=cmd_python,
+        description=f'remote copy {source} -> {target}',
+    )
+    if verbose:
+        print(
+            f"remote copy {source}  ->  {target}:  {summary['n_copied']} files copied ({summary['n_bytes_copied']/1e9:.3f} GB), "
+            f"{summary['n_skipped']} up to date ({summary['n_bytes_skipped']/1e9:.3f} GB) in {summary['time']:.1f} s "
+            f"({summary['throughput_MBps']:.1f} MB/s, {summary['workers']} workers)" + (f".  {len(summary['errors'])} errors" if summary['errors'] else '')
+        )
+    if len(summary['errors']) > 0:
+        raise IOError(f"{len(summary['errors'])} of {summary['n_to_copy']} files failed to copy. First failure: {summary['errors'][0][0]}: {summary['errors'][0][1]}")
+    return summary
+
+
+def summarize_sweep(
+    ssh,
+    dir_save,
+    prefix='jobNum_',
+    name_table='sweep_summary.csv',
+    sftp=None,
+    path_local=None,
+    workers=8,
+    force=False,
+    timeout=None,
+    cmd_python='python',
+    login_shell=True,
+    path_helper=None,
+    verbose=True,
+):
+    """
+    Summarize the job folders of a sweep on the server (sweep_summary.py)
+     into one small table, and optionally download it.
+    One row per job: ROI count, cell fraction, ROI sizes, registration
+     offsets, runtime and the params that were swept. Rows are cached on
+     the server, so a rerun only reads new or changed jobs.
+    sweep_summary.py is sent with the command. It needs numpy, so
+     cmd_python must be a python that has it (eg the environment that
+     the login files activate, 'conda run -n suite2p python', or
+     'srun -p short -t 0:20 -c 8 --mem 16G python' to keep the work off
+     the login node).
+    Args:
+        ssh (ssh_interface):
+            Connected ssh_interface. Uses ssh.run, so no shell is needed.
+        dir_save (str):
+            Remote folder of the sweep (dir_save of dispatcher.py).
+        prefix (str):
+            Job folder prefix (name_job of dispatcher.py).
+        name_table (str):
+            Name of the table in dir_save. '.csv' or '.parquet'
+             (needs pandas and pyarrow on the server).
+        sftp (sftp_interface):
+            Connected sftp_interface to download the table with.
+             Only used if path_local is set.
+        path_local (str):
+            Local path to download the table to. None: don't download.
+        workers (int):
+            Number of job folders read at once.
+        force (bool):
+            Recompute every job, ignoring the cache.
+        timeout (float):
+            Seconds to wait. None: forever.
+        cmd_python (str):
+            Python on the server.
+        login_shell (bool):
+            Whether to run in a login shell, so that module / conda
+             from the login files are loaded.
+        path_helper (str):
+            Local path of sweep_summary.py. None: next to this file.
+        verbose (bool):
+            Whether to print a one line summary.
+
+    Returns:
+        dict:
+            Summary printed by sweep_summary.py ('path_table', 'n_jobs',
+             'n_computed', 'n_cached', 'n_complete', 'time', 'errors'),
+             with 'path_local' if the table was downloaded.
+    """
+    path_table = str(PurePosixPath(dir_save) / name_table)
+    args = [dir_save, '--prefix', prefix, '--path-out', path_table, '--workers', str(workers)] + (['--force'] if force else [])
+    summary = _run_helper(
+        ssh=ssh,
+        path_helper=Path(__file__).resolve().parent / 'sweep_summary.py' if path_helper is None else path_helper,
+        args=args,
+        marker='SWEEP_SUMMARY ',
+        timeout=timeout,
+        cmd_python=cmd_python,
+        login_shell=login_shell,
+        description=f'sweep summary of {dir_save}',
+    )
+    if verbose:
+        print(
+            f"sweep summary of {dir_save}:  {summary['n_jobs']} jobs ({summary['n_complete']} complete), "
+            f"{summary['n_computed']} read, {summary['n_cached']} cached, in {summary['time']:.1f} s" + (f".  {len(summary['errors'])} errors" if summary['errors'] else '')
+        )
+    if path_local is not None:
+        if sftp is None:
+            raise ValueError('sftp is needed to download the table')
+        Path(path_local).parent.mkdir(parents=True, exist_ok=True)
+        sftp.sftp.get(summary['path_table'], str(path_local))
+        summary['path_local'] = str(path_local)
+    return summary
+
+
+def _run_helper(ssh, path_helper, args, marker, timeout=None, cmd_python='python3', login_shell=False, description='helper'):
+    """
+    Run a local helper script on the server without copying it there,
+     and parse the json summary it prints last.
+    The script is sent base64 encoded and runs as __main__ of
+     'python -c', with args as its command line arguments.
+
+    Returns:
+        dict:
+            The json after marker on the last line that starts with it.
+    """
+    import json
+
+    path_helper = Path(path_helper)
+    code = base64.b64encode(path_helper.read_bytes()).decode('ascii')
+    code_run = f"import base64; exec(compile(base64.b64decode('{code}'), '{path_helper.name}', 'exec'))"
+    cmd = f"{cmd_python} -c {shlex.quote(code_run)} {' '.join([shlex.quote(str(a)) for a in args])}"
+    result = ssh.run(cmd, timeout=timeout, login_shell=login_shell, verbose=False)
+
+    lines = [line for line in result.stdout.splitlines() if line.startswith(marker)]
+    if len(lines) == 0:
+        raise RuntimeError(f'{description} gave no summary (exit code {result.exit_code}):\n{result.stderr}')
+    return json.loads(lines[-1][len(marker):])
+
+
+def _expand_array_id(job_id):
+    """
+    Expands the collapsed id of pending array tasks
+     ('1234_[3-9%2]', '1234_[1,4-5]') into one id per task
+     (['1234_3', ..., '1234_9']). Other ids are returned as [job_id].
+    """
+    match = re.match(r'^(\d+)_\[([^\]]+)\]$', job_id)
+    if match is None:
+        return [job_id]
+    ids = []
+    for part in match.group(2).split('%')[0].split(','):
+        start, _, stop = part.partition('-')
+        stop, _, step = stop.partition(':')
+        ids += [f'{match.group(1)}_{i}' for i in range(int(start), int(stop or start) + 1, int(step or 1))]
+    return ids
+
+
+def _parse_squeue(out):
+    """
+    Parses the output of squeue -h -o '%i|%j|%T|%M|%l|%R'.
+    Collapsed rows of pending array tasks are expanded (see _expand_array_id).
+    """
+    table = {}
+    for line in out.strip().splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 6:
+            continue
+        job_id, name, state, elapsed, time_limit, reason = fields[:6]
+        for job_id_task in _expand_array_id(job_id):
+            table[job_id_task] = job_status(job_id_task, name, state, parse_slurm_time(elapsed), parse_slurm_time(time_limit), None, None, reason)
+    return table
+
+
+def _parse_sacct(out):
+    """
+    Parses the output of sacct -n -P --format=JobID,JobName,State,Elapsed,Timelimit,MaxRSS,ExitCode.
+    Job steps ('1234.batch', '1234.extern') are folded into their job;
+     max_rss is the maximum over the steps.
+    Collapsed rows of pending array tasks are expanded (see _expand_array_id).
+    """
+    table = {}
+    max_rss = {}
+    for line in out.strip().splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 7:
+            continue
+        job_id_full, name, state, elapsed, time_limit, rss, exit_code = fields[:7]
+        job_id = job_id_full.split('.')[0]
+        rss = parse_slurm_mem(rss)
+        if rss is not None:
+            max_rss[job_id] = max(rss, max_rss.get(job_id, 0))
+        if '.' not in job_id_full:
+            for job_id_task in _expand_array_id(job_id):
+                table[job_id_task] = job_status(job_id_task, name, state, parse_slurm_time(elapsed), parse_slurm_time(time_limit), None, exit_code, '')
+    return {job_id: status._replace(max_rss=max_rss.get(job_id)) for job_id, status in table.items()}
+
+
+class _counting_reader():
+    """
+    Minimal file-like wrapper that counts the bytes read through it.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.n_bytes = 0
+    def read(self, size=-1):
+        out = self.f.read(size)
+        self.n_bytes += len(out)
+        return out
+    def readable(self):
+        return True
+    def close(self):
+        self.f.close()
+
+
+class _counting_writer():
+    """
+    Minimal file-like wrapper that counts the bytes written through it.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.n_bytes = 0
+    def write(self, b):
+        self.f.write(b)
+        self.n_bytes += len(b)
+        return len(b)
+    def writable(self):
+        return True
+    def flush(self):
+        self.f.flush()
+    def close(self):
+        self.f.close()
+
+
+def _put_file(sftp, path_local, path_remote, offset=0, chunk_size=2**20, hash_type=None, finalize=True):
+    """
+    Uploads a file, optionally appending from a byte offset.
+    The bytes are written to path_remote + suffix_partial. Once
+     finished, the partial file gets the local mtime and is renamed
+     to path_remote (see _finalize_put), so a file under its real name
+     is always complete. sftp_interface.sync_dir only resumes
+     partial files.
+    Args:
+        sftp (paramiko.SFTPClient):
+            SFTPClient object.
+        path_local (str):
+            Path to the local file.
+        path_remote (str):
+            Path to the remote file.
+        offset (int):
+            Byte offset of the partial file to resume from.
+            0 will (over)write the whole file.
+        chunk_size (int):
+            Number of bytes to read and write at a time.
+        hash_type (str):
+            Optional name of a hashlib algorithm. The file is hashed
+             as it is read for the upload. When resuming, the bytes
+             before offset are read and hashed but not sent.
+        finalize (bool):
+            Whether to stamp and rename the partial file when done.
+             False leaves it at path_remote + suffix_partial, eg to
+             finalize only after its hash was verified.
+
+    Returns:
+        str or None:
+            Hex digest of the whole local file (None if hash_type is None).
+    """
+    h = _new_hash(hash_type) if hash_type is not None else None
+    with open(path_local, 'rb') as f_local, sftp.open(path_remote + suffix_partial, 'ab' if offset > 0 else 'wb') as f_remote:
+        f_remote.set_pipelined(True)
+        if h is not None:
+            n_left = offset
+            while n_left > 0:
+                chunk = f_local.read(min(chunk_size, n_left))
+                if not chunk:
+                    break
+                h.update(chunk)
+                n_left -= len(chunk)
+        else:
+            f_local.seek(offset)
+        for chunk in iter(lambda: f_local.read(chunk_size), b''):
+            if h is not None:
+                h.update(chunk)
+            f_remote.write(chunk)
+    if finalize:
+        _finalize_put(sftp, path_local, path_remote)
+    return h.hexdigest() if h is not None else None
+
+
+def _finalize_put(sftp, path_local, path_remote):
+    """
+    Set the mtime of an uploaded partial file to the local mtime and
+     rename it to path_remote. The mtime marks the file as up to date
+     for sftp_interface.sync_dir.
+    """
+    st = os.stat(path_local)
+    sftp.utime(path_remote + suffix_partial, (int(st.st_atime), int(st.st_mtime)))
+    sftp.posix_rename(path_remote + suffix_partial, path_remote)
+
+
+def _get_file(sftp, path_remote, path_local, chunk_size=2**20, hash_type=None):
+    """
+    Downloads a file, hashing it as the bytes arrive.
+    Reads are prefetched, so it is about as fast as SFTPClient.get.
+    Args:
+        sftp (paramiko.SFTPClient):
+            SFTPClient object.
+        path_remote (str):
+            Path to the remote file.
+        path_local (str):
+            Path to the local file.
+        chunk_size (int):
+            Number of bytes to read and write at a time.
+        hash_type (str):
+            Optional name of a hashlib algorithm.
+
+    Returns:
+        str or None:
+            Hex digest of the file (None if hash_type is None).
+    """
+    h = _new_hash(hash_type) if hash_type is not None else None
+    with sftp.open(path_remote, 'rb') as f_remote, open(path_local, 'wb') as f_local:
+        f_remote.prefetch()
+        for chunk in iter(lambda: f_remote.read(chunk_size), b''):
+            if h is not None:
+                h.update(chunk)
+            f_local.write(chunk)
+    return h.hexdigest() if h is not None else None
+
+
+## remote commands that print the same digests as hashlib.new(hash_type).hexdigest()
+cmds_hash_remote = {
+    'blake2b': 'b2sum',
+    'sha256': 'sha256sum',
+    'sha1': 'sha1sum',
+    'md5': 'md5sum',
+}
+
+
+def _hash_remote(transport, paths, hash_type='blake2b', cmd_python='python3'):
+    """
+    Hashes remote files on the server, on an exec channel of the
+     transport (so it can run while other channels transfer files).
+    Uses coreutils (b2sum, sha256sum, ...) when there is one for
+     hash_type, else python's hashlib on the server.
+    Args:
+        transport (paramiko.Transport):
+            Authenticated transport.
+        paths (list of str):
+            Remote paths.
+        hash_type (str):
+            Name of a hashlib algorithm.
+        cmd_python (str):
+            Python on the server, for algorithms without a coreutils command.
+
+    Returns:
+        dict:
+            {path: hex digest}. Files that could not be hashed are missing.
+    """
+    if len(paths) == 0:
+        return {}
+    if hash_type in cmds_hash_remote:
+        cmd = f"{cmds_hash_remote[hash_type]} -- {' '.join([shlex.quote(p) for p in paths])}"
+    else:
+        code = (
+            "import hashlib, sys\n"
+            "for p in sys.argv[2:]:\n"
+            "    h = hashlib.new(sys.argv[1])\n"
+            "    f = open(p, 'rb')\n"
+            "    for c in iter(lambda: f.read(1 << 23), b''): h.update(c)\n"
+            "    print(h.hexdigest() + '  ' + p)\n"
+        )
+        cmd = f"{cmd_python} -c {shlex.quote(code)} {shlex.quote(hash_type)} {' '.join([shlex.quote(p) for p in paths])}"
+    chan = transport.open_session()
+    chan.exec_command(cmd)
+    out = chan.makefile('rb').read().decode('utf-8', errors='replace')
+    chan.recv_exit_status()
+    chan.close()
+    ## one line per file: '<digest>  <path>'. paths are taken from the input since coreutils escapes odd names
+    digests = [line.split(maxsplit=1)[0].lstrip('\\') for line in out.splitlines() if line.strip() != '']
+    return {path: digest for path, digest in zip(paths, digests)} if len(digests) == len(paths) else {}
+
+
+def _new_hash(hash_type):
+    import hashlib
+    return hashlib.new(hash_type)
+
+
+def _hash_file(path, hash_type='blake2b', chunk_size=2**20):
+    """
+    Hashes a local file in chunks.
+    Args:
+        path (str):
+            Path to the local file.
+        hash_type (str):
+            Name of a hashlib algorithm.
+        chunk_size (int):
+            Number of bytes to read at a time.
+
+    Returns:
+        str:
+            Hex digest of the file.
+    """
+    import hashlib
+    h = hashlib.new(hash_type)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _load_manifest(path_manifest):
+    """
+    Loads a sync manifest json file.
+    Returns an empty dict if the path is None or does not exist.
+    """
+    import json
+    if path_manifest is None or not Path(path_manifest).exists():
+        return {}
+    with open(path_manifest, 'r') as f:
+        return json.load(f)
+
+
+def _update_manifest(path_manifest, files, hash_type):
+    """
+    Adds files to a manifest json file (see sftp_interface.sync_dir),
+     keeping the entries of other files.
+    Args:
+        path_manifest (str):
+            Path to the manifest.
+        files (dict):
+            {relative path: (local path, hex digest)}.
+        hash_type (str):
+            Name of the hashlib algorithm of the digests.
+    """
+    manifest = _load_manifest(path_manifest)
+    for path_rel, (path_local, digest) in files.items():
+        st = os.stat(path_local)
+        manifest[path_rel] = {'size': st.st_size, 'mtime': int(st.st_mtime), 'hash': digest, 'hash_type': hash_type}
+    _save_manifest(path_manifest, manifest)
+
+
+def _save_manifest(path_manifest, manifest):
+    """
+    Saves a sync manifest json file.
+    Does nothing if the path is None.
+    """
+    import json
+    if path_manifest is None:
+        return
+    with open(path_manifest, 'w') as f:
+        json.dump(manifest, f, indent=1)
 
 
 def pw_encode(pw):